@@ -9,17 +9,24 @@ import argparse
 import threading
 import multiprocessing as mp
 from datetime import datetime
-from utils.basler import Basler
-from utils.flir import FLIR
+from utils.devices import DeviceDiscovery, open_devices
 from utils.arduino import Arduino
 from utils.helpers import str_to_bool
 from utils.stimulation import Stimulator
-from utils.preview import DisplayManager
+from utils.preview import DisplayManager, preview_options
+from utils.multiprocess import MultiProcessAcquisition
+from utils.recorders import MOVIE_FORMATS
+from utils.session import StopMonitor, ACQUISITION_MODES, acquisition_frames
+from utils.sync import FrameSynchronizer, sync_options
+from utils.prediction import make_engine, prediction_options
+from utils.closed_loop import ClosedLoopStimulator, closed_loop_options
+from utils.events import EventLog
 from concurrent.futures import ThreadPoolExecutor
 
 
 # cv2.setNumThreads(2)
 display_lock = threading.Lock()
+stop_event = threading.Event()  # stops the grab loops of all cameras
 display_manager = DisplayManager() 
 tp = ThreadPoolExecutor(10)  # max 10 threads
 
@@ -31,30 +38,15 @@ def threaded(fn):
 grab_start_t = None
 
 @threaded
-def initialize_and_loop(tuple_list_item, logger, report_period=10): #config, camname, cam, args, experiment, start_t): #, arduino):
+def initialize_and_loop(tuple_list_item, device, logger, report_period=10): #config, camname, cam, args, experiment, start_t): #, arduino):
     global grab_start_t
     config, camname, cam, args, experiment, start_t, trigger_with_arduino, arduino = tuple_list_item
     logger.info(f"\n{camname}: Initializing Loop...\n")
     if trigger_with_arduino and arduino is None:
         raise ValueError('Trigger with Arduino is but not initialized.')
-    
-    acquisition_fps=cam['options']['AcquisitionFrameRate']
-    videowrite_fps = acquisition_fps if args.videowrite_fps is None else args.videowrite_fps
-    args.videowrite_fps = videowrite_fps
-
-    if cam['type'] == 'Realsense':
-        raise NotImplementedError
-    elif cam['type'] == 'FLIR':
-        device = FLIR(args, cam, camname, experiment, config, start_t, logger, cam_id=0,
-                      display_lock=display_lock, display_manager=display_manager)
-    elif cam['type'] == 'Basler':
-        device = Basler(args, cam, camname, experiment, config, start_t, logger, cam_id=0,
-                        display_lock=display_lock, display_manager=display_manager)
-    else:
-        raise ValueError('Invalid camera type: %s' % cam['type'])
         
     try:
-        device.get_n_frames(args.n_total_frames, report_period=report_period)
+        device.get_n_frames(acquisition_frames(args), report_period=report_period)
         # future = device.get_n_frames(args.n_total_frames, report_period=report_period)
         
         grab_start_t = time.perf_counter()
@@ -68,6 +60,12 @@ def initialize_and_loop(tuple_list_item, logger, report_period=10): #config, cam
 
     return f"{camname} done."
 
+def wait_for_cameras(futures, acquisition=None):
+    for future in futures:
+        future.result()
+    if acquisition is not None:
+        acquisition.join()
+
 def main():
     parser = argparse.ArgumentParser(description='Multi-device acquisition in Python.')
     parser.add_argument('-n','--name', type=str, default='JB999',
@@ -75,9 +73,11 @@ def main():
     parser.add_argument('-c', '--config', type=str, default='config/config-basler_multi_cam.yaml', 
         help='Configuration for acquisition. Defines number of cameras, serial numbers, etc.')
     parser.add_argument('--model_path', default='', type=str, 
-        help='Path to the prediction model')
+        help='Path to the prediction model (.onnx for ONNX Runtime, .pt/.ts for TorchScript, see the `prediction` section of the config); random keypoints if empty')
     parser.add_argument('--stimulation_path', default='', type=str, # config/stimulation_config.json
         help='Path to the stimulation config file (.json)')
+    parser.add_argument('--closed_loop', default='0', type=str,
+        help='Stimulate when predictions match the `closed_loop.rules` of the config (needs --trigger_with_arduino and predict: True)')
     parser.add_argument('-s', '--save', default="1", type=str, # action='store_true',
         help='Use this flag to save to disk. If not passed, will only view')
     parser.add_argument('--n_total_frames', default=680, type=int, # action='store_true',
@@ -86,12 +86,27 @@ def main():
          type=str, help='Flag to use python software trigger (instead of arduino)')
     parser.add_argument('--port', default='/dev/ttyACM0', type=str,
          help='port for arduino (default: /dev/ttyACM0)')
-    parser.add_argument('-a', '--acquisition_mode', default='frames', # action='store_true',
-        help='Acquisition mode.')
+    parser.add_argument('-a', '--acquisition_mode', default='frames', choices=ACQUISITION_MODES, type=str,
+        help='frames: stop after --n_total_frames, continuous: run until Ctrl+C, --experiment_duration or --min_free_disk')
+    parser.add_argument('-d', '--experiment_duration', default=float('inf'), type=float,
+         help='Experiment duration in minutes (default: inf.)')
+    parser.add_argument('--min_free_disk', default=5, type=float,
+         help='Stop acquisition when the free disk space in savedir falls below this many GB while saving (default: 5)')
     parser.add_argument('-w', '--videowrite_fps', default=30, type=float,
          help='Video save frame rate (default: acquisition rate)')
     parser.add_argument('-N', '--nodemap_path', default=None,
          action='store', help='Path to nodemap (.txt)')
+    parser.add_argument('--latency_stats', default='0', type=str,
+         help='Record per-stage grab loop latency histograms, logged every report period and saved to latency_<camname>.json')
+    parser.add_argument('--process_mode', default='thread', choices=['thread', 'process'], type=str,
+         help='Run all cameras as threads of one process, or each camera in its own process with shared memory frame transport.')
+    parser.add_argument('--movie_format', default='opencv', choices=MOVIE_FORMATS, type=str,
+        help='Video writer backend: opencv (mp4v), ffmpeg (multi-threaded `codec` from the config, see the `ffmpeg` section), '
+             'or lossless hdf5/raw with per-frame metadata')
+    parser.add_argument('-f', '--nframes_per_file', default=0, type=int,
+         help='Split videos into files of N frames, e.g. 108000 for 15 min at 120 Hz (default: 0, a single file)')
+    parser.add_argument('--segment_duration', default=0, type=float,
+         help='Split videos into files of this duration in minutes, if --nframes_per_file is not set (default: 0, a single file)')
     # parser.add_argument('-p', '--preview', default='1',
     #     help='Show preview in opencv window')
     # parser.add_argument('--predict', default='1',
@@ -102,18 +117,11 @@ def main():
     # unused flags
     # parser.add_argument('-v', '--verbose', default=False, action='store_true',
     #     help='Use this flag to print debugging commands.')
-    # parser.add_argument('--movie_format', default='opencv',
-    #     choices=['hdf5','opencv', 'ffmpeg', 'directory'], type=str,
-    #     help='Method to save files to movies. Dramatically affects performance and filesize')
     # parser.add_argument('--metadata_format', default='hdf5',
     #     choices=['hdf5', 'txt', 'csv'], type=str,
     #     help='Metadata format for timestamps (default: hdf5)')
     # parser.add_argument('-r', '--acquisition_fps', default=30, type=float,
     #      help='Acquisition frame rate (default: 30 Hz)')
-    # parser.add_argument('-d', '--experiment_duration', default=float('inf'), type=float,
-    #      help='Experiment dur in minutes (default: inf.)')
-    # parser.add_argument('-f', '--nframes_per_file', default=108000, type=int,
-    #      help='N frames per file (default: 108000, or 15min at 120Hz)')
 
     args = parser.parse_args()
 
@@ -127,14 +135,13 @@ def main():
     else:
         raise ValueError('Invalid config file: %s' %args.config)
 
+    display_manager.configure(**preview_options(config))
     trigger_with_arduino = str_to_bool(args.trigger_with_arduino)
     # if trigger_with_arduino or len(config['cams'])>1:
     if trigger_with_arduino:
+        # waits until the sketch is READY after the board reset
         arduino = Arduino(logger, port=args.port, baudrate=115200)
         arduino.initialize()
-        time.sleep(0.5)
-        arduino.continuous_listen = True
-        arduino.listen()
     else:
         arduino = None
 
@@ -142,6 +149,7 @@ def main():
     experiment = datetime.now().strftime("%Y%m%d_%H_%M_%S_")  + args.name
     directory = os.path.join(config['savedir'], experiment)
     
+    log_file = None
     if str_to_bool(args.save):
         # update config to reflect runtime params
         args_dict = vars(args)
@@ -189,48 +197,114 @@ def main():
     #     time.sleep(0.5)
 
     futures = []
+    acquisition = None
+    discovery = None
+    synchronizer = None
+    if len(tuple_list) > 1:
+        # joint frame table across cameras
+        options = sync_options(config, args)
+        synchronizer = FrameSynchronizer([tup[1] for tup in tuple_list], pwm_fps, logger, mode=options['mode'],
+                                         path=os.path.join(directory, 'frame_table') if str_to_bool(args.save) else None,
+                                         tolerance=options['tolerance'], max_pending=options['max_pending'])
+
+    inference_engine = None
+    if prediction_options(config)['batch'] and sum(bool(tup[2].get('predict')) for tup in tuple_list) > 1:
+        if args.process_mode == 'process':
+            logger.info('prediction.batch is ignored in process mode, each camera process runs its own model')
+        else:
+            # one model batching the latest frames of all cameras
+            inference_engine = make_engine(logger, args.model_path, prediction_options(config))
+
+    closed_loop = None
+    if str_to_bool(args.closed_loop):
+        if args.stimulation_path != '':
+            raise ValueError('--closed_loop and --stimulation_path both drive the stimulation, use one of them.')
+        if args.process_mode == 'process':
+            raise ValueError('--closed_loop is only supported with --process_mode thread.')
+        closed_loop = ClosedLoopStimulator(arduino, [tup[1] for tup in tuple_list], start_t, logger,
+                                           path=os.path.join(directory, 'stimulation_events') if str_to_bool(args.save) else None,
+                                           **closed_loop_options(config))
 
-    for tup in tuple_list:
-        if args.acquisition_mode == 'frames':
-            future = initialize_and_loop(tup, logger, report_period=1)
+    if args.process_mode == 'process':
+        # one process per camera, plus writer and display processes fed through shared memory
+        acquisition = MultiProcessAcquisition(tuple_list, logger, log_file=log_file, report_period=1, synchronizer=synchronizer)
+        acquisition.start()
+        time.sleep(1)
+    else:
+        if args.videowrite_fps is None:
+            args.videowrite_fps = pwm_fps
+        # one enumeration for all cameras, opened and configured concurrently before any of them grabs
+        discovery = DeviceDiscovery(logger)
+        devices = open_devices({tup[1]: tup[2] for tup in tuple_list}, args, experiment, config, start_t, logger,
+                               discovery=discovery, display_lock=display_lock, display_manager=display_manager,
+                               stop_event=stop_event, synchronizer=synchronizer, inference_engine=inference_engine,
+                               closed_loop=closed_loop)
+        for tup in tuple_list:
+            future = initialize_and_loop(tup, devices[tup[1]], logger, report_period=1)
             futures.append(future)
 
-    # display_manager.display_loop()
-    time.sleep(1)
-    logger.info(f'Starting Display...')
-    display_manager.start()
+        # display_manager.display_loop()
+        time.sleep(1)
+        logger.info(f'Starting Display...')
+        display_manager.start()
+
+    save = str_to_bool(args.save)
+    stop_monitor = StopMonitor(acquisition.stop_event if acquisition is not None else stop_event, logger,
+                               duration=args.experiment_duration * 60, path=directory if save else '.',
+                               min_free_gb=args.min_free_disk if save else 0)
+    stop_monitor.start()
 
+    event_log = None
     if trigger_with_arduino:
-        time.sleep(0.5)
+        if save:
+            # trigger pulse and stimulation times, aligned to the frame table by trigger index
+            event_log = EventLog(os.path.join(directory, 'arduino_events'), logger, start_t)
+            arduino.on_event.append(event_log.add)
+            try:
+                arduino.request('E,1')
+            except (TimeoutError, RuntimeError) as e:
+                logger.info(f'Arduino: the sketch does not stream events ({e})')
         # if pwm_fps is None:
         #     raise ValueError('pwm_fps is not set. Set one master device in the .yaml file.')
-        cmd = "S,{}\r\n".format(pwm_fps)
-        arduino.arduino.write(cmd.encode())
+        cmd = "S,{}\n".format(pwm_fps)
+        arduino.request(cmd)
         logger.info("***Sent msg to Arduino: {} ***".format(cmd))
-        time.sleep(0.5)
 
     if args.stimulation_path != '':
         stimulator = Stimulator(args, arduino, int(pwm_fps), logger, os.path.join(directory, 'loaded_stimulation_config.json'))
         logger.info('\nStimulation parameters:')
         stimulator.print_params()
         stimulator.send_stim_config()
-        time.sleep(0.1) # if stim doesn't work, sleep time may need to be adjusted based on computer's speed
 
     if args.stimulation_path != '':
         stimulator.send_stim_trigger()
         # time.sleep(0.1)
     
-    for future in futures:
-        future.result()
+    try:
+        wait_for_cameras(futures, acquisition)
+    except KeyboardInterrupt:
+        stop_monitor.stop('keyboard interrupt')
+        wait_for_cameras(futures, acquisition)
+    if discovery is not None:
+        discovery.close()
+    if synchronizer is not None:
+        synchronizer.close()
+    if closed_loop is not None:
+        closed_loop.stop(os.path.join(directory, 'closed_loop_latency.json') if str_to_bool(args.save) else None)
+    if inference_engine is not None:
+        inference_engine.stop()
     
     if trigger_with_arduino:
         logger.info("Closing Arduino")
-        arduino.arduino.write("Q\n".encode()) #b'Q\r\n')
-        time.sleep(0.2)
-        arduino.arduino.write("V\n".encode()) #b'Q\r\n')
-        time.sleep(0.2)
-        arduino.arduino.close()
+        for cmd in ['Q', 'V']:  # stop the frame trigger and the stimulation
+            try:
+                arduino.request(cmd)
+            except (TimeoutError, RuntimeError) as e:
+                logger.info(f'Arduino: {e}')
+        arduino.close()
         logger.info("Arduino is closed.")
+        if event_log is not None:
+            event_log.close()
     logger.info(f'Experiment is finished.')
         
 if __name__=='__main__':
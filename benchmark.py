@@ -0,0 +1,72 @@
+import os
+import sys
+import yaml
+import json
+import logging
+import argparse
+from datetime import datetime
+from utils.benchmark import benchmark_options, benchmark_cases, case_name, machine_info, run_case, compare
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Acquisition benchmark: runs the full pipeline for a matrix of camera counts, '
+                                                 'resolutions, frame rates, movie formats, preview and prediction.')
+    parser.add_argument('-c', '--config', type=str, default='config/benchmark.yaml',
+        help='Benchmark config with the matrix, the base acquisition config and the regression thresholds')
+    parser.add_argument('-o', '--output', type=str, default=None,
+        help='Results file (.json), default: <savedir>/benchmark_<hostname>_<date>.json')
+    parser.add_argument('-b', '--baseline', type=str, default=None,
+        help='Results file of a previous run to compare with, exits with 1 on regressions')
+    parser.add_argument('--model_path', default='', type=str,
+        help='Prediction model for the cases with predict: True; random keypoints if empty')
+    parser.add_argument('--cases', default='', type=str,
+        help='Run only the cases whose name contains this string, e.g. 2cam_')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger("logger")
+
+    with open(args.config) as f:
+        options = benchmark_options(yaml.load(f, Loader=yaml.SafeLoader) or {})
+    with open(options['base_config']) as f:
+        base_config = yaml.load(f, Loader=yaml.SafeLoader)
+
+    cases = [case for case in benchmark_cases(options['matrix']) if args.cases in case_name(case)]
+    results = {'machine': machine_info(), 'date': datetime.now().isoformat(timespec='seconds'),
+               'config': args.config, 'cases': []}
+    output = args.output or os.path.join(options['savedir'], f"benchmark_{results['machine']['hostname']}_{datetime.now().strftime('%Y%m%d_%H_%M_%S')}.json")
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+
+    for i, case in enumerate(cases):
+        if case['preview'] and not os.environ.get('DISPLAY'):
+            logger.info(f'Benchmark {i + 1}/{len(cases)}: skipping {case_name(case)}, previews need a display')
+            continue
+        logger.info(f'Benchmark {i + 1}/{len(cases)}: {case_name(case)}')
+        result = run_case(case, base_config, logger, camera=options['camera'], duration=options['duration'],
+                          savedir=options['savedir'], keep_data=options['keep_data'], model_path=args.model_path)
+        metrics = result['metrics']
+        logger.info(f"Benchmark {result['name']} | fps: {metrics['fps']:.2f} (target {case['fps']}), drop rate: {metrics['drop_rate']:.4f}, "
+                    f"cpu: {metrics['cpu_percent']:.0f}%, rss: {metrics['rss_mb']:.0f} MB, writer max depth: {metrics['writer_max_depth']}, "
+                    f"processing p99: {metrics['processing_p99_ms']:.2f} ms")
+        results['cases'].append(result)
+        # written after every case, so that an interrupted run keeps its results
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=1)
+    logger.info(f'Benchmark results: {output}')
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions, new_cases = compare(results, baseline, options['thresholds'])
+        logger.info(f"Baseline: {args.baseline} ({baseline['machine']['hostname']}, {baseline['date']})")
+        for name in new_cases:
+            logger.info(f'No baseline for {name}')
+        for name, metric, reference, value, threshold in regressions:
+            logger.info(f'REGRESSION {name}: {metric} {value:.4g} (baseline {reference:.4g}, threshold {threshold:g})')
+        logger.info(f'{len(regressions)} regression(s) in {len(results["cases"])} cases')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -30,11 +30,8 @@ for i in range(100):
     vid_show.update(frame)
     vid_show2.update(frame2)
 
-    predictor.frame = frame
-    predictor.n_frame = i
-    predictor.get_random_prediction()
+    predictor.update(frame, i)
     vid_show.pred_result = predictor.pred_result
-    predictor.get_random_prediction()
     vid_show2.pred_result = predictor.pred_result
 
     # if not display_manager.displays[name]['queue'].full():
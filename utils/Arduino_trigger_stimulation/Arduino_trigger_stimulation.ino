@@ -33,6 +33,7 @@ void setup(void)
   digitalWrite(LedPin, LOW);
   digitalWrite(stimulationPin, LOW);
   pinMode(LED_BUILTIN, OUTPUT);
+  Serial.println("READY");  // the host waits for this after opening the port (the board resets)
 }
 
 void loop(void)
@@ -40,9 +41,10 @@ void loop(void)
   if (Serial.available() > 0)
   {
     input = Serial.read();
+    bool known = true;
     if (input == 'P') // Poll the arduino, expect answer bit '1'
     {
-      Serial.print(1);
+      Serial.println(1);
     }
 
     if (input == 'Q')
@@ -88,7 +90,17 @@ void loop(void)
       String text = Serial.readString();
       mySerial.print(text); //Write the text from Serial port
     }
-    delay(100);
+    else if (input != 'P' && input != 'Q' && input != 'R' && input != 'V' && input != 'S')
+    {
+      known = false;  // line endings and arguments of the previous command
+    }
+    if (known)
+    {
+      // the host matches "ACK <letter>" to its pending command
+      Serial.print("ACK ");
+      Serial.println((char)input);
+    }
+    // no delay here: it postponed the next command (e.g., a closed-loop stimulation) by up to 100 ms
   }
 }
 
@@ -129,7 +141,7 @@ void start_stimulation(void)
     stringComplete = false;
 
     Timer1.initialize(pulse_interval * 1000); // microsec
-    Timer1.pwm(stimulationPin, (pulse_dutyCycle / 100) * 1023);
+    Timer1.pwm(stimulationPin, (pulse_dutyCycle * 1023L) / 100);  // integer division made any duty cycle < 100 zero
     stimulation_status = true;
     Serial.println("Stimulation started.");
     // digitalWrite(LED_BUILTIN, HIGH);  // turn the LED on (HIGH is the voltage level)
@@ -1,48 +1,220 @@
-import sys
 import time
+import queue
+import struct
+import threading
 import serial
-from concurrent.futures import ThreadPoolExecutor
+from collections import deque, namedtuple
 
+# a line received from the Arduino: kind is 'ready' (sketch started), 'ack' / 'error' (reply to the command
+# `command`, the first letter of the command line) or 'log'; host_time is time.perf_counter() when it was read
+ArduinoMessage = namedtuple('ArduinoMessage', ['kind', 'command', 'text', 'host_time'])
 
-tp = ThreadPoolExecutor(10)  # max 10 threads
+# binary event records streamed by the sketch after 'E,1', between text lines:
+# marker, kind, index (uint32), Arduino micros() (uint32), xor of the kind, index and micros bytes
+EVENT_MARKER = 0xA5
+EVENT_RECORD = struct.Struct('<BBIIB')
+EVENT_KINDS = {1: 'pulse', 2: 'stim_on', 3: 'stim_off'}  # pulse: frame trigger pulse, index counts from 1
+ArduinoEvent = namedtuple('ArduinoEvent', ['kind', 'index', 'micros', 'host_time'])
 
-def threaded(fn):
-    def wrapper(*args, **kwargs):
-        return tp.submit(fn, *args, **kwargs)  # returns Future object
-    return wrapper
+
+def checksum(data):
+    value = 0
+    for byte in data:
+        value ^= byte
+    return value
+
+
+def parse_message(line, host_time):
+    """ Parses a line sent by the sketch: 'READY', 'ACK <command> [text]', 'ERR <command> [text]' or anything else (log). """
+    kind, _, rest = line.partition(' ')
+    if kind == 'READY':
+        return ArduinoMessage('ready', None, rest, host_time)
+    if kind in ['ACK', 'ERR'] and rest:
+        command, _, text = rest.partition(' ')
+        return ArduinoMessage('ack' if kind == 'ACK' else 'error', command, text, host_time)
+    return ArduinoMessage('log', None, line, host_time)
+
+
+class ArduinoRequest():
+    """ A command in the write queue. `written` is set once it was written (at `write_time`), `done` once it
+    was acknowledged, or right after the write if no acknowledgement is expected.
+    """
+
+    def __init__(self, cmd, ack, payload=b'') -> None:
+        self.cmd = cmd
+        self.payload = payload  # raw bytes written right after the command line
+        self.command = cmd[:1]
+        self.ack = ack
+        self.written = threading.Event()
+        self.done = threading.Event()
+        self.write_time = None
+        self.reply = None  # ArduinoMessage acknowledging the command
+
+    def wait(self, timeout=None):
+        """ Waits for the acknowledgement and returns it; raises TimeoutError or RuntimeError (ERR reply). """
+        if not self.done.wait(timeout):
+            raise TimeoutError(f'No reply from the Arduino to {self.cmd.strip()!r} within {timeout} sec')
+        if self.reply is not None and self.reply.kind == 'error':
+            raise RuntimeError(f'Arduino rejected {self.cmd.strip()!r}: {self.reply.text}')
+        return self.reply
 
 
 class Arduino():
-    def __init__(self, logger, port='/dev/ttyACM0', baudrate=115200, timeout=5) -> None:
+    """ Serial connection to the Arduino sketch with a reader and a writer thread.
+
+    Commands are queued with send() and written in order by the writer thread; request() also waits
+    for the sketch's 'ACK <command>' reply. The reader thread parses every line into an ArduinoMessage,
+    completes the oldest pending request of the acknowledged command, logs the message and passes it to
+    the `on_message` callbacks. Binary event records (see EVENT_RECORD) are passed to the `on_event`
+    callbacks as ArduinoEvents. Sketches that don't send READY at startup are assumed not to acknowledge.
+    """
+
+    def __init__(self, logger, port='/dev/ttyACM0', baudrate=115200, timeout=5, ack_timeout=2.0) -> None:
         self.port = port
         self.baudrate = baudrate
-        self.timeout = timeout
-        self.continuous_listen = False
+        self.timeout = timeout  # sec to wait for READY after opening the port (the board resets)
+        self.ack_timeout = ack_timeout
         self.logger = logger
-        
-    def initialize(self):
+        self.acks = False
+        self.on_message = []
+        self.on_event = []
+        self.buffer = bytearray()  # received bytes not parsed yet
+        self.n_corrupt = 0  # event records with a wrong checksum
+        self.write_queue = queue.Queue()
+        self.pending = deque()  # written requests waiting for their ACK
+        self.pending_lock = threading.Lock()
+        self.ready = threading.Event()
+        self.stopped = threading.Event()
+        self.reader = None
+        self.writer = None
 
-        self.arduino = serial.Serial(self.port, self.baudrate, timeout=self.timeout)
-        time.sleep(1)
-        sys.stdout.flush()
-        self.logger.info(f"Arduino connected to the serial port: {self.port}")
+    def initialize(self):
+        # short read timeout, so that the reader notices close()
+        self.arduino = serial.Serial(self.port, self.baudrate, timeout=0.1)
+        self.reader = threading.Thread(target=self.read_loop, name='arduino_reader', daemon=True)
+        self.writer = threading.Thread(target=self.write_loop, name='arduino_writer', daemon=True)
+        self.reader.start()
+        self.writer.start()
+        self.acks = self.ready.wait(self.timeout)
+        if self.acks:
+            self.logger.info(f"Arduino connected to the serial port: {self.port}")
+        else:
+            self.logger.info(f"Arduino connected to the serial port: {self.port}, but the sketch did not send READY "
+                             f"within {self.timeout} sec; commands are not acknowledged (old sketch?)")
 
-    @threaded
     def listen(self):
-        while self.continuous_listen:
-            recv = self.arduino.readline().rstrip().decode('utf-8')
-            # if recv[-1] == '\n':
-            #     recv = recv[:-1]
-            #     if recv == '':
-            #         continue
-            # if recv[-1] == '\n':
-            #     recv = recv[:-1]
-            #     if recv == '':
-            #         continue
-                
-            self.logger.info("Arduino: {}".format(recv))
-        
+        """ Kept for older scripts: messages are read and logged by the reader thread started in initialize(). """
+        return self.reader
+
+    def send(self, cmd, ack=None, payload=b''):
+        """ Queues a command line (followed by raw `payload` bytes) and returns its ArduinoRequest;
+        `ack` defaults to whether the sketch acknowledges.
+        """
+        if not cmd.endswith('\n'):
+            cmd += '\n'
+        request = ArduinoRequest(cmd, self.acks if ack is None else ack, payload)
+        self.write_queue.put(request)
+        return request
+
+    def request(self, cmd, timeout=None, payload=b''):
+        """ Sends a command and waits for its acknowledgement (or only until it was written, see send()). """
+        request = self.send(cmd, payload=payload)
+        try:
+            return request.wait(self.ack_timeout if timeout is None else timeout)
+        except TimeoutError:
+            with self.pending_lock:
+                if request in self.pending:
+                    self.pending.remove(request)
+            raise
+
+    def write_loop(self):
+        while True:
+            request = self.write_queue.get()
+            if request is None:
+                break
+            if request.ack:
+                with self.pending_lock:
+                    self.pending.append(request)
+            try:
+                self.arduino.write(request.cmd.encode() + request.payload)
+                self.arduino.flush()
+            except serial.SerialException as e:
+                self.logger.info(f'Arduino: could not write {request.cmd.strip()!r}: {e}')
+                with self.pending_lock:
+                    if request in self.pending:
+                        self.pending.remove(request)
+                request.done.set()
+                continue
+            request.write_time = time.perf_counter()
+            request.written.set()
+            if not request.ack:
+                request.done.set()
+
+    def read_loop(self):
+        while not self.stopped.is_set():
+            try:
+                data = self.arduino.read(max(1, self.arduino.in_waiting))
+            except serial.SerialException as e:
+                if not self.stopped.is_set():
+                    self.logger.info(f'Arduino: serial read failed: {e}')
+                break
+            if data:
+                self.feed(data, time.perf_counter())
+
+    def feed(self, data, host_time):
+        """ Parses received bytes into text lines and event records; incomplete ones are kept for the next call. """
+        buffer = self.buffer
+        buffer += data
+        while buffer:
+            if buffer[0] == EVENT_MARKER:
+                if len(buffer) < EVENT_RECORD.size:
+                    break
+                _, kind, index, micros, check = EVENT_RECORD.unpack_from(buffer)
+                if check != checksum(buffer[1:EVENT_RECORD.size - 1]):
+                    # not a record, skip the marker and resynchronize
+                    self.n_corrupt += 1
+                    del buffer[0]
+                    continue
+                del buffer[:EVENT_RECORD.size]
+                event = ArduinoEvent(EVENT_KINDS.get(kind, str(kind)), index, micros, host_time)
+                for callback in self.on_event:
+                    callback(event)
+                continue
+            end = buffer.find(b'\n')
+            marker = buffer.find(EVENT_MARKER)
+            if marker != -1 and (end == -1 or marker < end):
+                end = marker - 1  # text interrupted by a record
+            elif end == -1:
+                break
+            line = bytes(buffer[:end + 1]).rstrip().decode('utf-8', errors='replace')
+            del buffer[:end + 1]
+            if line:
+                self.handle(parse_message(line, host_time))
+
+    def handle(self, message):
+        if message.kind == 'ready':
+            self.ready.set()
+        elif message.kind in ['ack', 'error']:
+            with self.pending_lock:
+                request = next((request for request in self.pending if request.command == message.command), None)
+                if request is not None:
+                    self.pending.remove(request)
+            if request is not None:
+                request.reply = message
+                request.done.set()
+        if message.kind == 'error':
+            self.logger.info(f"Arduino: ERR {message.command} {message.text}")
+        elif message.kind != 'ack':
+            self.logger.info(f"Arduino: {message.text or message.kind.upper()}")
+        for callback in self.on_message:
+            callback(message)
+
     def close(self):
-        self.continuous_listen = False
+        """ Writes the queued commands and closes the port. """
+        self.write_queue.put(None)
+        if self.writer is not None:
+            self.writer.join(timeout=self.ack_timeout)
+        self.stopped.set()
+        if self.reader is not None:
+            self.reader.join(timeout=1)
         self.arduino.close()
-    
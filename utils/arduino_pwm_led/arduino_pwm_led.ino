@@ -1,5 +1,6 @@
 #include <TimerOne.h>
 #include <SoftwareSerial.h>
+#include <util/crc16.h>
 
 const byte rxPin = 2;
 const byte txPin = 3;
@@ -18,26 +19,58 @@ char firstLetter;
 // stimulation params
 String inputString = ""; //main captured String
 char delimiter = ',';             // Delimiter to split the string
-char stimDelim = '-';             // Delimiter to split the string
 // int pulse_interval;
 // int pulse_dutyCycle;
 bool stimulation_status = false;
 const int stimulationPin = 10;  // has to be pin 9 or pin 10
-const int MAX_VALUES = 100;  // Maximum number of values to parse
-// String parsedValues[MAX_VALUES];  // Array to store parsed values
-String* stimulations;  // list of stimulation profiles
-// String stimParams[4];  // Array to store [turnOn_times (s), stimulation_durations (ms), pulse_intervals (ms), pulse_dutyCycles (percent)]
-int stimOnTime;  // sec
-int stimDuration;  // ms
 int stimPulseDur;  // ms
 int stimPulseDutyCycle;  // percent
-int stimProfileIndex;
-int numStimProfiles;
 bool stimTrigger = false;
 
+// stimulation schedule, uploaded with U/C/F (see compile_schedule in utils/stimulation.py): runs of `count`
+// epochs every `period` ms from `onset` ms after 'T', each stimulating for `duration` ms with pulses of
+// `interval` ms and `duty` percent; 15 bytes, little-endian
+struct StimRun {
+  unsigned long onset;
+  unsigned long period;
+  unsigned int count;
+  unsigned int duration;
+  unsigned int interval;
+  byte duty;
+};
+const byte MAX_RUNS = 40;
+const byte CHUNK_MAX_BYTES = 45;  // 3 runs per chunk, so a chunk fits in the 64 byte serial buffer
+StimRun runs[MAX_RUNS];
+byte numRuns = 0;
+byte uploadRuns = 0;  // runs announced by 'U'
+unsigned int uploadCrc = 0;  // CRC-16/XMODEM of the whole schedule, announced by 'U'
+unsigned int receivedCrc = 0;
+int nextChunk = 0;
+bool scheduleValid = false;
+byte runIndex;
+unsigned int repeatIndex;
+unsigned long epochOnset;  // ms after 'T'
+unsigned long epochDuration;  // ms
+
 unsigned long startTime;
 unsigned long endTime;
 
+// binary event records streamed to the host after "E,1" (see utils/arduino.py):
+// 0xA5, kind, index (uint32), micros() (uint32), xor of the 9 bytes after the marker
+const byte EVENT_MARKER = 0xA5;
+const byte EVENT_PULSE = 1;
+const byte EVENT_STIM_ON = 2;
+const byte EVENT_STIM_OFF = 3;
+const byte EVENT_BUFFER_SIZE = 32;  // events waiting to be sent, filled by the timer interrupt
+volatile byte eventKinds[EVENT_BUFFER_SIZE];
+volatile unsigned long eventIndices[EVENT_BUFFER_SIZE];
+volatile unsigned long eventMicros[EVENT_BUFFER_SIZE];
+volatile byte eventHead = 0;  // next slot to fill
+volatile byte eventTail = 0;  // next slot to send
+volatile unsigned long pulseIndex = 0;  // frame trigger pulses since 'S'
+unsigned long stimIndex = 0;
+volatile bool streamEvents = false;
+
 void setup() {
   Serial.begin(115200);
   digitalWrite(LedPin, LOW);
@@ -45,25 +78,30 @@ void setup() {
   pinMode(LED_BUILTIN, OUTPUT);
   pinMode(LedPin, OUTPUT);
   setupTimer2PWM();
-  
+  Serial.println("READY");  // the host waits for this after opening the port (the board resets)
 }
 
 void loop() {
+  send_events();
+
   if (Serial.available() > 0) {
     inputString = Serial.readStringUntil('\n');
     
+    inputString.trim();
     if (inputString.length() > 0) {
       firstLetter = inputString.charAt(0);
+      bool ok = true;
 
-      // Print the received string
-      Serial.print("You entered: ");
-      Serial.println(inputString);
-      Serial.print("The first letter: ");
-      Serial.println(firstLetter);
-
+      // every command is answered with "ACK <letter>" once handled, or "ERR <letter> <reason>"
       switch (firstLetter) {
-        case 'D':
-          decode_stimulation();
+        case 'U':
+          ok = begin_upload();
+          break;
+        case 'C':
+          ok = receive_chunk();
+          break;
+        case 'F':
+          ok = finish_upload();
           break;
         case 'V':
           stop_stimulation();
@@ -75,16 +113,28 @@ void loop() {
           stop_frame_trigger();
           break;
         case 'T':
-          trigger_stimulation();
+          ok = trigger_stimulation();
           break;          
+        case 'R':
+          start_closed_loop_stimulation();
+          break;
+        case 'P':  // poll
+          break;
+        case 'E':  // "E,1": stream event records, "E,0": stop
+          streamEvents = inputString.substring(2).toInt() != 0;
+          break;
         default:
-          Serial.print("Unrecognized first letter: ");
-          Serial.println(firstLetter);
+          reject("unrecognized command");
+          ok = false;
           break;
       }
+      if (ok) {
+        Serial.print("ACK ");
+        Serial.println(firstLetter);
+      }
 
     } else {
-      Serial.println("You entered an empty string.");
+      Serial.println("ERR - empty command");
     }
   }
 
@@ -94,16 +144,13 @@ void loop() {
     // Serial.print("Cur time: ");
     // Serial.println(endTime - startTime);
     if (!stimulation_status) {
-      if ((endTime - startTime) > stimOnTime * 1000) {
+      if ((endTime - startTime) >= epochOnset) {
         start_stimulation();
       }
     } else {
-      if ((endTime - startTime) > ((stimOnTime * 1000) + stimDuration)) {
+      if ((endTime - startTime) >= epochOnset + epochDuration) {
         stop_stimulation();
-        stimProfileIndex++;
-        if (stimProfileIndex <= numStimProfiles) {
-          update_stimParams();
-        } else {
+        if (!next_epoch()) {
           stimTrigger = false;
           Serial.println("Stimulations ended.");
         }
@@ -113,56 +160,134 @@ void loop() {
   // delay(100);
 }
 
-void decode_stimulation(void) {
-  stimulations = parseInputString(inputString, delimiter);
-  numStimProfiles = getValueCount(inputString, delimiter);  // Get the count of parsed values
-  numStimProfiles--;
-
-  Serial.print("Num. of stimulations: ");
-  Serial.println(numStimProfiles);
-  Serial.println("Stimulation profiles: [turnOn_times (s), stimulation_durations (ms), pulse_intervals (ms), pulse_dutyCycles (percent)]");
-  for (int i = 1; i <= numStimProfiles; i++) {
-    Serial.print(i);
-    Serial.print(". Stimulation: ");
-    Serial.println(stimulations[i]);
+void reject(const char* reason) {
+  Serial.print("ERR ");
+  Serial.print(firstLetter);
+  Serial.print(' ');
+  Serial.println(reason);
+}
+
+// "U,<runs>,<crc>": start a schedule upload
+bool begin_upload(void) {
+  int first = inputString.indexOf(',');
+  int second = inputString.indexOf(',', first + 1);
+  long n = inputString.substring(first + 1, second).toInt();
+  if (first < 0 || second < 0 || n < 1 || n > MAX_RUNS) {
+    reject("invalid number of runs");
+    return false;
   }
+  stimTrigger = false;
+  scheduleValid = false;
+  uploadRuns = n;
+  uploadCrc = (unsigned int)inputString.substring(second + 1).toInt();
+  receivedCrc = 0;
+  numRuns = 0;
+  nextChunk = 0;
+  return true;
 }
 
-void update_stimParams(void) {
-  String* cur_stimParams = parseInputString(stimulations[stimProfileIndex], stimDelim);
-  // int valueCount = getValueCount(stimulations[stimProfileIndex], stimDelim);  // Get the count of parsed values
-  
-  stimOnTime = cur_stimParams[0].toInt();
-  stimDuration = cur_stimParams[1].toInt();
-  stimPulseDur = cur_stimParams[2].toInt();
-  stimPulseDutyCycle = cur_stimParams[3].toInt();
-
-  Serial.println("\nUpdated stimParams:");
-  Serial.print("stimOnTime: ");
-  Serial.println(stimOnTime);
-  Serial.print("stimDuration: ");
-  Serial.println(stimDuration);
-  Serial.print("stimPulseDur: ");
-  Serial.println(stimPulseDur);
-  Serial.print("stimPulseDutyCycle: ");
-  Serial.println(stimPulseDutyCycle);
+// "C,<seq>,<bytes>" followed by <bytes> bytes of runs and their CRC-16/XMODEM (2 bytes, little-endian)
+bool receive_chunk(void) {
+  int first = inputString.indexOf(',');
+  int second = inputString.indexOf(',', first + 1);
+  int seq = inputString.substring(first + 1, second).toInt();
+  int n = inputString.substring(second + 1).toInt();
+  byte chunk[CHUNK_MAX_BYTES + 2];
+  if (first < 0 || second < 0 || n <= 0 || n > CHUNK_MAX_BYTES || n % sizeof(StimRun) != 0) {
+    reject("invalid chunk size");
+    return false;
+  }
+  if (Serial.readBytes(chunk, n + 2) != (size_t)(n + 2)) {
+    reject("chunk timeout");
+    return false;
+  }
+  unsigned int crc = 0;
+  for (int i = 0; i < n; i++) {
+    crc = _crc_xmodem_update(crc, chunk[i]);
+  }
+  if (crc != (chunk[n] | ((unsigned int)chunk[n + 1] << 8))) {
+    reject("crc mismatch");
+    return false;
+  }
+  if (seq == nextChunk - 1) {
+    return true;  // retransmission after a lost ACK, already stored
+  }
+  if (seq != nextChunk || numRuns + n / sizeof(StimRun) > uploadRuns) {
+    reject("unexpected chunk");
+    return false;
+  }
+  memcpy(&runs[numRuns], chunk, n);
+  numRuns += n / sizeof(StimRun);
+  for (int i = 0; i < n; i++) {
+    receivedCrc = _crc_xmodem_update(receivedCrc, chunk[i]);
+  }
+  nextChunk++;
+  return true;
+}
+
+// "F": check that the whole schedule arrived
+bool finish_upload(void) {
+  if (numRuns != uploadRuns || receivedCrc != uploadCrc) {
+    reject("incomplete schedule");
+    return false;
+  }
+  scheduleValid = true;
+  Serial.print("Stimulation schedule: ");
+  Serial.print(numRuns);
+  Serial.println(" runs");
+  return true;
+}
+
+// loads the next epoch of the schedule, false after the last one
+bool next_epoch(void) {
+  while (runIndex < numRuns && repeatIndex >= runs[runIndex].count) {
+    runIndex++;
+    repeatIndex = 0;
+  }
+  if (runIndex >= numRuns) {
+    return false;
+  }
+  epochOnset = runs[runIndex].onset + (unsigned long)repeatIndex * runs[runIndex].period;
+  epochDuration = runs[runIndex].duration;
+  stimPulseDur = runs[runIndex].interval;
+  stimPulseDutyCycle = runs[runIndex].duty;
+  repeatIndex++;
+  return true;
 }
 
 void Timer1_ISR(void) {
   digitalWrite(stimulationPin, !digitalRead(stimulationPin));
 }
 
-void trigger_stimulation(void) {
-  stimProfileIndex = 1;
-  update_stimParams();
-  stimTrigger = true;
+bool trigger_stimulation(void) {
+  if (!scheduleValid) {
+    reject("no stimulation schedule");
+    return false;
+  }
+  runIndex = 0;
+  repeatIndex = 0;
+  stimTrigger = next_epoch();
   startTime = millis();
   Serial.println("Stimulation trigger received.");
+  return true;
+}
+
+// "Re,<pulse interval ms>,<duty cycle %>": start stimulating now, until 'V'
+void start_closed_loop_stimulation(void) {
+  String* parsedValues = parseInputString(inputString, delimiter);
+  stimPulseDur = parsedValues[1].toInt();
+  stimPulseDutyCycle = parsedValues[2].toInt();
+  delete[] parsedValues;
+  start_stimulation();
 }
 
 void start_stimulation(void) {
   Timer1.initialize(1000 * float(stimPulseDur)); // microsec
   Timer1.pwm(stimulationPin, (float(stimPulseDutyCycle) / 100) * 1023);
+  stimIndex++;
+  noInterrupts();
+  push_event(EVENT_STIM_ON, stimIndex, micros());
+  interrupts();
   // Timer1.setPwmDuty(stimulationPin, (stimPulseDutyCycle / 100) * 1023);
   // Timer1.attachInterrupt(Timer1_ISR, stimPulseDur * 10);
   // Timer1.start();
@@ -178,6 +303,9 @@ void stop_stimulation(void) {
   Timer1.detachInterrupt();
   digitalWrite(stimulationPin, 0);
   Timer1.stop();
+  noInterrupts();
+  push_event(EVENT_STIM_OFF, stimIndex, micros());
+  interrupts();
   stimulation_status = false;
   // digitalWrite(stimulationPin, LOW);
   Serial.println("Stimulation stopped.");
@@ -215,6 +343,10 @@ void start_frame_trigger(void) {
   // setupBlink_Timer2(2, 50);
   // setupPWM_Timer2(int(fps));
 
+  // Timer2 overflows at the start of every PWM period, i.e. at every trigger pulse
+  pulseIndex = 0;
+  TIMSK2 |= _BV(TOIE2);
+
   pinStatus = 1;
   Serial.println("Frame trigger started.");
   // }
@@ -292,6 +424,48 @@ void setupBlink_Timer2(int FPS, float dutyCycle) {
   TIMSK2 = (1 << OCIE2A);
 }
 
+ISR(TIMER2_OVF_vect) {
+  pulseIndex++;
+  push_event(EVENT_PULSE, pulseIndex, micros());
+}
+
+// call with interrupts disabled; events are dropped while the buffer is full (the host sees the index gap)
+void push_event(byte kind, unsigned long index, unsigned long time) {
+  if (!streamEvents) {
+    return;
+  }
+  byte next = (eventHead + 1) % EVENT_BUFFER_SIZE;
+  if (next == eventTail) {
+    return;
+  }
+  eventKinds[eventHead] = kind;
+  eventIndices[eventHead] = index;
+  eventMicros[eventHead] = time;
+  eventHead = next;
+}
+
+// writes the buffered events between text lines
+void send_events(void) {
+  byte record[11];
+  while (eventTail != eventHead) {
+    noInterrupts();
+    byte kind = eventKinds[eventTail];
+    unsigned long index = eventIndices[eventTail];
+    unsigned long time = eventMicros[eventTail];
+    interrupts();
+    record[0] = EVENT_MARKER;
+    record[1] = kind;
+    memcpy(record + 2, &index, 4);  // little-endian
+    memcpy(record + 6, &time, 4);
+    record[10] = 0;
+    for (byte i = 1; i < 10; i++) {
+      record[10] ^= record[i];
+    }
+    Serial.write(record, 11);
+    eventTail = (eventTail + 1) % EVENT_BUFFER_SIZE;
+  }
+}
+
 ISR(TIMER2_COMPA_vect) {
   counter++;
 
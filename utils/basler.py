@@ -3,17 +3,19 @@ import cv2
 import time
 import json
 import pickle
+import shutil
 import traceback
 import numpy as np
 # import matplotlib.pyplot as plt
-from datetime import datetime
 import pypylon
 from pypylon import pylon
-from queue import Queue
 from concurrent.futures import ThreadPoolExecutor
 from utils.helpers import str_to_bool
-from utils.preview import VideoShow, VideoShow2
-from utils.prediction import Predictor
+from utils.devices import DeviceDiscovery
+from utils.camera_config import ConfigCache, apply_settings, camera_config_options, settings_hash
+from utils.latency import LatencyMonitor
+from utils.grab_loop import GrabLoop, GrabbedFrame
+from utils.frame_pool import pool_pixel_format
 
 tp = ThreadPoolExecutor(100)  # max 10 threads
 
@@ -22,10 +24,12 @@ def threaded(fn):
         return tp.submit(fn, *args, **kwargs)  # returns Future object
     return wrapper
 
-class Basler():
+class Basler(GrabLoop):
 
-    def __init__(self, args, cam, camname, experiment, config, start_t, logger, cam_id=0,
-                 max_cams=2, connect_retries=20, display_lock=None, display_manager=None) -> None:
+    def __init__(self, args, cam, camname, experiment, config, start_t, logger, cam_id=0, device=None,
+                 connect_retries=20, display_lock=None, display_manager=None,
+                 frame_pool=None, frame_writer=None, stop_event=None, synchronizer=None,
+                 inference_engine=None, closed_loop=None) -> None:
 
         self.start_t = start_t
         self.args = args
@@ -37,49 +41,52 @@ class Basler():
         self.frame_timer = None
         self.display_lock = display_lock
         self.display_manager = display_manager
+        # frame pool and writer are created here unless given (e.g., shared memory pool and writer process)
+        self.frame_pool = frame_pool
+        self.frame_writer = frame_writer
+        # set to stop acquisition before n_frames (or in continuous mode)
+        self.stop_event = stop_event
+        # FrameSynchronizer (or SyncQueue in process mode) matching frames across cameras
+        self.synchronizer = synchronizer
+        # InferenceEngine shared across cameras for micro-batching, otherwise the predictor runs its own
+        self.inference_engine = inference_engine
+        # ClosedLoopStimulator fed with this camera's predictions
+        self.closed_loop = closed_loop
+        self.latency = LatencyMonitor(camname, enabled=str_to_bool(args.latency_stats))
+        self.writer_obj = None
         # self.preview = str_to_bool(self.args.preview)
         self.preview = cam['preview']
         self.save = str_to_bool(self.args.save)
         self.predict = cam['predict']
         self.preview_predict = cam['preview_predict']
         self.logger = logger
-        cameras = None
-        # get transport layer factory
-        self.tlFactory = pylon.TlFactory.GetInstance()
-        # get the camera list 
-        self.logger.info(f'{self.camname}: Searching for camera...')
-        self.devices = self.tlFactory.EnumerateDevices()
-        self.vid_cod = cv2.VideoWriter_fourcc('m', 'p', '4', 'v')
         self.nframes = 0
-        self.logger.info(f'{self.camname}: Connecting to the Basler camera...')
-        # print('Connecting to the camera...')
+        # pylon DeviceInfo of the camera with the `serial` of the config, see DeviceDiscovery
+        self.device = device if device is not None else DeviceDiscovery(logger).find(cam, camname)[1]
+        self.serial = str(self.device.GetSerialNumber())
+        self.logger.info(f'{self.camname}: Connecting to the Basler camera {self.serial}...')
 
-        n = 0
-        while cameras is None and n < connect_retries:
+        for n in range(1, connect_retries + 1):
             try:
-                cameras = pylon.InstantCameraArray(min(len(self.devices), max_cams))
-                self.camera = cameras[cam_id]
-                self.camera = pylon.InstantCamera(self.tlFactory.CreateDevice(self.devices[self.cam_id]))
-                # self.camera = pylon.InstantCamera(pylon.TlFactory.GetInstance().CreateFirstDevice())
-                # print(dir(self.camera))
-                # self.camera.MaxNumBuffer.Value = 20
-                self.logger.info(f"{self.camname}: Num. of cameras detected: {cameras.GetSize()}, selected cam_ID: {cam_id}")
-                # print(f"Num. of cameras detected: {cameras.GetSize()}, selected cam_ID: {cam_id}")
-                self.init_camera()
-
+                self.open_device()
+                break
             except Exception as e:
-                # self.logger.info(f'Trying to detect camera, trial {n}/{connect_retries}...')
-                self.logger.info(f'{self.camname}: Trying to detect camera, trial {n}/{connect_retries}...')
+                if n == connect_retries:
+                    raise
+                self.logger.info(f'{self.camname}: Could not open the camera ({e}), trial {n}/{connect_retries}...')
                 time.sleep(0.1)
-                cameras = None
-                n += 1
+        self.init_camera()
+
+    def open_device(self):
+        self.camera = pylon.InstantCamera(pylon.TlFactory.GetInstance().CreateDevice(self.device))
+        self.camera.Open()
 
     def init_camera(self):
         
         # self.camera.Attach(self.tlFactory.CreateDevice(self.devices[self.cam_id]))
         
         self.camera.Open()
-        self.compute_timestamp_offset()
+        self.start_clock_sync()
         # new_width = self.camera.Width.Value - self.camera.Width.Inc
         # if new_width >= self.camera.Width.Min:
         #     self.camera.Width.Value = new_width
@@ -92,73 +99,131 @@ class Basler():
         # print(f"Camera {self.cam_id} [{self.name}] successfully initialized!")
         self.nodemap = self.camera.GetNodeMap()
         self.strobe = self.cam['strobe']
-        if self.save:
-            pylon.FeaturePersistence.Save(os.path.join(self.config['savedir'], self.experiment, f"{self.camname}_nodemap.txt"), self.nodemap)
         self.update_settings()
         # pylon.FeaturePersistence.Load("config/acA2040-120um_24516213.pfs", self.nodemap, True)
         
-        self.converter = pylon.ImageFormatConverter()
-        self.converter.OutputPixelFormat = pylon.PixelType_BGR8packed # converting to opencv bgr format
-        self.converter.OutputBitAlignment = pylon.OutputBitAlignment_MsbAligned
-        
-        if self.predict:
-            self.predictor = Predictor(self.logger, self.args.model_path)
-            # self.predictor.start()
-
-        if self.preview:
-            # self.vid_show = VideoShow(self.name, self.preview_predict, pred_preview_button=self.cam['pred_preview_toggle_button'],
-            #                           display_lock=self.display_lock)
-            # self.vid_show.frame = np.zeros((self.cam['options']['Height'], self.cam['options']['Width']), dtype=np.uint8)
-            self.vid_show = VideoShow2(self.camname, self.preview_predict, pred_preview_button=self.cam['pred_preview_toggle_button'],
-                                      display_manager=self.display_manager)
-            # self.display_manager.add_display(self.camname)
-            if self.vid_show.show_pred:
-                self.vid_show.pred_result = self.predictor.pred_result
-            # self.vid_show.start()
-
-        if self.save:
-            self.init_video_writer()
+        # Mono8 and Bayer frames are kept as the native buffer, color conversion is done
+        # lazily by the consumers that need it (see FramePool.bgr)
+        self.pixel_format = self.cam['options'].get('PixelFormat', 'Mono8')
+        self.pool_pixel_format = pool_pixel_format(self.cam)
+        self.converter = None
+        if self.pool_pixel_format != self.pixel_format:
+            self.converter = pylon.ImageFormatConverter()
+            self.converter.OutputPixelFormat = pylon.PixelType_BGR8packed # converting to opencv bgr format
+            self.converter.OutputBitAlignment = pylon.OutputBitAlignment_MsbAligned
+        self.record_color = not self.pool_pixel_format.startswith('Mono')
+
+        self.init_consumers()
 
     def close(self):
+        self.clock.close()
         self.camera.Close()
 
-    def init_video_writer(self):
-        self.writer_obj = cv2.VideoWriter(os.path.join(self.config['savedir'], self.experiment, f"video_{self.camname}.mp4"), self.vid_cod, self.args.videowrite_fps,
-                                    (self.cam['options']['Width'], self.cam['options']['Height']))
-        self.write_frames = True
-        self.frame_write_queue = Queue()
-        self.fram_writer_future = self.frame_writer()
-    
     def convert_image(self, grabResult):
         return self.converter.Convert(grabResult).GetArray()
+
+    def put_frame(self, grabResult):
+        """ Copies the grab result into a frame pool slot, converting it only if the pixel format is not native. """
+        if self.converter is not None:
+            return self.frame_pool.put(self.convert_image(grabResult), self.n_consumers, timeout=self.pool_timeout)
+        with grabResult.GetArrayZeroCopy() as frame:
+            return self.frame_pool.put(frame, self.n_consumers, timeout=self.pool_timeout)
     
+    def desired_settings(self):
+        """ Returns the (node, value) settings of the camera in the order they have to be written:
+        the options of the config, then the trigger and strobe nodes if triggering with the arduino.
+        """
+        trigger = str_to_bool(self.args.trigger_with_arduino)
+        settings = []
+        for key, value in self.cam['options'].items():
+            if key == 'AcquisitionFrameRateEnable':
+                value = False if trigger else True
+            settings.append((key, value))
+        # changing strobe involves multiple variables in the correct order, so I've bundled
+        # them into this function
+        if trigger:
+            settings += self.strobe_settings(self.strobe['line'],
+                                             trigger_selector=self.strobe['trigger_selector'],
+                                             line_output=self.strobe['line_output'],
+                                             line_source=self.strobe['line_source'])
+        return settings
+
     def update_settings(self):
         """ Updates Basler camera settings.
         Attributes, types, and range of possible values for each attribute are available
         in the camera documentation. 
         These are extraordinarily tricky! Order matters! For exampple, ExposureAuto must be set
         to Off before ExposureTime can be set. 
+        The nodes are always read back and only those whose current value differs are written, so that a setting
+        changed by another program since is corrected. ConfigCache tells whether the camera was reset since it got the
+        same settings: if not, its user set is not loaded again and, if no node had to be written, the saved nodemap
+        is copied from the cache.
         """
         self.logger.info("-updating settings-")
         # print("-updating settings-")
-
-        if self.args.nodemap_path is not None:
-            self.logger.info("Loading saved configs to camera")
-            pylon.FeaturePersistence.Load(self.args.nodemap_path, self.nodemap, True)
+        t0 = time.perf_counter()
+        options = camera_config_options(self.config, self.cam)
+        feature_file = self.args.nodemap_path
+        settings = [] if feature_file is not None else self.desired_settings()
+        self.config_hash = settings_hash(settings, feature_file)
+        serial = self.camera.DeviceInfo.GetSerialNumber()
+        cache = ConfigCache(options['cache_dir'], options['session_tolerance']) if options['cache'] else None
+        entry = cache.get(serial) if cache is not None else None
+        current = cache is not None and cache.is_current(entry, self.config_hash, self.latch_timestamp())
+
+        user_set = options['user_set']
+        loaded = False
+        if (user_set and not current and entry is not None and entry.get('hash') == self.config_hash
+                and entry.get('user_set') == user_set):
+            # the camera was reset since, the settings are restored from the user set they were saved to
+            self.set_value(self.nodemap, 'UserSetSelector', user_set)
+            self.camera.UserSetLoad.Execute()
+            loaded = True
+        n_written = None
+        if feature_file is not None:
+            if not loaded:
+                self.logger.info("Loading saved configs to camera")
+                pylon.FeaturePersistence.Load(feature_file, self.nodemap, True)
+            written = f'loaded from {feature_file}'
         else:
-            for key, value in self.cam['options'].items():
-                #print(key, value)
-                if key == 'AcquisitionFrameRateEnable':
-                    value = False if str_to_bool(self.args.trigger_with_arduino) else True
-                
-                self.set_value(self.nodemap, key, value)
-            # changing strobe involves multiple variables in the correct order, so I've bundled
-            # them into this function
-            if str_to_bool(self.args.trigger_with_arduino):
-                self.turn_strobe_on(self.nodemap, self.strobe['line'], 
-                                trigger_selector=self.strobe['trigger_selector'], 
-                                line_output=self.strobe['line_output'], 
-                                line_source=self.strobe['line_source']) 
+            n_written = apply_settings(settings, lambda node: self.get_value(self.nodemap, node),
+                                       lambda node, value: self.set_value(self.nodemap, node, value), self.logger, self.camname)
+            written = f'{n_written}/{len(settings)} nodes written'
+            if current and n_written:
+                self.logger.info(f'{self.camname}: {n_written} node(s) were changed since the settings were applied')
+
+        if user_set and not loaded and not (current and n_written == 0):
+            self.set_value(self.nodemap, 'UserSetSelector', user_set)
+            self.camera.UserSetSave.Execute()
+        if cache is not None:
+            cache.put(serial, self.config_hash, self.latch_timestamp(), user_set=user_set)
+        self.logger.info(f"{self.camname}: settings {self.config_hash} applied{' from ' + user_set if loaded else ''}, "
+                         f"{written} in {(time.perf_counter() - t0) * 1000:.1f} ms")
+        # after a camera reset with the same settings, the cached nodemap still applies
+        changed = entry is None or entry.get('hash') != self.config_hash or bool(n_written and current)
+        self.save_nodemap(cache, serial, changed=changed)
+
+    def save_nodemap(self, cache, serial, changed=False):
+        """ Saves all the camera features next to the recording. This reads every node and takes seconds, so the file is
+        kept in the config cache once per camera and settings, and only copied if the settings did not change.
+        """
+        if not self.save:
+            return
+        path = os.path.join(self.config['savedir'], self.experiment, f"{self.camname}_nodemap.txt")
+        if cache is None:
+            pylon.FeaturePersistence.Save(path, self.nodemap)
+            return
+        cached_path = cache.nodemap_path(serial, self.config_hash)
+        if changed or not os.path.isfile(cached_path):
+            pylon.FeaturePersistence.Save(cached_path, self.nodemap)
+        shutil.copyfile(cached_path, path)
+
+    def get_value(self, nodemap, nodename):
+        """ Current value of a node, the symbolic name of the entry for enumerations. """
+        node = nodemap.GetNode(nodename)
+        if type(node) == pypylon.genicam.IEnumeration:
+            return node.GetCurrentEntry().GetSymbolic()
+        return node.GetValue()
 
     def set_value(self, nodemap, nodename, value):
         try:
@@ -203,13 +268,15 @@ class Basler():
                     raise ValueError('Node not writable or available: %s' %nodename)
 
         except Exception as e:# PySpin.SpinnakerException as e:
-            self.logger.info("ERROR setting:", nodename, value)
+            self.logger.info(f"{self.camname}: ERROR setting: {nodename} {value}")
             # print("ERROR setting:", nodename, value)
             traceback.print_exc()
             raise ValueError('Error: %s' %e)
     
-    def turn_strobe_on(self, nodemap, line, trigger_selector='FrameStart', line_output=None, line_source='ExposureActive'): # strobe_duration=0.0):
+    def strobe_settings(self, line, trigger_selector='FrameStart', line_output=None, line_source='ExposureActive'): # strobe_duration=0.0):
         '''
+        Returns the (node, value) settings that turn the external trigger and the strobe output on, in order.
+
         # is using external hardware trigger, select line_output to record actual on times (LineSource = 'ExposureActive')
         # check camera model for which lines can be out/in
 
@@ -232,178 +299,92 @@ class Basler():
         assert(type(line)==int)
         #assert(type(strobe_duration)==float)
         
-        self.set_value(nodemap, 'TriggerSelector', trigger_selector)
-        self.set_value(nodemap, 'TriggerMode', 'On')
-        self.set_value(nodemap, 'TriggerSource', 'Line3')
-
-        self.set_value(nodemap, 'TriggerDelay', 0)
-        self.set_value(nodemap, 'TriggerActivation', 'RisingEdge')
-        #set_value(nodemap, 'AcquisitionMode', 'Continuous') # must be continuous for external frame trigger
-        self.set_value(nodemap, 'AcquisitionStatusSelector', 'FrameTriggerWait')
-        self.set_value(nodemap, 'AcquisitionBurstFrameCount', 1)
+        settings = [('TriggerSelector', trigger_selector),
+                    ('TriggerMode', 'On'),
+                    ('TriggerSource', 'Line3'),
+                    ('TriggerDelay', 0),
+                    ('TriggerActivation', 'RisingEdge'),
+                    #('AcquisitionMode', 'Continuous'), # must be continuous for external frame trigger
+                    ('AcquisitionStatusSelector', 'FrameTriggerWait'),
+                    ('AcquisitionBurstFrameCount', 1)]
 
         # Set trigger source 
         linestr = 'Line%d'%line
         # set the line selector to this line so that we change the following
         # values for Line2, for example, not Line0
-        self.set_value(nodemap, 'LineSelector', linestr)
+        settings.append(('LineSelector', linestr))
         # one of input, trigger, strobe, output
-        self.set_value(nodemap, 'LineMode', 'Input') #'strobe')
+        settings.append(('LineMode', 'Input')) #'strobe')
 
         # set output
         if line_output is not None:
             linestr_out = 'Line%d' % line_output
-            self.set_value(nodemap, 'LineSelector', linestr_out)
-            self.set_value(nodemap, 'LineMode', 'Output')
-            self.set_value(nodemap, 'LineSource', line_source)
-            self.set_value(nodemap, 'LineInverter', True)
+            settings += [('LineSelector', linestr_out),
+                         ('LineMode', 'Output'),
+                         ('LineSource', line_source),
+                         ('LineInverter', True)]
+        return settings
  
-    def compute_timestamp_offset(self):
+    def latch_timestamp(self):
         self.camera.TimestampLatch.Execute()
-        self.timestamp_offset = time.perf_counter() - self.camera.TimestampLatchValue.GetValue()*1e-9 - self.start_t
+        return self.camera.TimestampLatchValue.GetValue()
 
-    # @threaded
-    def get_n_frames(self, n_frames, timeout_time=2000, report_period=10):
-        if str_to_bool(self.args.trigger_with_arduino):
+    def start_acquisition(self, n_frames=None):
+        if str_to_bool(self.args.trigger_with_arduino) or n_frames is None:
             self.camera.StartGrabbing(pylon.GrabStrategy_OneByOne)
         else:
             self.camera.StartGrabbingMax(n_frames)
 
-        # print(f"Started cam {self.name} acquisition")
-        self.logger.info(f"{self.camname}: Started acquisition")
-        self.start_timer = time.perf_counter()
+    def wait_for_frames(self):
+        if self.camera.GetGrabResultWaitObject().Wait(0):
+            # print("grab results waiting")
+            self.logger.info(f"{self.camname}: grab results waiting")
 
-        # self.logger.info("Looping - %s" % self.name)
-        # print("Looping - %s" % self.name)
-        
+        self.logger.info(f'{self.camname}: Checking for results')
+        # print('Checking for results')
+        last_report = 0
+
+        while not self.camera.GetGrabResultWaitObject().Wait(0) and not self.stop_requested():
+            elapsed_pre = time.perf_counter() - self.start_timer #exp_start_tim     
+            if round(elapsed_pre) % 5 == 0 and round(elapsed_pre) != last_report:
+                # print("...waiting grabbing", round(elapsed_pre))
+                self.logger.info(f"{self.camname}: ...waiting grabbing", round(elapsed_pre))
+                
+            last_report = round(elapsed_pre)
+
+    def is_grabbing(self, supervisor=None):
+        # a removed camera may stop grabbing, it is reopened if supervised
+        return self.camera.IsGrabbing() or (supervisor is not None and self.camera.IsCameraDeviceRemoved())
+
+    def is_removed(self):
+        return self.camera.IsCameraDeviceRemoved()
+
+    def retrieve(self, timeout_time):
+        image_result = self.camera.RetrieveResult(timeout_time, pylon.TimeoutHandling_Return) #, pylon.TimeoutHandling_ThrowException)
+        return image_result if image_result is not None and image_result.IsValid() else None
+
+    def read_frame(self, grabResult):
+        if not grabResult.GrabSucceeded():
+            return None
+        # BlockID is the camera's frame counter, ImageNumber and ID count the grabbed images
+        return GrabbedFrame(grabResult.ID, grabResult.ImageNumber, grabResult.TimeStamp, grabResult.BlockID,
+                            grabResult.GetNumberOfSkippedImages())
+
+    def release(self, grabResult):
+        grabResult.Release()
+
+    def reopen(self):
+        """ Opens the camera again by serial after it was lost and re-applies its settings (see update_settings). """
         try:
-            if self.camera.GetGrabResultWaitObject().Wait(0):
-                # print("grab results waiting")
-                self.logger.info(f"{self.camname}: grab results waiting")
-
-            self.logger.info(f'{self.camname}: Checking for results')
-            # print('Checking for results')
-            last_report = 0
-
-            while not self.camera.GetGrabResultWaitObject().Wait(0):
-                elapsed_pre = time.perf_counter() - self.start_timer #exp_start_tim     
-                if round(elapsed_pre) % 5 == 0 and round(elapsed_pre) != last_report:
-                    # print("...waiting grabbing", round(elapsed_pre))
-                    self.logger.info(f"{self.camname}: ...waiting grabbing", round(elapsed_pre))
-                    
-                last_report = round(elapsed_pre)
-
-            metadata = {}
-
-            while self.camera.IsGrabbing():
-
-                if self.nframes == 0:
-                    elapsed_time = 0
-                    self.frame_timer = time.perf_counter()
-
-                if self.nframes % round(report_period * self.cam['options']['AcquisitionFrameRate']) == 0:
-                    # print("[fps %.2f] grabbing (%ith frame) | elapsed %.2f" % (self.cam['options']['AcquisitionFrameRate'], self.nframes, elapsed_time))
-                    self.logger.info("%s: [fps %.2f] grabbing (%ith frame) | elapsed %.2f" % (self.camname, self.cam['options']['AcquisitionFrameRate'], self.nframes, elapsed_time))
-
-                image_result = self.camera.RetrieveResult(timeout_time, pylon.TimeoutHandling_Return) #, pylon.TimeoutHandling_ThrowException)
-                #if (image_result.GetNumberOfSkippedImages()):
-                #    print("Skipped ", image_result.GetNumberOfSkippedImages(), " image.")
-                if image_result is None and int(elapsed_time) % 5 == 0: #not image_result.GrabSucceeded():
-                    self.logger.info(f"{self.camname}:... waiting frame")
-                    # print("... waiting frame")
-                    continue
-
-                if image_result.GrabSucceeded():
-                    if self.nframes == 0:
-                        init_time_stamp = image_result.TimeStamp
-                    last_time_stamp = image_result.TimeStamp
-
-                    self.nframes += 1
-                    # if self.nframes % self.cam['options']['AcquisitionFrameRate'] == 0:
-                        # print(f'Frame: {self.nframes} / {n_frames}')
-                        # self.logger.info(f'Frame: {self.nframes} / {n_frames}')
-                        
-                    frame = self.convert_image(image_result)
-                    self.last_frame = frame.copy()
-                    
-                    if self.save:
-                        self.frame_write_queue.put_nowait(self.last_frame)
-
-                    if self.predict:
-                        self.predictor.frame = frame
-                        self.predictor.n_frame = self.nframes
-                        self.predictor.get_random_prediction()
-
-                    if self.preview:
-                        # self.vid_show.n_frame = self.nframes
-                        # self.vid_show.frame = frame
-                        # if not self.vid_show.queue.full():
-                        #     # print(f'{self.camname} frame: {frame.shape}')
-                        #     self.vid_show.queue.put_nowait(frame)
-                        #     # self.vid_show.queue.put_nowait(np.ascontiguousarray(frame))
-                        self.vid_show.update(frame)
-                        # if not self.display_manager.displays[self.camname]['queue'].full():
-                        #     self.display_manager.displays[self.camname]['queue'].put_nowait(frame)
-                        # self.display_manager.update_frame(self.camname, frame)
-
-                        if self.preview_predict:
-                            self.vid_show.pred_result = self.predictor.pred_result
-
-                    metadata[image_result.ID] = {}
-                    metadata[image_result.ID]['date_time_stamp'] = datetime.now().strftime("%Y%m%d_%H_%M_%S.%f")  # microsec precision
-                    metadata[image_result.ID]['fps'] = self.camera.ResultingFrameRate.Value
-                    # metadata[grabResult.ID]['frame_ID'] = grabResult.ID
-                    metadata[image_result.ID]['frame_number'] = image_result.ImageNumber
-                    metadata[image_result.ID]['time_stamp_w_offset'] = image_result.GetTimeStamp()*1e-9 + self.timestamp_offset
-                    metadata[image_result.ID]['cam_clock_time_stamp'] = image_result.TimeStamp                    
-
-                    image_result.Release()
-
-                    elapsed_time = time.perf_counter() - self.frame_timer
-                    if self.nframes >= n_frames:
-                        if self.preview:
-                            self.vid_show.stop()
-                        self.logger.info(f"{self.camname}: Breaking...")
-                        # print("Breaking...")
-                        break 
-
-        except KeyboardInterrupt:
-            self.logger.info(f"{self.camname}: Keyboard interrupt detected.")
-            # print("ABORT loop")
-            
-        finally:
-            
-            self.logger.info(f'{self.camname}: Ended acquisition.')
-            self.logger.info(f'{self.camname}: Elapsed time (time.perf_counter()) for processing {self.nframes} frames at {self.cam["options"]["AcquisitionFrameRate"]} FPS: {time.perf_counter() - self.frame_timer} sec.')
-            self.logger.info(f'{self.camname}: Time difference (grabResult.TimeStamp) between the first and the last frame timestamp: {(last_time_stamp - init_time_stamp) * 1e-9} sec.')
-            if self.preview:
-                self.vid_show.stop()
-            if self.predict:
-                self.predictor.stop()
-            if self.save:
-                self.logger.info(f'{self.camname}: Saving queued frames...')
-                self.write_frames = False
-                self.fram_writer_future.result()
-                self.save_vid_metadata(metadata)
-                self.logger.info(f'{self.camname}: Finished saving queued frames.')
-            # print(f'Elapsed time (time.perf_counter()) for processing {n_frames} frames at {self.cam["options"]["AcquisitionFrameRate"]} FPS: {time.perf_counter() - self.frame_timer} sec.')
-            # print(f'Time difference (grabResult.TimeStamp) between the first and the last frame timestamp: {(last_time_stamp - init_time_stamp) * 1e-9} sec.')
-    
-    @threaded
-    def frame_writer(self):
-        while self.write_frames:
-            if self.frame_write_queue.empty():
-                continue
-            self.writer_obj.write(self.frame_write_queue.get_nowait())
-
-        while not self.frame_write_queue.empty():
-            self.writer_obj.write(self.frame_write_queue.get_nowait())
-
-    def save_vid_metadata(self, metadata=None):
-        if metadata is not None:
-            with open(os.path.join(self.config['savedir'], self.experiment, f'metadata_{self.camname}.json'), 'w') as file:
-                json.dump(metadata, file)
-                # with open(os.path.join(self.config['savedir'], self.experiment, f'metadata.pickle'), 'wb') as file:
-                #     pickle.dump(metadata, file, pickle.HIGHEST_PROTOCOL)
-        self.writer_obj.release()
-    
\ No newline at end of file
+            self.camera.StopGrabbing()
+            self.camera.Close()
+            self.camera.DestroyDevice()
+        except Exception as e:
+            self.logger.info(f'{self.camname}: Could not close the lost camera: {e}')
+        # enumerated again, the device may have a new address after a USB reset
+        self.device = DeviceDiscovery(self.logger).find({**self.cam, 'serial': self.serial}, self.camname)[1]
+        self.open_device()
+        self.clock.reset()
+        self.camera.MaxNumBuffer.Value = int(self.cam['options']['AcquisitionFrameRate'])
+        self.nodemap = self.camera.GetNodeMap()
+        self.update_settings()
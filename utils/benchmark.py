@@ -0,0 +1,272 @@
+import os
+import copy
+import time
+import json
+import shutil
+import platform
+import resource
+import itertools
+import threading
+import numpy as np
+from argparse import Namespace
+from utils.devices import open_devices
+from utils.metadata import load_columns
+from utils.preview import DisplayManager, preview_options
+from utils.sync import FrameSynchronizer, sync_options
+
+# matrix axes of a benchmark config, each a list of values
+MATRIX_AXES = ['n_cams', 'resolution', 'fps', 'movie_format', 'preview', 'predict']
+DEFAULT_MATRIX = {'n_cams': [1], 'resolution': [[1280, 1024]], 'fps': [120], 'movie_format': ['raw'],
+                  'preview': [False], 'predict': [False]}
+
+# metrics compared with the baseline: name -> (higher is better, threshold is relative to the baseline)
+BASELINE_METRICS = {'fps': (True, True), 'drop_rate': (False, False), 'cpu_percent': (False, True),
+                    'rss_mb': (False, True), 'writer_max_depth': (False, True), 'processing_p99_ms': (False, True)}
+DEFAULT_THRESHOLDS = {'fps': 0.02, 'drop_rate': 0.001, 'cpu_percent': 0.25, 'rss_mb': 0.25,
+                      'writer_max_depth': 1.0, 'processing_p99_ms': 0.5}
+
+# CPU time is attributed to pipeline stages by thread name suffix (see the threads of utils/)
+THREAD_STAGES = {'grab': 'grab', 'camera': 'simulation', 'writer': 'writer', 'predictions': 'prediction',
+                 'inference': 'prediction', 'clock': 'sync', 'display': 'preview'}
+
+
+def benchmark_options(config):
+    """ Returns benchmark options from a benchmark config, see config/benchmark.yaml. """
+    options = {'base_config': 'config/config-simulated_multi_cam.yaml', 'camera': None, 'duration': 10,
+               'savedir': 'data/benchmark', 'keep_data': False, 'thresholds': {}}
+    options.update(config)
+    options['matrix'] = {**DEFAULT_MATRIX, **(config.get('matrix') or {})}
+    options['thresholds'] = {**DEFAULT_THRESHOLDS, **(config.get('thresholds') or {})}
+    unknown = set(options['matrix']) - set(MATRIX_AXES)
+    if unknown:
+        raise ValueError(f'Unknown benchmark matrix axes: {sorted(unknown)}, choose from {MATRIX_AXES}')
+    return options
+
+
+def benchmark_cases(matrix):
+    """ Returns the cases (dicts with one value per axis) of a benchmark matrix. """
+    axes = [axis for axis in MATRIX_AXES if axis in matrix]
+    return [dict(zip(axes, values)) for values in itertools.product(*(matrix[axis] for axis in axes))]
+
+
+def case_name(case):
+    width, height = case['resolution']
+    return (f"{case['n_cams']}cam_{width}x{height}_{case['fps']:g}fps_{case['movie_format']}"
+            f"_preview{int(bool(case['preview']))}_predict{int(bool(case['predict']))}")
+
+
+def machine_info():
+    return {'hostname': platform.node(), 'platform': platform.platform(), 'processor': platform.processor(),
+            'cpu_count': os.cpu_count(), 'python': platform.python_version()}
+
+
+def thread_cpu_times():
+    """ CPU time (sec) of each live thread by native id, from /proc (Linux only, empty elsewhere). """
+    ticks = os.sysconf('SC_CLK_TCK')
+    times = {}
+    for thread in threading.enumerate():
+        try:
+            with open(f'/proc/self/task/{thread.native_id}/stat') as file:
+                fields = file.read().rsplit(')', 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        times[thread.native_id] = (thread.name, (int(fields[11]) + int(fields[12])) / ticks)
+    return times
+
+
+def rss_mb():
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # peak since the start on other systems
+
+
+class ResourceMonitor():
+    """ Samples the CPU time of every thread and the resident memory every `period` sec. CPU time is
+    summed per stage (THREAD_STAGES); time of threads that ended between samples, and of unnamed
+    threads, is counted as `other`.
+    """
+
+    def __init__(self, period=0.25) -> None:
+        self.period = period
+        self.threads = {}  # native id -> (name, cpu sec)
+        self.peak_rss = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='benchmark_monitor', daemon=True)
+
+    def start(self):
+        self.start_t = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.start_threads = thread_cpu_times()
+        self.sample()
+        self.thread.start()
+
+    def sample(self):
+        self.threads.update(thread_cpu_times())
+        self.peak_rss = max(self.peak_rss, rss_mb())
+
+    def run(self):
+        while not self.stop_event.wait(self.period):
+            self.sample()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        self.sample()
+        elapsed = time.perf_counter() - self.start_t
+        total = time.process_time() - self.start_cpu
+        stages = {}
+        for native_id, (name, cpu) in self.threads.items():
+            if native_id == self.thread.native_id:
+                continue
+            start = self.start_threads.get(native_id)
+            cpu -= start[1] if start is not None and start[0] == name else 0
+            stage = THREAD_STAGES.get(name.rsplit('_', 1)[-1], 'other')
+            stages[stage] = stages.get(stage, 0) + cpu
+        stages['other'] = stages.get('other', 0) + max(0, total - sum(stages.values()))
+        return {'cpu_percent': 100 * total / elapsed, 'cpu_percent_by_stage': {stage: 100 * cpu / elapsed for stage, cpu in stages.items()},
+                'rss_mb': self.peak_rss}
+
+
+def case_config(base_config, camera, case, savedir):
+    """ Config of a case: `n_cams` copies of the `camera` of the base config at the case's resolution and fps. """
+    config = copy.deepcopy(base_config)
+    config['savedir'] = savedir
+    config['recording_fps'] = case['fps']
+    cams = {name: cam for name, cam in config['cams'].items() if cam.get('use', True)}
+    if not cams:
+        raise ValueError('No cameras in the base config.')
+    camname = camera or next(iter(cams))
+    template = cams[camname]
+    config['cams'] = {}
+    for i in range(case['n_cams']):
+        cam = copy.deepcopy(template)
+        # copies of a hardware camera take the next free devices
+        cam['serial'] = template.get('serial') if i == 0 else None
+        cam.update({'use': True, 'preview': case['preview'], 'predict': case['predict'], 'preview_predict': case['preview'] and case['predict']})
+        cam['options']['Width'], cam['options']['Height'] = case['resolution']
+        cam['options']['AcquisitionFrameRate'] = case['fps']
+        config['cams'][f'{camname}_{i}'] = cam
+    return config
+
+
+def case_args(case, duration, model_path=''):
+    """ Command line arguments of acquire_multi_cam.py for a case. """
+    return Namespace(save='1', movie_format=case['movie_format'], n_total_frames=int(duration * case['fps']),
+                     acquisition_mode='frames', trigger_with_arduino='0', latency_stats='1', model_path=model_path,
+                     nodemap_path=None, videowrite_fps=case['fps'], nframes_per_file=0, segment_duration=0,
+                     stimulation_path='', process_mode='thread')
+
+
+def run_case(case, base_config, logger, camera=None, duration=10, savedir='data/benchmark', keep_data=False, model_path=''):
+    """ Runs the acquisition of a benchmark case (thread mode, saving) and returns its metrics. """
+    name = case_name(case)
+    config = case_config(base_config, camera, case, savedir)
+    args = case_args(case, duration, model_path)
+    experiment = name
+    directory = os.path.join(savedir, experiment)
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+    os.makedirs(directory)
+    camnames = list(config['cams'])
+    start_t = time.perf_counter()
+
+    synchronizer = None
+    if len(camnames) > 1:
+        synchronizer = FrameSynchronizer(camnames, case['fps'], logger, mode=sync_options(config, args)['mode'],
+                                         path=os.path.join(directory, 'frame_table'))
+    display_manager = DisplayManager(**preview_options(config)) if case['preview'] else None
+    stop_event = threading.Event()
+    devices = open_devices(config['cams'], args, experiment, config, start_t, logger, display_manager=display_manager,
+                           stop_event=stop_event, synchronizer=synchronizer)
+    if display_manager is not None:
+        display_manager.start()
+
+    monitor = ResourceMonitor()
+    monitor.start()
+    threads = [threading.Thread(target=device.get_n_frames, args=(args.n_total_frames,), kwargs={'report_period': duration},
+                                name=f'{camname}_grab') for camname, device in devices.items()]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        stop_event.set()
+        for thread in threads:
+            thread.join()
+        raise
+    finally:
+        resources = monitor.stop()
+        for device in devices.values():
+            device.close()
+        if display_manager is not None:
+            display_manager.stop()
+        if synchronizer is not None:
+            synchronizer.close()
+
+    cameras = {camname: camera_metrics(device, directory) for camname, device in devices.items()}
+    n_frames = sum(metrics['frames'] for metrics in cameras.values())
+    n_missing = sum(metrics['missing'] for metrics in cameras.values())
+    metrics = {'fps': min(metrics['fps'] for metrics in cameras.values()),
+               'drop_rate': n_missing / max(1, n_frames + n_missing),
+               'writer_max_depth': max(metrics['writer_max_depth'] for metrics in cameras.values()),
+               'processing_p99_ms': max(metrics['processing_p99_ms'] for metrics in cameras.values()),
+               **resources}
+    if not keep_data:
+        shutil.rmtree(directory)
+    return {'name': name, 'case': case, 'duration': duration, 'metrics': metrics, 'cameras': cameras}
+
+
+def camera_metrics(device, directory):
+    """ Sustained fps (delivered frames over the span of their timestamps), drops, writer backlog and grab loop latency
+    of a camera. frames counts the frames written to the video (without placeholders), missing the frames lost by the
+    camera, for lack of a frame pool slot or by the writer. processing_p99_ms, the sum of the p99 of the grab loop stages
+    after the frame arrived, bounds the p99 of the time the loop spends on a frame.
+    """
+    camname = device.camname
+    metadata = load_columns(os.path.join(directory, f'metadata_{camname}'))
+    time_stamps = metadata['cam_clock_time_stamp'][metadata['frame_id'] != -1]
+    span = (time_stamps[-1] - time_stamps[0]) * 1e-9 if len(time_stamps) > 1 else 0
+    gaps = load_columns(os.path.join(directory, f'dropped_frames_{camname}'))
+    with open(os.path.join(directory, f'latency_{camname}.json')) as file:
+        latency = json.load(file)
+    n_placeholders = int(np.count_nonzero(metadata['frame_id'] == -1))
+    metrics = {'frames': device.frame_writer.n_written - n_placeholders,
+               'fps': (len(time_stamps) - 1) / span if span > 0 else 0.0,
+               'missing': int(np.sum(gaps['n_missing'])) + device.frame_pool.n_exhausted + device.frame_writer.n_dropped,
+               'pool_exhausted': device.frame_pool.n_exhausted,
+               'writer_max_depth': device.frame_writer.max_depth, 'writer_blocked': device.frame_writer.n_blocked,
+               'writer_dropped': device.frame_writer.n_dropped,
+               'processing_p99_ms': sum(summary['p99'] for stage, summary in latency.items() if stage not in ['retrieve', 'frame']),
+               'latency_p99_ms': {stage: summary['p99'] for stage, summary in latency.items() if summary['count']}}
+    if device.predict:
+        metrics['predictions'] = device.predictor.latency.n
+        metrics['prediction_p99_ms'] = device.predictor.latency.summary()['p99']
+    return metrics
+
+
+def compare(results, baseline, thresholds):
+    """ Compares the metrics of each case with the baseline case of the same name. Returns a list of
+    regressions (case, metric, baseline value, value, threshold) and the names of cases without a baseline.
+    """
+    baseline_cases = {case['name']: case for case in baseline['cases']}
+    regressions, new_cases = [], []
+    for case in results['cases']:
+        reference = baseline_cases.get(case['name'])
+        if reference is None:
+            new_cases.append(case['name'])
+            continue
+        for metric, (higher_is_better, relative) in BASELINE_METRICS.items():
+            if metric not in case['metrics'] or metric not in reference['metrics']:
+                continue
+            value, reference_value = case['metrics'][metric], reference['metrics'][metric]
+            allowed = thresholds[metric] * abs(reference_value) if relative else thresholds[metric]
+            worse = reference_value - value if higher_is_better else value - reference_value
+            if worse > allowed:
+                regressions.append((case['name'], metric, reference_value, value, thresholds[metric]))
+    return regressions, new_cases
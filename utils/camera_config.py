@@ -0,0 +1,101 @@
+import os
+import json
+import math
+import time
+import hashlib
+
+
+def camera_config_options(config, cam):
+    """ Returns camera configuration options from the top-level `camera_config` section of the config,
+    overridden by the camera's own `camera_config` section if present.
+    """
+    options = {'cache': True, 'cache_dir': '~/.cache/basler_arduino', 'user_set': None, 'session_tolerance': 1.0}
+    options.update(config.get('camera_config') or {})
+    options.update(cam.get('camera_config') or {})
+    options['cache_dir'] = os.path.expanduser(options['cache_dir'])
+    return options
+
+
+def settings_hash(settings, feature_file=None):
+    """ Hash of the ordered (node, value) settings and of the contents of a feature file (.pfs) if given. """
+    digest = hashlib.sha1(json.dumps([[name, value] for name, value in settings]).encode())
+    if feature_file is not None:
+        with open(feature_file, 'rb') as file:
+            digest.update(file.read())
+    return digest.hexdigest()[:16]
+
+
+def same_value(current, value):
+    if isinstance(value, float) or isinstance(current, float):
+        return math.isclose(float(current), float(value), rel_tol=1e-6, abs_tol=1e-9)
+    return current == value
+
+
+def apply_settings(settings, read, write, logger, name=''):
+    """ Writes the (node, value) settings in order, skipping nodes that already have the value (read back
+    right before, so that nodes behind a selector are read for the selected entry). If a write fails, e.g. an
+    offset that only fits after a later width, the settings are gone through once more and errors are raised.
+    Returns the number of written nodes.
+    """
+    n_written = 0
+    failed = []
+    for attempt in range(2):
+        for node, value in settings:
+            try:
+                if same_value(read(node), value):
+                    continue
+            except Exception:
+                pass  # not readable now, e.g. not available before another node is set
+            try:
+                write(node, value)
+                n_written += 1
+            except Exception as e:
+                if attempt == 1:
+                    raise
+                failed.append(f'{node} = {value} ({e})')
+        if not failed or attempt == 1:
+            break
+        logger.info(f'{name}: retrying the settings after {", ".join(failed)}')
+    return n_written
+
+
+class ConfigCache():
+    """ Remembers per camera serial which settings (hash) were applied, and when: the camera clock
+    (ns since its power-up or reset) and the host clock at that time. If both clocks advanced by the
+    same amount since, the camera has not been reset. Its settings may still have been changed by another
+    program, so they are read back and diffed anyway (see apply_settings).
+    """
+
+    def __init__(self, cache_dir, session_tolerance=1.0) -> None:
+        self.cache_dir = cache_dir
+        self.session_tolerance = session_tolerance  # sec
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def path(self, serial, suffix='.json'):
+        return os.path.join(self.cache_dir, f'{serial}{suffix}')
+
+    def get(self, serial):
+        try:
+            with open(self.path(serial)) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, serial, key, cam_time_stamp, **extra):
+        entry = {'hash': key, 'cam_time_stamp': int(cam_time_stamp), 'host_time': time.time(), **extra}
+        # written to a temporary file first, so that a crash never leaves half an entry
+        tmp_path = self.path(serial, '.json.tmp')
+        with open(tmp_path, 'w') as file:
+            json.dump(entry, file, indent=1)
+        os.replace(tmp_path, self.path(serial))
+
+    def is_current(self, entry, key, cam_time_stamp):
+        """ True if the entry has the settings `key` and the camera was not reset since it got them. """
+        if entry is None or entry.get('hash') != key:
+            return False
+        cam_elapsed = (int(cam_time_stamp) - entry['cam_time_stamp']) * 1e-9
+        host_elapsed = time.time() - entry['host_time']
+        return cam_elapsed >= 0 and abs(cam_elapsed - host_elapsed) < self.session_tolerance + 1e-4 * host_elapsed
+
+    def nodemap_path(self, serial, key):
+        return self.path(serial, f'_{key}_nodemap.txt')
@@ -0,0 +1,151 @@
+import time
+import threading
+import numpy as np
+from utils.latency import LatencyMonitor
+from utils.metadata import ColumnarWriter
+
+# latency of each stimulation command: frame exposure -> prediction, prediction -> serial write, and the total
+CLOSED_LOOP_STAGES = ['inference', 'decision', 'total']
+
+# one row per stimulation command, written to stimulation_events; times are host times (sec since start)
+STIM_EVENT_DTYPE = np.dtype([('frame_id', np.int64),          # frame whose prediction triggered the command
+                             ('n_frame', np.int64),
+                             ('camera', np.int64),            # index of the camera in the rules' camera list
+                             ('rule', np.int64),              # index of the matching rule, -1 for stop commands
+                             ('command', np.int64),           # 1: stimulation on, 0: off
+                             ('exposure_time', np.float64),   # frame timestamp
+                             ('prediction_time', np.float64), # prediction result
+                             ('write_time', np.float64),      # serial write returned
+                             ('latency', np.float64)])        # write_time - exposure_time
+
+
+def closed_loop_options(config):
+    """ Returns closed-loop stimulation options from the `closed_loop` section of the config. """
+    options = {'pulse_interval_ms': 100, 'duty_cycle': 50, 'hold_ms': 100, 'min_confidence': 0.5,
+               'latency_budget_ms': 20, 'rules': []}
+    options.update(config.get('closed_loop') or {})
+    return options
+
+
+class ROIRule():
+    """ Matches if `keypoint` of any animal (or of `animal`) with at least `min_confidence` lies in
+    `roi` = [x0, y0, x1, y1] (frame pixels). Applies to predictions of `camera`, or of all cameras if None.
+    """
+
+    def __init__(self, roi, keypoint=0, camera=None, animal=None, min_confidence=0.5) -> None:
+        if len(roi) != 4:
+            raise ValueError(f'Invalid ROI: {roi}, expected [x0, y0, x1, y1]')
+        self.roi = [float(value) for value in roi]
+        self.keypoint = keypoint
+        self.camera = camera
+        self.animal = animal
+        self.min_confidence = min_confidence
+
+    def applies_to(self, camname):
+        return self.camera is None or self.camera == camname
+
+    def match(self, keypoints):
+        points = keypoints[:, self.keypoint] if self.animal is None else keypoints[[self.animal], self.keypoint]
+        x, y, confidence = points[:, 0], points[:, 1], points[:, 2]
+        x0, y0, x1, y1 = self.roi
+        # nan keypoints (not detected) compare as False
+        return bool(np.any((x >= x0) & (x < x1) & (y >= y0) & (y < y1) & (confidence >= self.min_confidence)))
+
+
+class ClosedLoopStimulator():
+    """ Turns the Arduino stimulation on and off from the predictions of the cameras.
+
+    update(camname, prediction) is called with every Prediction (see Predictor.on_prediction). Stimulation
+    is turned on ('Re,<interval ms>,<duty cycle %>') when a rule matches, and off ('V') once no rule has
+    matched for `hold_ms`. Each command is saved to a table at `path` (see STIM_EVENT_DTYPE) with its
+    latency from the frame exposure to the serial write; latency percentiles are logged at the end.
+    """
+
+    def __init__(self, arduino, camnames, start_t, logger, path=None, rules=(), pulse_interval_ms=100, duty_cycle=50,
+                 hold_ms=100, min_confidence=0.5, latency_budget_ms=20) -> None:
+        if arduino is None:
+            raise ValueError('Arduino is not set as the trigger source.')
+        self.arduino = arduino
+        self.camnames = list(camnames)
+        self.start_t = start_t
+        self.logger = logger
+        self.rules = [ROIRule(**{'min_confidence': min_confidence, **rule}) for rule in rules]
+        if not self.rules:
+            raise ValueError('No closed_loop.rules in the config.')
+        for rule in self.rules:
+            if rule.camera is not None and rule.camera not in self.camnames:
+                raise ValueError(f'Closed-loop rule for unknown camera: {rule.camera}')
+        self.start_cmd = f'Re,{int(pulse_interval_ms)},{int(duty_cycle)}\n'
+        self.hold = hold_ms / 1000
+        self.latency_budget = latency_budget_ms / 1000
+        self.events = ColumnarWriter(path, STIM_EVENT_DTYPE, chunk_size=64) if path is not None else None
+        self.latency = LatencyMonitor('closed_loop', stages=CLOSED_LOOP_STAGES)
+        self.lock = threading.Lock()
+        self.last_match = [-np.inf] * len(self.rules)  # host time of each rule's last matching frame
+        self.stimulating = False
+        self.stopped = False
+
+        # counters
+        self.n_predictions = 0
+        self.n_on = 0
+        self.n_over_budget = 0
+
+    def callback(self, camname):
+        """ Returns the on_prediction callback of a camera's Predictor. """
+        return lambda prediction: self.update(camname, prediction)
+
+    def update(self, camname, prediction):
+        prediction_time = time.perf_counter() - self.start_t
+        with self.lock:
+            if self.stopped:
+                return
+            self.n_predictions += 1
+            matched = -1
+            for i, rule in enumerate(self.rules):
+                if rule.applies_to(camname) and rule.match(prediction.keypoints):
+                    self.last_match[i] = prediction_time
+                    matched = i if matched == -1 else matched
+            active = any(prediction_time - last_match <= self.hold for last_match in self.last_match)
+            if active != self.stimulating:
+                self.send(active, camname, matched, prediction, prediction_time)
+
+    def send(self, on, camname, rule, prediction, prediction_time):
+        # wait for the write only, the acknowledgement is matched in the background
+        request = self.arduino.send(self.start_cmd if on else 'V\n')
+        request.written.wait(1)
+        write_time = (request.write_time or time.perf_counter()) - self.start_t
+        self.stimulating = on
+        self.n_on += on
+
+        # exposure_time is nan if the frame's host time is unknown
+        exposure_time = prediction.time_stamp
+        latency = write_time - exposure_time
+        self.latency.histograms['decision'].record((write_time - prediction_time) * 1e9)
+        if np.isfinite(latency):
+            self.latency.histograms['inference'].record((prediction_time - exposure_time) * 1e9)
+            self.latency.histograms['total'].record(latency * 1e9)
+            if latency > self.latency_budget:
+                self.n_over_budget += 1
+        if self.events is not None:
+            self.events.append((prediction.frame_id, prediction.n_frame, self.camnames.index(camname), rule, int(on),
+                                exposure_time, prediction_time, write_time, latency))
+        self.logger.info(f'{camname}: closed loop stimulation {"on" if on else "off"} at frame {prediction.frame_id} '
+                         f'(rule {rule}), {latency * 1e3:.1f} ms after exposure')
+
+    def report(self):
+        return (f'predictions: {self.n_predictions}, stimulations: {self.n_on}, over the '
+                f'{self.latency_budget * 1e3:g} ms budget: {self.n_over_budget} | {self.latency.report()}')
+
+    def stop(self, latency_path=None):
+        with self.lock:
+            if self.stopped:
+                return
+            self.stopped = True
+            if self.stimulating:
+                self.arduino.send('V\n')
+                self.stimulating = False
+        if self.events is not None:
+            self.events.close()
+        if latency_path is not None:
+            self.latency.save(latency_path)
+        self.logger.info(f'Closed loop | {self.report()}')
@@ -0,0 +1,132 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+CAMERA_TYPES = ['Basler', 'FLIR', 'Simulated']
+
+
+class DeviceDiscovery():
+    """ Enumerates the cameras of each SDK once and hands them out by the `serial` of each camera in the
+    config. Cameras without a serial get the first device that is not taken yet, in enumeration order.
+    SDKs are imported on first use, so that only the ones in use need to be installed.
+    """
+
+    def __init__(self, logger) -> None:
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.devices = {}  # camera type -> [(serial, device)] in enumeration order
+        self.taken = {}  # camera type -> {serial: camname}
+        self.system = None  # PySpin.System, released in close()
+        self.flir_cameras = None
+
+    def enumerate(self, cam_type):
+        """ Returns [(serial, device)] of a camera type: pylon DeviceInfo, PySpin CameraPtr, or None for simulated cameras. """
+        with self.lock:
+            if cam_type not in self.devices:
+                if cam_type == 'Basler':
+                    self.devices[cam_type] = self.enumerate_basler()
+                elif cam_type == 'FLIR':
+                    self.devices[cam_type] = self.enumerate_flir()
+                else:
+                    self.devices[cam_type] = []
+                self.taken[cam_type] = {}
+                if cam_type != 'Simulated':
+                    self.logger.info(f'{cam_type} cameras found: {[serial for serial, _ in self.devices[cam_type]]}')
+            return self.devices[cam_type]
+
+    def enumerate_basler(self):
+        from pypylon import pylon
+        return [(str(info.GetSerialNumber()), info) for info in pylon.TlFactory.GetInstance().EnumerateDevices()]
+
+    def enumerate_flir(self):
+        import PySpin
+        self.system = PySpin.System.GetInstance()
+        self.flir_cameras = self.system.GetCameras()
+        return [(PySpin.CStringPtr(camera.GetTLDeviceNodeMap().GetNode('DeviceSerialNumber')).GetValue(), camera)
+                for camera in self.flir_cameras]
+
+    def find(self, cam, camname):
+        """ Returns (cam_id, device) of the camera `camname`: its index in the enumeration and its SDK device. """
+        if cam['type'] not in CAMERA_TYPES:
+            raise ValueError('Invalid camera type: %s' % cam['type'])
+        devices = self.enumerate(cam['type'])
+        serial = cam.get('serial')
+        with self.lock:
+            taken = self.taken[cam['type']]
+            if cam['type'] == 'Simulated':
+                cam_id = len(taken)
+                taken[str(serial) if serial is not None else camname] = camname
+                return cam_id, None
+            if serial is None:
+                free = [i for i, (device_serial, _) in enumerate(devices) if device_serial not in taken]
+                if not free:
+                    raise RuntimeError(f'{camname}: no free {cam["type"]} camera left, found: {[s for s, _ in devices]}')
+                cam_id = free[0]
+                self.logger.info(f'{camname}: no serial in the config, using the {cam["type"]} camera {devices[cam_id][0]}')
+            else:
+                serials = [device_serial for device_serial, _ in devices]
+                if str(serial) not in serials:
+                    raise RuntimeError(f'{camname}: {cam["type"]} camera {serial} not found, found: {serials}')
+                if str(serial) in taken:
+                    raise ValueError(f'{camname}: camera {serial} is already used by {taken[str(serial)]}')
+                cam_id = serials.index(str(serial))
+            taken[devices[cam_id][0]] = camname
+            return cam_id, devices[cam_id][1]
+
+    def close(self):
+        """ Releases the FLIR system; the FLIR cameras have to be closed before. """
+        with self.lock:
+            if self.flir_cameras is not None:
+                self.devices.pop('FLIR', None)
+                self.flir_cameras.Clear()
+                self.flir_cameras = None
+            if self.system is not None:
+                self.system.ReleaseInstance()
+                self.system = None
+
+
+def create_device(args, cam, camname, experiment, config, start_t, logger, discovery=None, found=None, **kwargs):
+    """ Creates the camera object for the `type` of the camera in the config, for the device with its `serial`
+    (or `found`, the (cam_id, device) returned by discovery.find).
+    """
+    if cam['type'] == 'Realsense':
+        raise NotImplementedError
+    own_discovery = discovery is None
+    if own_discovery:
+        discovery = DeviceDiscovery(logger)
+    cam_id, device = found if found is not None else discovery.find(cam, camname)
+    if cam['type'] == 'FLIR':
+        from utils.flir import FLIR
+        # a discovery of its own is released when the camera is closed
+        return FLIR(args, cam, camname, experiment, config, start_t, logger, cam_id=cam_id, device=device,
+                    discovery=discovery if own_discovery else None, **kwargs)
+    elif cam['type'] == 'Basler':
+        from utils.basler import Basler
+        return Basler(args, cam, camname, experiment, config, start_t, logger, cam_id=cam_id, device=device, **kwargs)
+    else:
+        from utils.simulated import Simulated
+        return Simulated(args, cam, camname, experiment, config, start_t, logger, cam_id=cam_id, **kwargs)
+
+
+def open_devices(cams, args, experiment, config, start_t, logger, discovery=None, **kwargs):
+    """ Opens and configures the cameras {camname: cam} concurrently, after a single enumeration.
+    Returns {camname: device}; if a camera fails, the others are closed and the error is raised.
+    """
+    discovery = discovery or DeviceDiscovery(logger)
+    # devices are assigned in config order, so that cameras without a serial always get the same one
+    found = {camname: discovery.find(cam, camname) for camname, cam in cams.items()}
+    with ThreadPoolExecutor(max(1, len(cams))) as executor:
+        futures = {camname: executor.submit(create_device, args, cam, camname, experiment, config, start_t, logger,
+                                            discovery=discovery, found=found[camname], **kwargs)
+                   for camname, cam in cams.items()}
+    devices, error = {}, None
+    for camname, future in futures.items():
+        try:
+            devices[camname] = future.result()
+        except Exception as e:
+            logger.info(f'{camname}: could not be opened: {e}')
+            error = error or e
+    if error is not None:
+        for device in devices.values():
+            device.close()
+        raise error
+    return devices
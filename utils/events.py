@@ -0,0 +1,66 @@
+import threading
+import numpy as np
+from utils.metadata import ColumnarWriter
+
+# one row per Arduino event (see utils/arduino.py), written to arduino_events
+EVENT_DTYPE = np.dtype([('kind', np.int64),           # 1: trigger pulse, 2: stimulation on, 3: stimulation off
+                        ('index', np.int64),          # pulse number (from 1) or stimulation number
+                        ('arduino_time', np.int64),   # Arduino micros(), unwrapped (us)
+                        ('host_time', np.float64),    # arrival on the host (sec since start)
+                        ('trigger', np.int64),        # trigger index of the event, -1 before the first pulse
+                        ('offset', np.int64)])        # time since that trigger pulse (us)
+EVENT_CODES = {'pulse': 1, 'stim_on': 2, 'stim_off': 3}
+
+
+class EventLog():
+    """ Writes the trigger pulse and stimulation events of the Arduino to a table at `path`, aligned to
+    camera frames: the n-th pulse (index n) triggers the frames with trigger index n - 1 (the `trigger`
+    column of the FrameSynchronizer frame table), and stimulation events get the trigger index of the
+    last pulse before them and their offset from it.
+    """
+
+    def __init__(self, path, logger, start_t) -> None:
+        self.logger = logger
+        self.start_t = start_t
+        self.table = ColumnarWriter(path, EVENT_DTYPE, chunk_size=1024)
+        self.lock = threading.Lock()
+        self.last_micros = None
+        self.wraps = 0  # micros() overflows every ~71.6 min
+        self.last_pulse = None  # (index, unwrapped micros)
+
+        # counters
+        self.n_events = {kind: 0 for kind in EVENT_CODES}
+        self.n_missing_pulses = 0
+
+    def unwrap(self, micros):
+        if self.last_micros is not None and micros < self.last_micros - (1 << 31):
+            self.wraps += 1
+        self.last_micros = micros
+        return micros + (self.wraps << 32)
+
+    def add(self, event):
+        """ Adds an ArduinoEvent, see Arduino.on_event. """
+        if event.kind not in EVENT_CODES:
+            return
+        with self.lock:
+            micros = self.unwrap(event.micros)
+            if event.kind == 'pulse':
+                if self.last_pulse is not None and event.index > self.last_pulse[0] + 1:
+                    self.n_missing_pulses += event.index - self.last_pulse[0] - 1
+                self.last_pulse = (event.index, micros)
+                trigger, offset = event.index - 1, 0
+            elif self.last_pulse is not None:
+                trigger, offset = self.last_pulse[0] - 1, micros - self.last_pulse[1]
+            else:
+                trigger, offset = -1, 0
+            self.n_events[event.kind] += 1
+            self.table.append((EVENT_CODES[event.kind], event.index, micros, event.host_time - self.start_t, trigger, offset))
+
+    def report(self):
+        return (f"pulses: {self.n_events['pulse']} (missing records: {self.n_missing_pulses}), "
+                f"stimulation on: {self.n_events['stim_on']}, off: {self.n_events['stim_off']}")
+
+    def close(self):
+        with self.lock:
+            self.table.close()
+        self.logger.info(f'Arduino events | {self.report()}')
@@ -6,11 +6,14 @@ import PySpin
 import pprint
 import numpy as np
 import utils.pointgrey_utils as pg
-from datetime import datetime
-from .preview import VideoShow, VideoShow2
-from .prediction import Predictor
 from .helpers import str_to_bool
-from queue import Queue
+from .devices import DeviceDiscovery
+from .camera_config import apply_settings
+from .writer import FrameWriter, writer_options
+from .recorders import make_recorder, segment_frames
+from .latency import LatencyMonitor
+from .grab_loop import GrabLoop, GrabbedFrame
+from .frame_pool import pool_pixel_format
 from concurrent.futures import ThreadPoolExecutor
 
 # PySpin.System.SetCTIFile("/opt/spinnaker/lib/spinnaker-gentl/Spinnaker_GenTL.cti")
@@ -23,10 +26,14 @@ def threaded(fn):
     return wrapper
 
 
-class FLIR():
+class FLIR(GrabLoop):
 
-    def __init__(self, args, cam, camname, experiment, config, start_t, logger, cam_id=0,
-                 max_cams=2, connect_retries=20, display_lock=None, display_manager=None) -> None:
+    grab_timeout_ms = 1000
+
+    def __init__(self, args, cam, camname, experiment, config, start_t, logger, cam_id=0, device=None, discovery=None,
+                 connect_retries=20, display_lock=None, display_manager=None,
+                 frame_pool=None, frame_writer=None, stop_event=None, synchronizer=None,
+                 inference_engine=None, closed_loop=None) -> None:
         logger.info(f'{camname}: Searching for camera...')
 
         self.start_t = start_t
@@ -36,8 +43,26 @@ class FLIR():
         self.experiment = experiment
         self.config = config
         self.cam_id = cam_id
+        # PySpin camera with the `serial` of the config, and the DeviceDiscovery to release on close() if it
+        # is not shared with other cameras (see utils/devices.py)
+        self.device = device
+        self.discovery = discovery
         self.frame_timer = None
         self.display_manager = display_manager
+        # frame pool and writer are created here unless given (e.g., shared memory pool and writer process)
+        self.frame_pool = frame_pool
+        self.frame_writer = frame_writer
+        # set to stop acquisition before n_frames (or in continuous mode)
+        self.stop_event = stop_event
+        # FrameSynchronizer (or SyncQueue in process mode) matching frames across cameras
+        self.synchronizer = synchronizer
+        # InferenceEngine shared across cameras for micro-batching, otherwise the predictor runs its own
+        self.inference_engine = inference_engine
+        # ClosedLoopStimulator fed with this camera's predictions
+        self.closed_loop = closed_loop
+        self.latency = LatencyMonitor(camname, enabled=str_to_bool(args.latency_stats))
+        self.avi_recorder = None
+        self.writer_obj = None
         # self.preview = str_to_bool(self.args.preview)
         self.preview = cam['preview']
         self.save = str_to_bool(self.args.save)
@@ -60,34 +85,18 @@ class FLIR():
 
         self.update_settings()
 
-        if self.predict:
-            self.predictor = Predictor(self.logger, self.args.model_path)
-        
-        if self.preview:
-            # self.vid_show = VideoShow(f'{self.camname}', self.preview_predict, pred_preview_button=cam['pred_preview_toggle_button'],
-            #                           display_lock=display_lock)
-            # self.vid_show.frame = np.zeros((self.cam['options']['Height'], self.cam['options']['Width']), dtype=np.uint8)
-            self.vid_show = VideoShow2(f'{self.camname}', self.preview_predict, pred_preview_button=cam['pred_preview_toggle_button'],
-                                       display_manager=display_manager)
-            # self.display_manager.add_display(self.camname)
-        #     if self.vid_show.show_pred:
-        #         self.vid_show.pred_result = self.predictor.pred_result
-            # self.vid_show.start()
-
-        if self.save:
-            self.init_video_writer()
+        # frames are converted to Mono8 before pooling, see put_frame()
+        self.pool_pixel_format = pool_pixel_format(self.cam)
+        self.record_color = False
+        self.init_consumers()
 
     def init_camera(self):
-        self.system = PySpin.System.GetInstance()
-        self.cam_list = self.system.GetCameras()
-
-        if len(self.cam_list) == 0:
-            raise Exception(f'{self.camname} is not detected.')
-        
-        self.camera = self.cam_list.GetBySerial(str(self.cam['serial']))
-        # self.camera = self.cam_list[self.cam_id]
+        if self.device is None:
+            self.discovery = DeviceDiscovery(self.logger)
+            self.device = self.discovery.find(self.cam, self.camname)[1]
+        self.camera = self.device
         self.camera.Init()
-        # self.compute_timestamp_offset()
+        self.start_clock_sync()
         self.nodemap = self.camera.GetNodeMap()
         self.nodemap_tldevice = self.camera.GetTLDeviceNodeMap()
         self.device_serial_number = PySpin.CStringPtr(self.nodemap_tldevice.GetNode('DeviceSerialNumber')).GetValue()
@@ -199,12 +208,12 @@ class FLIR():
         # if not str_to_bool(self.args.trigger_with_arduino):
         #     self.reset()
         # else:
-        for key, value in self.cam['options'].items():
-        # for key, value in options.items():
-            if key in ['AcquisitionFrameRate']:
-                continue
-            # if key in ['Height', 'Width']:
-            pg.set_value(self.nodemap, key, value)
+        # only the nodes whose current value differs are written, see apply_settings
+        settings = [(key, value) for key, value in self.cam['options'].items() if key not in ['AcquisitionFrameRate']]
+        t0 = time.perf_counter()
+        n_written = apply_settings(settings, lambda node: pg.get_value(self.nodemap, node),
+                                   lambda node, value: pg.set_value(self.nodemap, node, value), self.logger, self.camname)
+        self.logger.info(f'{self.camname}: {n_written}/{len(settings)} nodes written in {(time.perf_counter() - t0) * 1000:.1f} ms')
         
         if str_to_bool(self.args.trigger_with_arduino):
             # pg.turn_strobe_on(self.nodemap, self.cam['strobe']['line'], strobe_duration=self.cam['strobe']['duration'])
@@ -317,40 +326,69 @@ class FLIR():
         self.camera.UserSetSelector.SetValue(PySpin.UserSetSelector_Default)
         self.camera.UserSetLoad.Execute()
 
-    def reconnect(self):
-        self.logger.info(f"FLIR {self.cam_id}: Reconnecting...")
-        ### disconnect - reconnect
-        reset_node = PySpin.CCommandPtr(self.nodemap.GetNode('DeviceReset'))
-        reset_node.Execute()
-        time.sleep(2)
-
-        self.cam_list.Clear()   # Clear the camera list
-        self.system.ReleaseInstance()  # Release the system instance
-        self.logger.info(f"FLIR {self.cam_id} disconnected.")
-
-        self.system = PySpin.System.GetInstance()
-        self.cam_list = self.system.GetCameras()
-        self.camera = self.cam_list[0]
+    def reopen(self):
+        """ Reopens the camera by serial after it was lost (resetting it first if it still answers) and re-applies its settings. """
+        self.logger.info(f"{self.camname}: Reconnecting...")
+        if self.camera is not None:
+            ### disconnect - reconnect
+            try:
+                self.camera.EndAcquisition()
+                reset_node = PySpin.CCommandPtr(self.nodemap.GetNode('DeviceReset'))
+                reset_node.Execute()
+                time.sleep(2)
+            except PySpin.SpinnakerException as e:
+                self.logger.info(f"{self.camname}: Could not reset the camera: {e}")
+            del self.camera
+            self.camera = self.device = None
+            self.logger.info(f"{self.camname}: disconnected.")
+
+        # the same camera by serial, the system is shared with the other cameras
+        cam_list = PySpin.System.GetInstance().GetCameras()
+        camera = cam_list.GetBySerial(self.device_serial_number)
+        cam_list.Clear()
+        if not camera.IsValid():
+            raise RuntimeError(f'camera {self.device_serial_number} not found')
+        self.camera = self.device = camera
         self.camera.Init()
         self.nodemap_tldevice = self.camera.GetTLDeviceNodeMap()
         self.nodemap = self.camera.GetNodeMap()
-        self.device_serial_number = PySpin.CStringPtr(self.nodemap_tldevice.GetNode('DeviceSerialNumber')).GetValue()
+        self.clock.reset()
+        self.set_default_params()
+        self.update_settings()
 
         self.logger.info(f"{self.camname} reconnected.")
 
     def close(self):
         
         try:
-            self.camera.DeInit()
-            self.cam_list.Clear()
-            system = PySpin.System.GetInstance()
-            system.ReleaseInstance()
+            self.clock.close()
+            # None if the camera was lost and could not be reconnected
+            if self.camera is not None:
+                self.camera.DeInit()
+            # the system can only be released once no camera is referenced
+            del self.camera
+            self.device = None
+            if self.discovery is not None:
+                self.discovery.close()
             self.logger.info(f"{self.camname}: Closed.")
         except PySpin.SpinnakerException as e:
             self.logger.info(f"{self.camname}: Error during cleanup: {e}")
     
     def init_video_writer(self):
-
+        if self.frame_writer is not None:
+            return
+
+        nframes_per_file = segment_frames(self.args, self.cam)
+        if self.args.movie_format != 'opencv' or nframes_per_file:
+            self.writer_obj = make_recorder(self.args.movie_format, os.path.join(self.config['savedir'], self.experiment, f"video_{self.camname}"),
+                                            self.args.videowrite_fps, self.cam['options']['Width'], self.cam['options']['Height'],
+                                            False, self.config, self.cam, nframes_per_file=nframes_per_file)
+            self.frame_writer = FrameWriter(self.camname, self.writer_obj.write, self.logger,
+                                            spill_path=os.path.join(self.config['savedir'], self.experiment, f"spill_{self.camname}.npy"),
+                                            frame_pool=self.frame_pool, **writer_options(self.config, self.cam))
+            return
+
+        # default: Spinnaker's own AVI writer
         chosenAviType = AviType.MJPG  # change me!
 
         self.avi_recorder = PySpin.SpinVideo()
@@ -374,144 +412,65 @@ class FLIR():
 
         # self.writer_obj = cv2.VideoWriter(os.path.join(self.config['savedir'], self.experiment, f"video_flir_{self.cam_id}.mp4"), self.vid_cod, self.args.videowrite_fps,
         #                             (self.cam['options']['Width'], self.cam['options']['Height']))
-        self.write_frames = True
-        self.frame_write_queue = Queue()
-        self.fram_writer_future = self.frame_writer()
-    
-    @threaded
-    def frame_writer(self):
-        while self.write_frames:
-            if self.frame_write_queue.empty():
-                continue
-            self.avi_recorder.Append(self.frame_write_queue.get_nowait())
-        
-        while not self.frame_write_queue.empty():
-            self.avi_recorder.Append(self.frame_write_queue.get_nowait())
+        self.frame_writer = FrameWriter(self.camname, self.append_frame, self.logger,
+                                        spill_path=os.path.join(self.config['savedir'], self.experiment, f"spill_{self.camname}.npy"),
+                                        frame_pool=self.frame_pool, **writer_options(self.config, self.cam))
+
+    def append_frame(self, frame, info=None):
+        # frames are queued as numpy arrays so that they can be spilled to disk
+        height, width = frame.shape[:2]
+        self.avi_recorder.Append(PySpin.Image.Create(width, height, 0, 0, PySpin.PixelFormat_Mono8, frame))
 
     def save_vid_metadata(self, metadata=None):
-        if metadata is not None:
-            with open(os.path.join(self.config['savedir'], self.experiment, f'metadata_{self.camname}.json'), 'w') as file:
-                json.dump(metadata, file)
-        # self.writer_obj.release()
-        self.avi_recorder.Close()
-
-    # def compute_timestamp_offset(self):
-    #     self.camera.TimestampLatch.Execute()
-    #     self.timestamp_offset = time.perf_counter() - self.camera.TimestampLatchValue.GetValue()*1e-9 - self.start_t
-            
-    def get_n_frames(self, n_frames, timeout_time=1000, report_period=10):
+        super().save_vid_metadata(metadata)
+        if self.avi_recorder is not None:
+            self.avi_recorder.Close()
 
-        # print(f"Started cam {self.name} acquisition")
-        self.logger.info(f"{self.camname}: Started acquisition.")
-        self.start_timer = time.perf_counter()
+    def latch_timestamp(self):
+        self.camera.TimestampLatch.Execute()
+        return self.camera.TimestampLatchValue.GetValue()
 
+    def start_acquisition(self, n_frames=None):
         self.camera.BeginAcquisition()
 
+    def end_acquisition(self):
         try:
-            metadata = {}
-            prev_timestamp = None
-
-            while self.camera.IsStreaming():
-            # while self.nframes < n_frames:
-            #     self.camera.BeginAcquisition()
-
-                if self.nframes == 0:
-                    elapsed_time = 0
-                    self.frame_timer = time.perf_counter()
-
-                if self.nframes % round(report_period * self.cam['options']['AcquisitionFrameRate']) == 0:
-                    # print("[fps %.2f] grabbing (%ith frame) | elapsed %.2f" % (self.cam['options']['AcquisitionFrameRate'], self.nframes, elapsed_time))
-                    self.logger.info("%s: [fps %.2f] grabbing (%ith frame) | elapsed %.2f" % (self.camname, self.cam['options']['AcquisitionFrameRate'], self.nframes, elapsed_time))
-
-                image_result = self.camera.GetNextImage(timeout_time) # timeout_time == buffer size, for the arg name consistency
-
-                #  Ensure image completion
-                if image_result.IsIncomplete():
-                    self.logger.info(f'{self.camname}: incomplete with image status %d ...' % image_result.GetImageStatus())
-                    continue
-                else:
-                    if self.nframes == 0:
-                        init_time_stamp = image_result.GetTimeStamp()
-                    last_time_stamp = image_result.GetTimeStamp()
-
-                    frame = image_result.GetNDArray()
-                    self.last_frame = frame.copy()
-
-                    self.nframes += 1
-                    # if self.nframes % self.cam['options']['AcquisitionFrameRate'] == 0:
-                        # print(f'Frame: {self.nframes} / {n_frames}')
-                        # self.logger.info(f'Frame: {self.nframes} / {n_frames}')
-                    
-                    if self.save:
-                        self.frame_write_queue.put_nowait(self.processor.Convert(image_result, PySpin.PixelFormat_Mono8))
-
-                    if self.predict:
-                        self.predictor.frame = frame
-                        self.predictor.n_frame = self.nframes
-                        self.predictor.get_random_prediction()
-
-                    if self.preview:
-                        # self.vid_show.n_frame = self.nframes
-                        # # self.vid_show.frame = frame.copy()
-                        # if not self.vid_show.queue.full():
-                        #     # print(f'{self.camname} frame: {frame.shape}')
-                        #     self.vid_show.queue.put_nowait(frame.copy())
-                        #     # self.vid_show.queue.put_nowait(np.ascontiguousarray(frame.copy()))
-
-                        self.vid_show.update(frame.copy())
-                        # if not self.display_manager.displays[self.camname]['queue'].full():
-                        #     self.display_manager.displays[self.camname]['queue'].put_nowait(frame.copy())
-                        # self.display_manager.update_frame(self.camname, frame.copy())
-
-                        # self.vid_show.frame = np.expand_dims(frame.copy(), -1)
-                        # print(f'fsum: {np.sum(self.vid_show.frame)}')
-                        if self.preview_predict:
-                            self.vid_show.pred_result = self.predictor.pred_result
-
-
-                    metadata[image_result.GetFrameID() + 1] = {}
-                    metadata[image_result.GetFrameID() + 1]['frame_ID'] = image_result.GetID()
-                    metadata[image_result.GetFrameID() + 1]['date_time_stamp'] = datetime.now().strftime("%Y%m%d_%H_%M_%S.%f")  # microsec precision
-                    metadata[image_result.GetFrameID() + 1]['fps'] = self.cam['options']['AcquisitionFrameRate'] if prev_timestamp is None else 1e9 / (last_time_stamp - prev_timestamp) 
-                    metadata[image_result.GetFrameID() + 1]['frame_number'] = self.nframes + 1
-                    metadata[image_result.GetFrameID() + 1]['time_stamp_w_offset'] = (last_time_stamp + init_time_stamp) * 1e-9
-                    metadata[image_result.GetFrameID() + 1]['cam_clock_time_stamp'] = last_time_stamp      
-
-                    prev_timestamp = last_time_stamp
-
-                    image_result.Release()
-
-                    elapsed_time = time.perf_counter() - self.frame_timer
-                    if self.nframes >= n_frames:
-                        if self.preview:
-                            self.vid_show.stop()
-                        self.logger.info(f"{self.camname}: Breaking...")
-                        # print("Breaking...")
-                        break
-
-                    # if self.cam['options']['AcquisitionMode'] == 'SingleFrame':
-                    #     self.camera.EndAcquisition()
-                    #     self.camera.BeginAcquisition()
-
-        except KeyboardInterrupt:
-            self.logger.info(f"{self.camname}: Keyboard interrupt detected.")
-
-        finally:
             self.camera.EndAcquisition()
-            self.logger.info(f'{self.camname}: Ended acquisition.')
-            self.logger.info(f'{self.camname}: Elapsed time (time.perf_counter()) for processing {self.nframes} frames at {self.cam["options"]["AcquisitionFrameRate"]} FPS: {time.perf_counter() - self.frame_timer} sec.')
-            self.logger.info(f'{self.camname}: Time difference (grabResult.TimeStamp) between the first and the last frame timestamp: {(last_time_stamp - init_time_stamp) * 1e-9} sec.')
-            if self.preview:
-                self.vid_show.stop()
-            if self.predict:
-                self.predictor.stop()
-            if self.save:
-                self.logger.info(f'{self.camname}: Saving queued frames...')
-                self.write_frames = False
-                self.fram_writer_future.result()
-                self.save_vid_metadata(metadata)
-                self.logger.info(f'{self.camname}: Finished saving queued frames.')
-            
+        except (PySpin.SpinnakerException, AttributeError) as e:
+            # the camera was lost and could not be reconnected
+            self.logger.info(f"{self.camname}: Could not end acquisition: {e}")
+
+    def is_grabbing(self, supervisor=None):
+        # a lost camera may stop streaming, it is reconnected if supervised
+        return supervisor is not None or self.camera.IsStreaming()
+
+    def is_removed(self):
+        return not self.camera.IsStreaming()
+
+    def retrieve(self, timeout_time):
+        # raises on a grab timeout as well
+        return self.camera.GetNextImage(timeout_time) # timeout_time == buffer size, for the arg name consistency
+
+    def read_frame(self, image_result):
+        #  Ensure image completion
+        if image_result.IsIncomplete():
+            self.logger.info(f'{self.camname}: incomplete with image status %d ...' % image_result.GetImageStatus())
+            return None
+        # the image number counts the grabbed images from 1, like Basler's ImageNumber
+        return GrabbedFrame(image_result.GetFrameID() + 1, self.nframes + 1, image_result.GetTimeStamp(),
+                            image_result.GetFrameID(), 0)
+
+    def put_frame(self, image_result):
+        # GetNDArray() is a view of the camera buffer, so it is copied into the pool before Release()
+        if image_result.GetPixelFormat() == PySpin.PixelFormat_Mono8:
+            frame = image_result.GetNDArray()
+        else:
+            frame = self.processor.Convert(image_result, PySpin.PixelFormat_Mono8).GetNDArray()
+        return self.frame_pool.put(frame, self.n_consumers, timeout=self.pool_timeout)
+
+    def release(self, image_result):
+        image_result.Release()
+
 
 class AviType:
     """'Enum' to select AVI video type to be created and saved"""
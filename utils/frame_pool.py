@@ -0,0 +1,150 @@
+import cv2
+import threading
+import numpy as np
+from collections import deque
+
+DEFAULT_N_SLOTS = 64
+# slots held outside the writer queue: the preview's latest and displayed frames, the predictor's
+# pending and in-flight frames, and the frame in the grab loop plus a few in the writer's hands
+RESERVED_SLOTS = 12
+
+# number of channels, dtype and cv2 code to convert to BGR for the pixel formats we record
+# note: OpenCV names Bayer patterns after the second row, i.e. GenICam BayerRG (RGGB) is cv2's BayerBG
+PIXEL_FORMATS = {
+    'Mono8': (1, np.uint8, cv2.COLOR_GRAY2BGR),
+    'Mono10': (1, np.uint16, cv2.COLOR_GRAY2BGR),
+    'Mono12': (1, np.uint16, cv2.COLOR_GRAY2BGR),
+    'Mono16': (1, np.uint16, cv2.COLOR_GRAY2BGR),
+    'BayerRG8': (1, np.uint8, cv2.COLOR_BayerBG2BGR),
+    'BayerBG8': (1, np.uint8, cv2.COLOR_BayerRG2BGR),
+    'BayerGR8': (1, np.uint8, cv2.COLOR_BayerGB2BGR),
+    'BayerGB8': (1, np.uint8, cv2.COLOR_BayerGR2BGR),
+    'BGR8': (3, np.uint8, None),
+    'RGB8': (3, np.uint8, cv2.COLOR_RGB2BGR),
+}
+# formats that are kept as the camera's native buffer, without an ImageFormatConverter
+NATIVE_PIXEL_FORMATS = ['Mono8', 'BayerRG8', 'BayerBG8', 'BayerGR8', 'BayerGB8']
+
+
+def frame_pool_options(config, cam):
+    """ Returns frame pool options from the top-level `frame_pool` section of the config,
+    overridden by the camera's own `frame_pool` section if present.
+    """
+    options = {'n_slots': DEFAULT_N_SLOTS}
+    options.update(config.get('frame_pool') or {})
+    options.update(cam.get('frame_pool') or {})
+    return options
+
+
+def max_queue_size(n_slots):
+    """ Largest writer queue that fits in a pool of `n_slots` next to the reserved slots, so that the queue
+    fills up (and the writer's overflow policy engages) before the pool runs out of slots.
+    """
+    return max(1, int(n_slots) - RESERVED_SLOTS)
+
+
+def pool_pixel_format(cam):
+    """ Pixel format a camera's frames are pooled in. Basler Mono8 and Bayer frames are kept native,
+    other formats are converted to BGR8. FLIR frames are converted to Mono8.
+    """
+    if cam['type'] == 'FLIR':
+        return 'Mono8'
+    pixel_format = cam['options'].get('PixelFormat', 'Mono8')
+    return pixel_format if pixel_format in NATIVE_PIXEL_FORMATS else 'BGR8'
+
+
+def frame_shape(options, pixel_format=None):
+    """ Returns (shape, dtype) of a frame from the Width/Height/PixelFormat camera options.
+    `pixel_format` overrides options['PixelFormat'], e.g. when frames are converted before pooling.
+    """
+    pixel_format = pixel_format or options.get('PixelFormat', 'Mono8')
+    if pixel_format not in PIXEL_FORMATS:
+        raise ValueError(f'Unsupported pixel format for the frame pool: {pixel_format}')
+    channels, dtype, _ = PIXEL_FORMATS[pixel_format]
+    shape = (int(options['Height']), int(options['Width']))
+    if channels > 1:
+        shape += (channels,)
+    return shape, dtype
+
+
+class FramePool():
+    """ Fixed-size ring of pre-allocated frame slots shared by the frame consumers.
+
+    put() copies a grabbed frame into the oldest free slot and sets the slot's reference count
+    to the number of consumers it is handed to (writer, preview, predictor). Consumers only pass
+    the slot index around and call release(slot) when done; the slot goes back to the ring once
+    every consumer released it.
+    Slots hold frames in `pixel_format`; consumers that need color call bgr(slot), which converts
+    the slot once and caches the result until the slot is released.
+    """
+
+    def __init__(self, name, shape, dtype=np.uint8, n_slots=DEFAULT_N_SLOTS, pixel_format='Mono8') -> None:
+        self.name = name
+        self.pixel_format = pixel_format
+        self.bgr_code = PIXEL_FORMATS[pixel_format][2]
+        self.bgr_cache = {}
+        self.bgr_lock = threading.Lock()
+        self.n_slots = int(n_slots)
+        self.frames = np.empty((self.n_slots, *shape), dtype=dtype)
+        # written once so that the pages are mapped before acquisition starts, not on the first frames
+        self.frames.fill(0)
+        self.refcounts = [0] * self.n_slots
+        self.free_slots = deque(range(self.n_slots))
+        self.cond = threading.Condition()
+        self.n_exhausted = 0
+
+    def __getitem__(self, slot):
+        return self.frames[slot]
+
+    def acquire(self, n_refs, timeout=None):
+        """ Takes a free slot with `n_refs` references. Waits up to `timeout` sec (forever if None)
+        for a slot to be released, returns None if the pool is still exhausted.
+        """
+        with self.cond:
+            if not self.free_slots:
+                self.cond.wait_for(lambda: self.free_slots, timeout=timeout)
+                if not self.free_slots:
+                    self.n_exhausted += 1
+                    return None
+            slot = self.free_slots.popleft()
+            self.refcounts[slot] = n_refs
+        return slot
+
+    def put(self, frame, n_refs, timeout=None):
+        """ Copies `frame` into a free slot and returns the slot index, or None if none is free. """
+        slot = self.acquire(n_refs, timeout=timeout)
+        if slot is not None:
+            np.copyto(self.frames[slot], frame.reshape(self.frames.shape[1:]))
+        return slot
+
+    def bgr(self, slot):
+        """ Returns the frame in the slot as BGR, converting it at most once per grabbed frame.
+        The returned array is shared between consumers and must not be modified.
+        """
+        if self.bgr_code is None:
+            return self.frames[slot]
+        with self.bgr_lock:
+            frame = self.bgr_cache.get(slot)
+        if frame is None:
+            frame = cv2.cvtColor(self.frames[slot], self.bgr_code)
+            with self.bgr_lock:
+                frame = self.bgr_cache.setdefault(slot, frame)
+        return frame
+
+    def retain(self, slot, n_refs=1):
+        with self.cond:
+            self.refcounts[slot] += n_refs
+
+    def release(self, slot):
+        with self.cond:
+            self.refcounts[slot] -= 1
+            if self.refcounts[slot] == 0:
+                with self.bgr_lock:
+                    self.bgr_cache.pop(slot, None)
+                self.free_slots.append(slot)
+                self.cond.notify()
+            elif self.refcounts[slot] < 0:
+                raise ValueError(f'{self.name}: slot {slot} released more times than it was referenced.')
+
+    def n_free(self):
+        return len(self.free_slots)
@@ -0,0 +1,120 @@
+import numpy as np
+from utils.metadata import ColumnarWriter
+
+# one row per detected gap, written to dropped_frames_<camname>
+GAP_DTYPE = np.dtype([('frame_number', np.int64),       # camera frame counter of the first frame after the gap
+                      ('prev_frame_number', np.int64),  # ... and of the last frame before it
+                      ('n_missing', np.int64),          # estimated number of missing frames
+                      ('n_skipped', np.int64),          # images the SDK reported as skipped
+                      ('interval_ns', np.int64),        # camera clock time between the two frames
+                      ('grab_index', np.int64)])        # number of frames grabbed before the gap
+
+
+def gap_options(config, cam):
+    """ Returns gap detector options from the top-level `gaps` section of the config,
+    overridden by the camera's own `gaps` section if present.
+    """
+    options = {'tolerance': 0.5, 'placeholders': False, 'max_placeholders': 1000}
+    options.update(config.get('gaps') or {})
+    options.update(cam.get('gaps') or {})
+    return options
+
+
+class GapDetector():
+    """ Detects dropped frames from consecutive camera frame counters and timestamps.
+
+    A gap is flagged if the frame counter jumps by more than 1, the SDK reports skipped images, or
+    the camera clock interval exceeds the expected 1/fps period by more than `tolerance` periods.
+    Each gap is appended to a table at `path` (see utils/metadata.py) if given. Grabbed frames that were
+    not recorded (no free frame pool slot, or dropped by the writer) are counted separately, see unrecorded().
+    """
+
+    def __init__(self, name, fps, logger, path=None, tolerance=0.5, placeholders=False, max_placeholders=1000) -> None:
+        self.name = name
+        self.logger = logger
+        self.period_ns = 1e9 / fps
+        self.tolerance = tolerance
+        # insert blank frames for missing ones, so that the video frame index follows the trigger index
+        self.placeholders = placeholders
+        self.max_placeholders = max_placeholders
+        self.table = ColumnarWriter(path, GAP_DTYPE, chunk_size=64) if path is not None else None
+        self.prev_frame_number = None
+        self.prev_time_stamp = None
+        self.n_restart_missing = 0
+        # unrecorded frames not yet replaced by placeholders
+        self.n_pending_unrecorded = 0
+
+        # counters
+        self.n_gaps = 0
+        self.n_missing = 0
+        self.n_id_gaps = 0
+        self.n_time_gaps = 0
+        self.n_skipped = 0
+        self.n_unrecorded = 0
+
+    def check(self, frame_number, time_stamp, grab_index, n_skipped=0):
+        """ Checks a grabbed frame (camera frame counter, camera clock timestamp in ns) against the
+        previous one. Returns the estimated number of frames missing before it.
+        """
+        frame_number, time_stamp = int(frame_number), int(time_stamp)
+        if self.prev_frame_number is None:
+            self.prev_frame_number, self.prev_time_stamp = frame_number, time_stamp
+            n_missing, self.n_restart_missing = self.n_restart_missing, 0
+            return n_missing
+
+        id_missing = frame_number - self.prev_frame_number - 1
+        interval = time_stamp - self.prev_time_stamp
+        time_missing = 0
+        if interval > (1 + self.tolerance) * self.period_ns:
+            time_missing = int(round(interval / self.period_ns)) - 1
+        n_missing = max(id_missing, time_missing, n_skipped)
+
+        if n_missing > 0:
+            self.n_gaps += 1
+            self.n_missing += n_missing
+            self.n_id_gaps += id_missing > 0
+            self.n_time_gaps += time_missing > 0
+            self.n_skipped += n_skipped
+            if self.table is not None:
+                self.table.append((frame_number, self.prev_frame_number, n_missing, n_skipped, interval, grab_index))
+            if self.n_gaps <= 10 or self.n_gaps % 100 == 0:
+                self.logger.info(f'{self.name}: {n_missing} frame(s) missing between frame {self.prev_frame_number} and {frame_number} '
+                                 f'({interval * 1e-6:.2f} ms) | {self.report()}')
+
+        self.prev_frame_number, self.prev_time_stamp = frame_number, time_stamp
+        return max(n_missing, 0)
+
+    def restart(self, n_missing, grab_index):
+        """ Counts the frames missed while the camera was reconnected, they are returned by check() for the next
+        frame. The camera's frame counter and clock may have been reset, so that frame starts a new sequence.
+        """
+        if n_missing > 0:
+            self.n_gaps += 1
+            self.n_missing += n_missing
+            if self.table is not None:
+                self.table.append((-1, self.prev_frame_number if self.prev_frame_number is not None else -1,
+                                   n_missing, 0, -1, grab_index))
+        self.prev_frame_number, self.prev_time_stamp = None, None
+        self.n_restart_missing = n_missing
+
+    def unrecorded(self, frame_number, grab_index):
+        """ Counts a grabbed frame that was left out of the video and the metadata. It was grabbed, so it is not
+        missing (the trigger index does not skip it), but it is replaced by a placeholder with the next recorded frame.
+        """
+        self.n_unrecorded += 1
+        self.n_pending_unrecorded += 1
+        if self.n_unrecorded <= 10 or self.n_unrecorded % 100 == 0:
+            self.logger.info(f'{self.name}: frame {int(frame_number)} (grab {grab_index}) not recorded | {self.report()}')
+
+    def n_placeholders(self, n_missing):
+        """ Number of placeholders to write before the next recorded frame, for `n_missing` frames and the unrecorded ones. """
+        n_missing, self.n_pending_unrecorded = n_missing + self.n_pending_unrecorded, 0
+        return min(n_missing, self.max_placeholders) if self.placeholders else 0
+
+    def report(self):
+        return (f'missing: {self.n_missing} in {self.n_gaps} gaps (frame counter: {self.n_id_gaps}, '
+                f'timestamp: {self.n_time_gaps}), skipped: {self.n_skipped}, not recorded: {self.n_unrecorded}')
+
+    def close(self):
+        if self.table is not None:
+            self.table.close()
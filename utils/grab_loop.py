@@ -0,0 +1,316 @@
+import os
+import time
+import numpy as np
+from collections import namedtuple
+from utils.helpers import str_to_bool
+from utils.preview import VideoShow2
+from utils.prediction import Predictor, prediction_options
+from utils.writer import FrameWriter, FrameInfo, writer_options
+from utils.recorders import make_recorder, segment_frames
+from utils.metadata import ColumnarWriter, FRAME_METADATA_DTYPE
+from utils.gaps import GapDetector, gap_options
+from utils.sync import ClockSync, sync_options
+from utils.reconnect import ReconnectSupervisor, reconnect_options, split_recording
+from utils.frame_pool import FramePool, frame_pool_options, frame_shape
+
+# what the grab loop reads from a grab result: frame_id and image_number go to the metadata (image_number counts
+# the grabbed images from 1), block_id is the camera's frame counter and n_skipped the images the SDK reported as
+# skipped, both for the gap detector; time_stamp is the camera clock (ns)
+GrabbedFrame = namedtuple('GrabbedFrame', ['frame_id', 'image_number', 'time_stamp', 'block_id', 'n_skipped'])
+
+
+class GrabLoop():
+    """ Acquisition loop shared by the Basler, FLIR and Simulated cameras: frame pool, writer, predictor, preview,
+    metadata, gap detection, clock sync, synchronizer and reconnects. The camera classes only talk to their SDK:
+
+    start_acquisition(n_frames), end_acquisition() and is_grabbing(supervisor) start, stop and check the stream,
+    retrieve(timeout_time) returns the next grab result (None on timeout), read_frame(result) a GrabbedFrame (None
+    if the grab failed), put_frame(result) copies it into a frame pool slot and release(result) gives the buffer back.
+    is_removed(), latch_timestamp() and reopen() are used to detect and recover a lost camera.
+    Once the camera is set up, init_consumers() creates the frame pool, predictor, preview and video writer
+    for frames in `pool_pixel_format`.
+    """
+
+    # default grab timeout (ms) of get_n_frames()
+    grab_timeout_ms = 2000
+
+    def start_acquisition(self, n_frames=None):
+        raise NotImplementedError
+
+    def end_acquisition(self):
+        pass
+
+    def wait_for_frames(self):
+        """ Called once before the loop, e.g. to wait for the first grab result. """
+        pass
+
+    def is_grabbing(self, supervisor=None):
+        return True
+
+    def retrieve(self, timeout_time):
+        raise NotImplementedError
+
+    def read_frame(self, result):
+        raise NotImplementedError
+
+    def put_frame(self, result):
+        raise NotImplementedError
+
+    def release(self, result):
+        pass
+
+    def is_removed(self):
+        return False
+
+    def get_n_frames(self, n_frames, timeout_time=None, report_period=10):
+        """ Grabs n_frames frames, or until stop_event is set if n_frames is None. """
+        timeout_time = self.grab_timeout_ms if timeout_time is None else timeout_time
+        self.start_acquisition(n_frames)
+
+        # print(f"Started cam {self.name} acquisition")
+        self.logger.info(f"{self.camname}: Started acquisition")
+        self.start_timer = time.perf_counter()
+
+        metadata = self.open_metadata() if self.save else None
+        gaps = self.open_gap_detector()
+        supervisor = self.open_supervisor()
+        # set before the first frame, for the report at the end if none arrives
+        self.frame_timer = self.start_timer
+        init_time_stamp = last_time_stamp = 0
+        elapsed_time = 0
+
+        try:
+            self.wait_for_frames()
+
+            # a lost camera may stop grabbing, it is reopened if supervised
+            while self.is_grabbing(supervisor):
+                if self.stop_requested():
+                    self.logger.info(f"{self.camname}: Stop requested, breaking...")
+                    break
+
+                if self.nframes == 0:
+                    elapsed_time = 0
+                    self.frame_timer = time.perf_counter()
+
+                if self.nframes % round(report_period * self.cam['options']['AcquisitionFrameRate']) == 0:
+                    self.logger.info("%s: [fps %.2f] grabbing (%ith frame) | elapsed %.2f" % (self.camname, self.cam['options']['AcquisitionFrameRate'], self.nframes, elapsed_time))
+                    if self.save:
+                        self.logger.info(f"{self.camname}: writer queue | {self.frame_writer.report()}")
+                    if self.frame_pool is not None and self.frame_pool.n_exhausted:
+                        self.logger.info(f"{self.camname}: frame pool exhausted {self.frame_pool.n_exhausted} times")
+                    if self.latency.enabled:
+                        self.logger.info(f"{self.camname}: {self.latency.report()}")
+                    if gaps.n_gaps:
+                        self.logger.info(f"{self.camname}: dropped frames | {gaps.report()}")
+
+                self.latency.start()
+                grab_error = None
+                try:
+                    image_result = self.retrieve(timeout_time)
+                except Exception as e:
+                    # e.g. the camera was removed
+                    if supervisor is None:
+                        raise
+                    grab_error, image_result = e, None
+                self.latency.lap('retrieve')
+                if image_result is None:
+                    if supervisor is not None and supervisor.lost(self.is_removed, self.latch_timestamp):
+                        if grab_error is not None:
+                            self.logger.info(f"{self.camname}: grab failed: {grab_error}")
+                        if not self.recover(supervisor, n_frames):
+                            break
+                    elif grab_error is None and int(elapsed_time) % 5 == 0:
+                        self.logger.info(f"{self.camname}:... waiting frame")
+                    continue
+
+                grabbed = self.read_frame(image_result)
+                if grabbed is None:
+                    self.release(image_result)
+                    continue
+
+                if self.nframes == 0:
+                    init_time_stamp = grabbed.time_stamp
+                last_time_stamp = grabbed.time_stamp
+                self.nframes += 1
+
+                slot = None
+                if self.frame_pool is not None:
+                    slot = self.put_frame(image_result)
+                self.latency.lap('convert')
+
+                info = FrameInfo(grabbed.frame_id, grabbed.image_number, grabbed.time_stamp,
+                                 self.clock.to_host(grabbed.time_stamp))
+                if supervisor is not None and supervisor.outage is not None:
+                    # first frame after a reconnect, the frames missed in between are returned by gaps.check()
+                    gaps.restart(supervisor.resume(info.time_stamp_w_offset), self.nframes - 1)
+                n_missing = gaps.check(grabbed.block_id, grabbed.time_stamp, self.nframes - 1, n_skipped=grabbed.n_skipped)
+                if self.save and slot is not None:
+                    self.put_placeholders(gaps.n_placeholders(n_missing), metadata)
+                if self.synchronizer is not None:
+                    # the trigger index counts the dropped frames as well
+                    self.synchronizer.update(self.camname, info, self.nframes - 1 + gaps.n_missing)
+                self.latency.lap('bookkeeping')
+
+                recorded = False
+                if self.save and slot is not None:
+                    recorded = self.frame_writer.put(slot, info)
+                    self.latency.lap('writer_put')
+                if self.save and not recorded:
+                    # no free frame pool slot, or dropped by the writer: its metadata row is left out as well
+                    gaps.unrecorded(grabbed.block_id, self.nframes - 1)
+
+                if self.predict and slot is not None:
+                    self.predictor.update(slot, self.nframes, info.frame_id, info.time_stamp_w_offset)
+                    self.latency.lap('predictor')
+
+                if self.preview and slot is not None:
+                    self.vid_show.update(slot)
+                    if self.preview_predict:
+                        self.vid_show.pred_result = self.predictor.pred_result
+                    self.latency.lap('preview')
+
+                if recorded:
+                    metadata.append((*info, time.time()))
+                if supervisor is not None:
+                    supervisor.frame(info.frame_id, info.time_stamp_w_offset)
+
+                self.release(image_result)
+                self.latency.end()
+
+                elapsed_time = time.perf_counter() - self.frame_timer
+                if n_frames is not None and self.nframes >= n_frames:
+                    if self.preview:
+                        self.vid_show.stop()
+                    self.logger.info(f"{self.camname}: Breaking...")
+                    break
+
+        except KeyboardInterrupt:
+            self.logger.info(f"{self.camname}: Keyboard interrupt detected.")
+
+        finally:
+            self.end_acquisition()
+            self.logger.info(f'{self.camname}: Ended acquisition.')
+            self.logger.info(f'{self.camname}: Elapsed time (time.perf_counter()) for processing {self.nframes} frames at {self.cam["options"]["AcquisitionFrameRate"]} FPS: {time.perf_counter() - self.frame_timer} sec.')
+            self.logger.info(f'{self.camname}: Time difference (camera timestamp) between the first and the last frame timestamp: {(last_time_stamp - init_time_stamp) * 1e-9} sec.')
+            if self.preview:
+                self.vid_show.stop()
+            if self.predict:
+                self.predictor.stop()
+            gaps.close()
+            if supervisor is not None:
+                self.logger.info(f"{self.camname}: reconnects | {supervisor.report()}")
+                supervisor.close()
+            self.logger.info(f"{self.camname}: camera clock drift {self.clock.drift_ppm():.2f} ppm")
+            self.logger.info(f"{self.camname}: dropped frames | {gaps.report()}")
+            if self.latency.enabled:
+                self.logger.info(f"{self.camname}: {self.latency.report()}")
+                if self.save:
+                    self.latency.save(os.path.join(self.config['savedir'], self.experiment, f'latency_{self.camname}.json'))
+            if self.save:
+                self.logger.info(f'{self.camname}: Saving queued frames...')
+                self.frame_writer.close()
+                self.save_vid_metadata(metadata)
+                self.logger.info(f'{self.camname}: Finished saving queued frames | {self.frame_writer.report()}')
+
+    def init_consumers(self):
+        # grabbed frames are copied once into a pre-allocated slot and handed to the consumers by index
+        self.n_consumers = int(self.save) + int(self.preview) + int(self.predict)
+        if self.n_consumers > 0:
+            if self.frame_pool is None:
+                shape, dtype = frame_shape(self.cam['options'], pixel_format=self.pool_pixel_format)
+                self.frame_pool = FramePool(self.camname, shape, dtype, pixel_format=self.pool_pixel_format,
+                                            **frame_pool_options(self.config, self.cam))
+            # with the block policy, wait for the writer to free a slot instead of losing the frame
+            block = self.save and writer_options(self.config, self.cam)['overflow_policy'] == 'block'
+            self.pool_timeout = None if block else 0
+            # written in place of dropped frames, see put_placeholders()
+            self.placeholder_frame = np.zeros_like(self.frame_pool[0])
+
+        if self.predict:
+            save_dir = os.path.join(self.config['savedir'], self.experiment) if self.save else None
+            self.predictor = Predictor(self.logger, self.args.model_path, save_dir=save_dir, frame_pool=self.frame_pool,
+                                       name=self.camname, options=prediction_options(self.config, self.cam),
+                                       engine=self.inference_engine)
+            if self.closed_loop is not None:
+                self.predictor.on_prediction.append(self.closed_loop.callback(self.camname))
+
+        if self.preview:
+            self.vid_show = VideoShow2(self.camname, self.preview_predict, pred_preview_button=self.cam['pred_preview_toggle_button'],
+                                       display_manager=self.display_manager, frame_pool=self.frame_pool)
+            if self.vid_show.show_pred:
+                self.vid_show.pred_result = self.predictor.pred_result
+
+        if self.save:
+            self.init_video_writer()
+
+    def stop_requested(self):
+        return self.stop_event is not None and self.stop_event.is_set()
+
+    def init_video_writer(self):
+        if self.frame_writer is not None:
+            return
+        # Mono8 frames are encoded as single-channel video, lossless formats keep the native Mono8/Bayer frames
+        self.writer_obj = make_recorder(self.args.movie_format, os.path.join(self.config['savedir'], self.experiment, f"video_{self.camname}"),
+                                        self.args.videowrite_fps, self.cam['options']['Width'], self.cam['options']['Height'],
+                                        self.record_color, self.config, self.cam, pixel_format=self.pool_pixel_format,
+                                        nframes_per_file=segment_frames(self.args, self.cam))
+        self.frame_writer = FrameWriter(self.camname, self.writer_obj.write, self.logger,
+                                        spill_path=os.path.join(self.config['savedir'], self.experiment, f"spill_{self.camname}.npy"),
+                                        frame_pool=self.frame_pool, color=self.record_color and not self.writer_obj.native,
+                                        **writer_options(self.config, self.cam))
+
+    def open_metadata(self):
+        """ Per-frame metadata is streamed to metadata_<camname>.bin during acquisition, see utils/metadata.py. """
+        return ColumnarWriter(os.path.join(self.config['savedir'], self.experiment, f'metadata_{self.camname}'), FRAME_METADATA_DTYPE)
+
+    def save_vid_metadata(self, metadata=None):
+        if metadata is not None:
+            metadata.close()
+        if self.writer_obj is not None:
+            self.writer_obj.release()
+
+    def open_gap_detector(self):
+        path = os.path.join(self.config['savedir'], self.experiment, f'dropped_frames_{self.camname}') if self.save else None
+        return GapDetector(self.camname, self.cam['options']['AcquisitionFrameRate'], self.logger, path=path,
+                           **gap_options(self.config, self.cam))
+
+    def put_placeholders(self, n_placeholders, metadata=None):
+        """ Writes blank frames in place of missing ones, with frame_id -1 in their metadata. """
+        placeholder = FrameInfo(-1, -1, -1, np.nan)
+        for _ in range(n_placeholders):
+            slot = self.frame_pool.put(self.placeholder_frame, 1, timeout=self.pool_timeout)
+            if slot is None:
+                break
+            self.frame_writer.put(slot, placeholder)
+            if metadata is not None:
+                metadata.append((*placeholder, time.time()))
+
+    def start_clock_sync(self):
+        """ Latches the camera clock now and periodically during acquisition, to convert frame timestamps to host time. """
+        path = os.path.join(self.config['savedir'], self.experiment, f'clock_{self.camname}') if self.save else None
+        self.clock = ClockSync(self.camname, self.latch_timestamp, self.start_t, self.logger,
+                               period=sync_options(self.config, self.args)['relatch_period'], path=path)
+        self.clock.start()
+
+    def open_supervisor(self):
+        """ ReconnectSupervisor of the camera if enabled in the `reconnect` section of the config, see utils/reconnect.py. """
+        options = reconnect_options(self.config, self.cam)
+        if not options.pop('enabled'):
+            return None
+        path = os.path.join(self.config['savedir'], self.experiment, f'outages_{self.camname}') if self.save else None
+        return ReconnectSupervisor(self.camname, self.cam['options']['AcquisitionFrameRate'], self.logger, path=path,
+                                   triggered=self.triggered(), stop_event=self.stop_event, **options)
+
+    def triggered(self):
+        return str_to_bool(self.args.trigger_with_arduino)
+
+    def recover(self, supervisor, n_frames=None):
+        """ Reopens a lost camera and resumes grabbing the remaining frames in a new video segment, once the
+        frames grabbed before are written. Returns False if the camera could not be reopened.
+        """
+        if not supervisor.recover(self.reopen, self.nframes):
+            return False
+        if self.save:
+            supervisor.outage['segment'] = split_recording(self.frame_writer, self.writer_obj)
+        self.start_acquisition(None if n_frames is None else n_frames - self.nframes)
+        return True
@@ -0,0 +1,104 @@
+import json
+import time
+import numpy as np
+
+# stages of a grab loop iteration, in order
+GRAB_STAGES = ['retrieve', 'convert', 'bookkeeping', 'writer_put', 'predictor', 'preview', 'frame']
+PERCENTILES = [50, 90, 99, 99.9]
+
+
+class LatencyHistogram():
+    """ HDR-style histogram of durations in nanoseconds: log2 buckets, each split into 64 linear
+    sub-buckets, i.e. values are recorded with <1.6% error from 1 ns to hours in a fixed array.
+    """
+    SUB_BITS = 7
+    SUB_HALF = 1 << (SUB_BITS - 1)
+
+    def __init__(self) -> None:
+        self.counts = np.zeros(self.SUB_HALF * (64 - self.SUB_BITS) + 2 * self.SUB_HALF, dtype=np.int64)
+        self.n = 0
+        self.max = 0
+
+    def index(self, value):
+        shift = value.bit_length() - self.SUB_BITS
+        if shift <= 0:
+            return value
+        return shift * self.SUB_HALF + (value >> shift)
+
+    def bucket_value(self, index):
+        """ Lowest value of a bucket. """
+        if index < 2 * self.SUB_HALF:
+            return index
+        shift = index // self.SUB_HALF - 1
+        return (index - shift * self.SUB_HALF) << shift
+
+    def record(self, value):
+        value = max(int(value), 0)
+        self.counts[self.index(value)] += 1
+        self.n += 1
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        if self.n == 0:
+            return 0
+        index = int(np.searchsorted(np.cumsum(self.counts), q / 100 * self.n))
+        return min(self.bucket_value(index), self.max)
+
+    def summary(self):
+        """ Count, percentiles and max in ms. """
+        summary = {'count': self.n}
+        summary.update({f'p{q:g}': self.percentile(q) * 1e-6 for q in PERCENTILES})
+        summary['max'] = self.max * 1e-6
+        return summary
+
+
+class LatencyMonitor():
+    """ Per-stage latency histograms of a grab loop (opt-in with --latency_stats).
+
+    The loop calls start() before waiting for a frame and lap(stage) after each stage; lap records the
+    time since the previous start()/lap() in the stage's histogram. With enabled=False both are no-ops.
+    """
+
+    def __init__(self, name, stages=GRAB_STAGES, enabled=True) -> None:
+        self.name = name
+        self.enabled = enabled
+        self.histograms = {stage: LatencyHistogram() for stage in stages}
+        self.frame_start = 0
+        self.last = 0
+
+    def start(self):
+        if not self.enabled:
+            return
+        self.frame_start = self.last = time.perf_counter_ns()
+
+    def lap(self, stage):
+        if not self.enabled:
+            return
+        now = time.perf_counter_ns()
+        self.histograms[stage].record(now - self.last)
+        self.last = now
+
+    def end(self):
+        """ Records the whole iteration in the `frame` stage. """
+        if not self.enabled:
+            return
+        self.histograms['frame'].record(time.perf_counter_ns() - self.frame_start)
+
+    def report(self):
+        parts = []
+        for stage, histogram in self.histograms.items():
+            if histogram.n:
+                summary = histogram.summary()
+                parts.append(f"{stage} p50 {summary['p50']:.3f} / p99 {summary['p99']:.3f} / max {summary['max']:.3f}")
+        return 'latency (ms) | ' + ', '.join(parts)
+
+    def save(self, path):
+        """ Writes the summaries and the non-empty buckets ({lowest value in ns: count}) of each stage. """
+        results = {}
+        for stage, histogram in self.histograms.items():
+            nonzero = np.flatnonzero(histogram.counts)
+            results[stage] = histogram.summary()
+            results[stage]['buckets_ns'] = {int(histogram.bucket_value(i)): int(histogram.counts[i]) for i in nonzero}
+        with open(path, 'w') as file:
+            json.dump(results, file, indent=1)
@@ -0,0 +1,55 @@
+import json
+import numpy as np
+from utils.writer import FRAME_INFO_DTYPE
+
+DEFAULT_CHUNK_SIZE = 1024  # rows written to disk at a time, ~8.5 sec at 120 FPS
+
+# one row per grabbed frame: FrameInfo fields and the host wall-clock time (time.time()) of the grab
+FRAME_METADATA_DTYPE = np.dtype(FRAME_INFO_DTYPE.descr + [('host_time', np.float64)])
+
+
+class ColumnarWriter():
+    """ Append-only store of fixed-size records.
+
+    Rows are collected in a pre-allocated structured array and appended to `<path>.bin` one chunk
+    at a time, so at most one chunk is lost if acquisition crashes. The dtype is saved in
+    `<path>.dtype.json`; load the rows back with load_columns(path).
+    """
+
+    def __init__(self, path, dtype, chunk_size=DEFAULT_CHUNK_SIZE) -> None:
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.buffer = np.zeros(int(chunk_size), dtype=self.dtype)
+        self.n_buffered = 0
+        self.n_rows = 0
+        with open(path + '.dtype.json', 'w') as file:
+            json.dump({'dtype': self.dtype.descr}, file)
+        self.file = open(path + '.bin', 'wb')
+
+    def append(self, row):
+        """ Appends a row given as a tuple in the order of the dtype's fields. """
+        self.buffer[self.n_buffered] = row
+        self.n_buffered += 1
+        self.n_rows += 1
+        if self.n_buffered == len(self.buffer):
+            self.flush()
+
+    def flush(self):
+        self.file.write(self.buffer[:self.n_buffered].data)
+        self.file.flush()
+        self.n_buffered = 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def load_columns(path):
+    """ Loads the rows of a ColumnarWriter as a structured array, e.g. load_columns('<path>/metadata_<camname>')['cam_clock_time_stamp'].
+    A partially written last row (e.g. after a crash) is ignored.
+    """
+    with open(path + '.dtype.json') as file:
+        dtype = np.dtype([tuple(field) for field in json.load(file)['dtype']])
+    data = np.fromfile(path + '.bin', dtype=np.uint8)
+    n_rows = len(data) // dtype.itemsize
+    return data[:n_rows * dtype.itemsize].view(dtype)
@@ -0,0 +1,390 @@
+import os
+import cv2
+import time
+import signal
+import logging
+import threading
+import numpy as np
+import multiprocessing as mp
+from queue import Full
+from multiprocessing import shared_memory
+from utils.helpers import str_to_bool
+from utils.session import acquisition_frames
+from utils.writer import FrameInfo
+from utils.sync import SyncQueue
+from utils.preview import DisplayManager, preview_options
+from utils.writer import FrameWriter, writer_options
+from utils.recorders import make_recorder, segment_frames
+from utils.reconnect import split_recording
+from utils.frame_pool import FramePool, PIXEL_FORMATS, DEFAULT_N_SLOTS, frame_pool_options, frame_shape, pool_pixel_format
+
+# sent to the writer process in place of a frame descriptor to start a new video segment
+SPLIT = 'split'
+
+
+class SharedFramePool(FramePool):
+    """ FramePool whose slots and reference counts live in a shared memory block, so that frames
+    grabbed in a camera process can be read by the writer and display processes without copying.
+
+    The pool is handed to the other processes as a Process argument; unpickling re-attaches to the
+    shared memory block by name. Slot bookkeeping uses a process-shared lock and semaphore.
+    """
+
+    def __init__(self, name, shape, dtype=np.uint8, n_slots=DEFAULT_N_SLOTS, pixel_format='Mono8', ctx=None) -> None:
+        ctx = ctx or mp.get_context()
+        self.name = name
+        self.pixel_format = pixel_format
+        self.bgr_code = PIXEL_FORMATS[pixel_format][2]
+        self.n_slots = int(n_slots)
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        frames_nbytes = self.n_slots * int(np.prod(self.shape)) * self.dtype.itemsize
+        # frames followed by one int32 reference count per slot
+        self.shm = shared_memory.SharedMemory(create=True, size=frames_nbytes + self.n_slots * 4)
+        self.owner = True
+        self.lock = ctx.Lock()
+        self.free_sem = ctx.Semaphore(self.n_slots)
+        self.cursor = ctx.RawValue('i', 0)  # guarded by self.lock
+        self.exhausted = ctx.Value('i', 0)
+        self.attach()
+        # written once so that the pages are mapped before acquisition starts, not on the first frames
+        self.frames.fill(0)
+
+    def attach(self):
+        self.frames = np.ndarray((self.n_slots, *self.shape), dtype=self.dtype, buffer=self.shm.buf)
+        self.refcounts = np.ndarray((self.n_slots,), dtype=np.int32, buffer=self.shm.buf, offset=self.frames.nbytes)
+        # BGR conversions are cached per process
+        self.bgr_cache = {}
+        self.bgr_lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ['shm', 'frames', 'refcounts', 'bgr_cache', 'bgr_lock']:
+            del state[key]
+        state['shm_name'] = self.shm.name
+        state['owner'] = False
+        return state
+
+    def __setstate__(self, state):
+        shm_name = state.pop('shm_name')
+        self.__dict__.update(state)
+        self.shm = shared_memory.SharedMemory(name=shm_name)
+        self.attach()
+
+    @property
+    def n_exhausted(self):
+        return self.exhausted.value
+
+    def acquire(self, n_refs, timeout=None):
+        if not self.free_sem.acquire(timeout=timeout):
+            with self.exhausted.get_lock():
+                self.exhausted.value += 1
+            return None
+        with self.lock:
+            # the semaphore guarantees a free slot, take the next one in ring order
+            slot = self.cursor.value
+            while self.refcounts[slot] != 0:
+                slot = (slot + 1) % self.n_slots
+            self.refcounts[slot] = n_refs
+            self.cursor.value = (slot + 1) % self.n_slots
+        return slot
+
+    def retain(self, slot, n_refs=1):
+        with self.lock:
+            self.refcounts[slot] += n_refs
+
+    def release(self, slot):
+        with self.lock:
+            self.refcounts[slot] -= 1
+            count = int(self.refcounts[slot])
+        # every process holds at most one reference to a slot, so its cached conversion is stale from now on
+        with self.bgr_lock:
+            self.bgr_cache.pop(slot, None)
+        if count == 0:
+            self.free_sem.release()
+        elif count < 0:
+            raise ValueError(f'{self.name}: slot {slot} released more times than it was referenced.')
+
+    def n_free(self):
+        with self.lock:
+            return int(np.count_nonzero(self.refcounts == 0))
+
+    def close(self):
+        del self.frames, self.refcounts
+        self.bgr_cache.clear()
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class FrameDescriptorQueue():
+    """ Stand-in for FrameWriter in a camera process: sends (slot, FrameInfo) descriptors to the writer process.
+
+    The `block` and `drop` overflow policies are applied here, on a queue of `queue_size` descriptors, so that the
+    grab loop knows which frames are dropped (see GrabLoop.get_n_frames). With `spill`, the queue is unbounded and
+    the writer process spills the overflowing frames.
+    """
+
+    def __init__(self, name, queue, frame_pool=None, overflow_policy='block') -> None:
+        self.name = name
+        self.queue = queue
+        self.frame_pool = frame_pool
+        self.overflow_policy = overflow_policy
+
+        # counters
+        self.n_put = 0
+        self.n_dropped = 0
+        self.n_blocked = 0
+
+    def put(self, slot, info=None):
+        """ Returns False if the frame was dropped. """
+        try:
+            self.queue.put_nowait((slot, info))
+        except Full:
+            if self.overflow_policy == 'drop':
+                self.n_dropped += 1
+                if self.frame_pool is not None:
+                    self.frame_pool.release(slot)
+                return False
+            self.n_blocked += 1
+            self.queue.put((slot, info))
+        self.n_put += 1
+        return True
+
+    def split(self):
+        """ Asks the writer process for a new video segment after the frames sent so far. """
+        self.queue.put(SPLIT)
+
+    def close(self):
+        self.queue.put(None)
+
+    def report(self):
+        return f'sent: {self.n_put}, pending: {self.queue.qsize()}, dropped: {self.n_dropped}, blocked: {self.n_blocked}'
+
+
+class RemoteDisplayManager():
+    """ Stand-in for DisplayManager in a camera process: sends (camname, slot, predictions) to the display process,
+    at most `fps` times per second; the other frames are released right away.
+    """
+
+    def __init__(self, queue, frame_pool, fps=None) -> None:
+        self.queue = queue
+        self.frame_pool = frame_pool
+        self.min_interval = 1 / fps if fps else 0
+        self.last_sent = 0
+        self.display_thread = None  # the display loop runs in the display process
+
+    def add_display(self, name, width=500, height=500, pred_preview_button=None, frame_pool=None):
+        pass
+
+    def update_frame(self, name, frame, pred_result=None):
+        now = time.perf_counter()
+        if now - self.last_sent < self.min_interval:
+            self.frame_pool.release(frame)
+            return
+        try:
+            self.queue.put_nowait((name, frame, pred_result))
+            self.last_sent = now
+        except Full:
+            # the display process is behind, skip this frame
+            self.frame_pool.release(frame)
+
+    def start(self):
+        pass
+
+    def stop(self, window_name=None):
+        pass
+
+
+def setup_logging(log_file=None):
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger("logger")
+    if log_file is not None:
+        file_handler = logging.FileHandler(log_file)
+        file_handler.setLevel(logging.INFO)
+        file_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+        logger.addHandler(file_handler)
+    return logger
+
+
+def camera_process(camera_item, frame_pool, writer_queue, display_queue, stop_event=None, sync_queue=None, log_file=None, report_period=10):
+    # only the camera processes load the camera SDKs
+    from utils.devices import create_device
+
+    logger = setup_logging(log_file)
+    config, camname, cam, args, experiment, start_t = camera_item
+    logger.info(f"\n{camname}: Initializing Loop in process {os.getpid()}...\n")
+
+    frame_writer = None
+    if writer_queue is not None:
+        frame_writer = FrameDescriptorQueue(camname, writer_queue, frame_pool=frame_pool,
+                                            overflow_policy=writer_options(config, cam)['overflow_policy'])
+    display_manager = RemoteDisplayManager(display_queue, frame_pool, fps=preview_options(config)['fps']) if display_queue is not None else None
+    synchronizer = SyncQueue(sync_queue) if sync_queue is not None else None
+    device = create_device(args, cam, camname, experiment, config, start_t, logger,
+                           display_manager=display_manager, frame_pool=frame_pool, frame_writer=frame_writer,
+                           stop_event=stop_event, synchronizer=synchronizer)
+    try:
+        device.get_n_frames(acquisition_frames(args), report_period=report_period)
+    except KeyboardInterrupt:
+        logger.info(f"{camname}: Aborted in camera process")
+    finally:
+        device.close()
+        logger.info(f"{camname}: Exited.")
+
+
+def writer_process(camname, cam, config, args, experiment, frame_pool, writer_queue, log_file=None):
+    # keep writing the queued frames on Ctrl+C, the camera process sends the sentinel when it stops
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logger = setup_logging(log_file)
+
+    record_color = not frame_pool.pixel_format.startswith('Mono')
+    writer_obj = make_recorder(args.movie_format, os.path.join(config['savedir'], experiment, f"video_{camname}"),
+                               args.videowrite_fps, cam['options']['Width'], cam['options']['Height'],
+                               record_color, config, cam, pixel_format=frame_pool.pixel_format,
+                               nframes_per_file=segment_frames(args, cam))
+    # frames wait or are dropped in the descriptor queue (see FrameDescriptorQueue), which is the writer queue
+    # here unless spilling, so that at most writer.queue_size frames are in flight
+    options = writer_options(config, cam)
+    if options['overflow_policy'] != 'spill':
+        options.update(overflow_policy='block', queue_size=2)
+    frame_writer = FrameWriter(camname, writer_obj.write, logger,
+                               spill_path=os.path.join(config['savedir'], experiment, f"spill_{camname}.npy"),
+                               frame_pool=frame_pool, color=record_color and not writer_obj.native, **options)
+    while True:
+        descriptor = writer_queue.get()
+        if descriptor is None:
+            break
+        if descriptor == SPLIT:
+            split_recording(frame_writer, writer_obj)
+            continue
+        frame_writer.put(*descriptor)
+
+    frame_writer.close()
+    writer_obj.release()
+    logger.info(f'{camname}: Writer process finished | {frame_writer.report()}')
+
+
+def display_process(frame_pools, display_queue, options, log_file=None):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    setup_logging(log_file)
+
+    display_manager = DisplayManager(**options)
+    for name, frame_pool in frame_pools.items():
+        display_manager.add_display(name, frame_pool=frame_pool)
+    display_manager.start()
+
+    while True:
+        descriptor = display_queue.get()
+        if descriptor is None:
+            break
+        display_manager.update_frame(*descriptor)
+    display_manager.stop()
+
+
+class MultiProcessAcquisition():
+    """ Runs every camera's grab loop in its own process.
+
+    Frames stay in one SharedFramePool per camera; the writer process of each camera and the single
+    display process only receive small descriptors (slot index, FrameInfo) over queues.
+    """
+
+    def __init__(self, tuple_list, logger, log_file=None, report_period=10, synchronizer=None) -> None:
+        self.logger = logger
+        # spawn, so that no camera SDK state is inherited from the main process
+        self.ctx = mp.get_context('spawn')
+        self.frame_pools = []
+        self.camera_processes = []
+        self.writer_processes = []
+        self.writer_queues = []
+        self.display_proc = None
+        self.display_queue = self.ctx.Queue(maxsize=4 * len(tuple_list))
+        # stops all camera processes, e.g. in continuous mode
+        self.stop_event = self.ctx.Event()
+        # frame descriptors for the FrameSynchronizer, which runs in a thread of the main process
+        self.synchronizer = synchronizer
+        self.sync_queue = self.ctx.Queue() if synchronizer is not None else None
+        self.sync_thread = None
+        display_pools = {}
+
+        # each camera process enumerates the devices on its own, so they can only be told apart by serial
+        types = [cam['type'] for _, _, cam, *_ in tuple_list if cam['type'] != 'Simulated']
+        for _, camname, cam, *_ in tuple_list:
+            if cam.get('serial') is None and types.count(cam['type']) > 1:
+                raise ValueError(f"{camname}: set the `serial` of each {cam['type']} camera in the config to use --process_mode process")
+
+        for config, camname, cam, args, experiment, start_t, _, _ in tuple_list:
+            save = str_to_bool(args.save)
+            if args.videowrite_fps is None:
+                args.videowrite_fps = cam['options']['AcquisitionFrameRate']
+
+            frame_pool = None
+            if save or cam['preview'] or cam['predict']:
+                pixel_format = pool_pixel_format(cam)
+                shape, dtype = frame_shape(cam['options'], pixel_format=pixel_format)
+                frame_pool = SharedFramePool(camname, shape, dtype, pixel_format=pixel_format, ctx=self.ctx,
+                                             **frame_pool_options(config, cam))
+                self.frame_pools.append(frame_pool)
+
+            writer_queue = None
+            if save:
+                # bounded, so that the camera process waits or drops frames when the writer falls behind
+                options = writer_options(config, cam)
+                writer_queue = self.ctx.Queue(maxsize=0 if options['overflow_policy'] == 'spill' else options['queue_size'])
+            display_queue = self.display_queue if cam['preview'] else None
+            self.camera_processes.append(self.ctx.Process(
+                target=camera_process, name=f'{camname}_camera',
+                args=((config, camname, cam, args, experiment, start_t), frame_pool, writer_queue, display_queue,
+                      self.stop_event, self.sync_queue, log_file, report_period)))
+
+            if save:
+                self.writer_queues.append(writer_queue)
+                self.writer_processes.append(self.ctx.Process(
+                    target=writer_process, name=f'{camname}_writer',
+                    args=(camname, cam, config, args, experiment, frame_pool, writer_queue, log_file)))
+            else:
+                self.writer_queues.append(None)
+            if cam['preview']:
+                display_pools[camname] = frame_pool
+
+        if display_pools:
+            self.display_proc = self.ctx.Process(target=display_process, name='display',
+                                                 args=(display_pools, self.display_queue, preview_options(config), log_file))
+
+    def sync_loop(self):
+        while True:
+            item = self.sync_queue.get()
+            if item is None:
+                break
+            camname, info, trigger_index = item
+            self.synchronizer.update(camname, FrameInfo(*info), trigger_index)
+
+    def start(self):
+        if self.synchronizer is not None:
+            self.sync_thread = threading.Thread(target=self.sync_loop, name='sync', daemon=True)
+            self.sync_thread.start()
+        for process in self.writer_processes:
+            process.start()
+        if self.display_proc is not None:
+            self.display_proc.start()
+        for process in self.camera_processes:
+            process.start()
+        self.logger.info(f'Started {len(self.camera_processes)} camera processes.')
+
+    def join(self):
+        for process, writer_queue in zip(self.camera_processes, self.writer_queues):
+            process.join()
+            if process.exitcode != 0:
+                self.logger.info(f'{process.name}: exited with code {process.exitcode}')
+                if writer_queue is not None:
+                    writer_queue.put(None)  # the camera process could not stop its writer
+        for process in self.writer_processes:
+            process.join()
+        if self.sync_thread is not None:
+            self.sync_queue.put(None)
+            self.sync_thread.join()
+        if self.display_proc is not None:
+            self.display_queue.put(None)
+            self.display_proc.join()
+        for frame_pool in self.frame_pools:
+            frame_pool.close()
@@ -97,6 +97,13 @@ def print_value(nodemap, nodename):
     else:
         print(nodename, typestring, nodeval.GetValue())
 
+def get_value(nodemap, nodename):
+    """ Current value of a node, the symbolic name of the entry for enumerations. """
+    nodeval, typestring = get_nodeval_and_type(nodemap.GetNode(nodename))
+    if typestring == 'enum':
+        return nodeval.GetCurrentEntry().GetSymbolic()
+    return nodeval.GetValue()
+
 def get_nodeval_and_type(node):
     nodetype = node.GetPrincipalInterfaceType()
     if nodetype== PySpin.intfIString:
@@ -1,75 +1,438 @@
 import os
+import cv2
 import time
+import queue
+import threading
 import numpy as np
-from threading import Thread
-from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple
+from utils.latency import LatencyHistogram
+from utils.metadata import ColumnarWriter, load_columns
 
-tp = ThreadPoolExecutor(5)  # max 10 threads
+RUNNERS = ['auto', 'random', 'onnx', 'torchscript']
+TORCHSCRIPT_EXTENSIONS = ['.pt', '.pth', '.ts', '.torchscript']
+
+# one inference result: time_stamp is the frame's host time (FrameInfo.time_stamp_w_offset, nan if unknown),
+# keypoints of shape (animals x keypoints x (x, y, confidence)) in frame pixels, latency is the time from
+# the grab loop handing over the frame to the result (sec)
+Prediction = namedtuple('Prediction', ['frame_id', 'n_frame', 'time_stamp', 'keypoints', 'latency'])
+
+
+def prediction_dtype(keypoints_shape):
+    """ Row of a predictions file, the fields of a Prediction: the frame's FrameInfo.frame_id, grab number and
+    host time, its (animals x keypoints x (x, y, confidence)) keypoints and the inference latency (sec).
+    """
+    return np.dtype([('frame_id', np.int64), ('n_frame', np.int64), ('time_stamp', np.float64),
+                     ('keypoints', np.float32, tuple(keypoints_shape)), ('latency', np.float64)])
+
+
+def prediction_options(config, cam=None):
+    """ Returns predictor options from the top-level `prediction` section of the config,
+    overridden by the camera's own `prediction` section if present.
+    """
+    options = {'runner': 'auto', 'threads': 2, 'input_size': None, 'channels': None,
+               'batch': False, 'max_batch': 4, 'batch_wait': 0.002, 'n_animals': 4}
+    options.update(config.get('prediction') or {})
+    if cam is not None:
+        options.update(cam.get('prediction') or {})
+    return options
+
+
+def preprocess(frame, input_size, channels):
+    """ Resizes a frame to the model input size (width, height) and returns a float32 (channels x H x W)
+    array in [0, 1], with the (x, y) scale from input to frame pixels.
+    """
+    height, width = frame.shape[:2]
+    if (width, height) != tuple(input_size):
+        frame = cv2.resize(frame, tuple(input_size), interpolation=cv2.INTER_AREA)
+    if frame.ndim == 2:
+        frame = frame[:, :, None]
+    if channels == 3 and frame.shape[2] == 1:
+        frame = np.repeat(frame, 3, axis=2)
+    elif channels == 1 and frame.shape[2] == 3:
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)[:, :, None]
+    inputs = np.ascontiguousarray(frame.transpose(2, 0, 1), dtype=np.float32)
+    inputs *= 1 / 255
+    return inputs, (width / input_size[0], height / input_size[1])
+
+
+class RandomRunner():
+    """ Stand-in model without a model file: random head, wing and leg keypoints of `n_animals` animals. """
+
+    def __init__(self, n_animals=4, **kwargs) -> None:
+        self.n_animals = n_animals
+        self.batch_size = None
+
+    def prepare(self, frame):
+        return np.array(frame.shape[:2]), (1.0, 1.0)
+
+    def run(self, inputs):
+        offsets = np.array([[-40, 0], [0, 20], [0, -20], [40, 15], [40, -15]])  # head, lwing, rwing, lleg, rleg
+        results = np.ones((len(inputs), self.n_animals, len(offsets), 3), dtype=np.float32)
+        for result, (height, width) in zip(results, inputs):
+            centers = np.random.randint(50, max(51, min(width, height) - 50), size=(self.n_animals, 1, 2))
+            result[..., :2] = centers + offsets
+        return results
+
+
+class ONNXRunner():
+    """ ONNX Runtime model on the CPU, with a (N x C x H x W) float input. """
+
+    def __init__(self, model_path, threads=2, input_size=None, channels=None, **kwargs) -> None:
+        import onnxruntime as ort
+        session_options = ort.SessionOptions()
+        session_options.intra_op_num_threads = threads
+        session_options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(model_path, session_options, providers=['CPUExecutionProvider'])
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        # dimensions are ints if fixed, names or None if dynamic
+        n, c, h, w = [dim if isinstance(dim, int) else None for dim in model_input.shape]
+        self.batch_size = n
+        self.channels = channels or c or 1
+        self.input_size = input_size or (w, h)
+        if None in self.input_size:
+            raise ValueError(f'{model_path} has a dynamic input size, set prediction.input_size in the config')
+
+    def prepare(self, frame):
+        return preprocess(frame, self.input_size, self.channels)
+
+    def run(self, inputs):
+        return self.session.run(None, {self.input_name: inputs})[0]
+
+
+class TorchScriptRunner():
+    """ TorchScript model on the CPU, with a (N x C x H x W) float input. """
+
+    def __init__(self, model_path, threads=2, input_size=None, channels=None, **kwargs) -> None:
+        import torch
+        if input_size is None:
+            raise ValueError('Set prediction.input_size in the config for TorchScript models')
+        torch.set_num_threads(threads)
+        self.torch = torch
+        self.model = torch.jit.load(model_path, map_location='cpu').eval()
+        self.batch_size = None
+        self.channels = channels or 1
+        self.input_size = input_size
+
+    def prepare(self, frame):
+        return preprocess(frame, self.input_size, self.channels)
+
+    def run(self, inputs):
+        with self.torch.inference_mode():
+            outputs = self.model(self.torch.from_numpy(inputs))
+        if isinstance(outputs, (tuple, list)):
+            outputs = outputs[0]
+        return outputs.numpy()
+
+
+def make_runner(model_path='', runner='auto', **options):
+    """ Creates the model runner: `random` without a model_path, otherwise `onnx` for .onnx files and
+    `torchscript` for .pt/.pth/.ts/.torchscript files unless `runner` is given. Models return keypoints
+    as (N x animals x keypoints x (x, y, confidence)) or (N x keypoints x 3) in input pixels.
+    """
+    if runner not in RUNNERS:
+        raise ValueError(f'Invalid prediction runner: {runner}, choose one of {RUNNERS}')
+    if runner == 'auto':
+        extension = os.path.splitext(model_path)[1].lower()
+        if model_path == '':
+            runner = 'random'
+        elif extension == '.onnx':
+            runner = 'onnx'
+        elif extension in TORCHSCRIPT_EXTENSIONS:
+            runner = 'torchscript'
+        else:
+            raise ValueError(f'Cannot infer the runner of {model_path}, set prediction.runner in the config')
+    if runner == 'random':
+        return RandomRunner(**options)
+    if runner == 'onnx':
+        return ONNXRunner(model_path, **options)
+    return TorchScriptRunner(model_path, **options)
+
+
+class PredictionWriter():
+    """ Streams Predictions to `<path>.bin` (a ColumnarWriter table, see utils/metadata.py) from a
+    background thread. The table is created with the keypoint shape of the first prediction; if the
+    queue is full, predictions are dropped (and counted) rather than stalling inference.
+    """
+
+    def __init__(self, name, path, logger, chunk_size=256, queue_size=1024) -> None:
+        self.name = name
+        self.path = path
+        self.logger = logger
+        self.chunk_size = chunk_size
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.table = None
+        self.n_dropped = 0
+        self.thread = threading.Thread(target=self.run, name=f'{name}_predictions', daemon=True)
+        self.thread.start()
+
+    def put(self, prediction):
+        try:
+            self.queue.put_nowait(prediction)
+        except queue.Full:
+            self.n_dropped += 1
+
+    def run(self):
+        while True:
+            prediction = self.queue.get()
+            if prediction is None:
+                break
+            if self.table is None:
+                self.table = ColumnarWriter(self.path, prediction_dtype(prediction.keypoints.shape), chunk_size=self.chunk_size)
+            elif prediction.keypoints.shape != self.table.dtype['keypoints'].shape:
+                self.n_dropped += 1
+                continue
+            self.table.append(tuple(prediction))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        n_rows = 0
+        if self.table is not None:
+            self.table.close()
+            n_rows = self.table.n_rows
+        self.logger.info(f'{self.name}: saved {n_rows} predictions to {self.path}.bin (dropped: {self.n_dropped})')
+
+
+def load_predictions(path, frame_ids=None):
+    """ Loads a PredictionWriter table as (keypoints, table). keypoints is a (frames x animals x keypoints x 3) array;
+    with `frame_ids`, e.g. load_columns('<path>/metadata_<camname>')['frame_id'], it has one row per given frame
+    (nan for frames without a prediction), aligned with the video metadata.
+    """
+    table = load_columns(path)
+    if frame_ids is None:
+        return table['keypoints'], table
+    frame_ids = np.asarray(frame_ids)
+    keypoints = np.full((len(frame_ids), *table.dtype['keypoints'].shape), np.nan, dtype=np.float32)
+    if len(table):
+        # frames predicted more than once (none in practice) keep their last prediction
+        order = np.argsort(table['frame_id'], kind='stable')
+        ids = table['frame_id'][order]
+        positions = np.clip(np.searchsorted(ids, frame_ids, side='right') - 1, 0, len(ids) - 1)
+        found = ids[positions] == frame_ids
+        keypoints[found] = table['keypoints'][order[positions[found]]]
+    return keypoints, table
+
+
+class InferenceEngine():
+    """ Runs a model on the latest frame of each attached Predictor, in a single thread.
+
+    The thread sleeps until a predictor has a new frame, takes the newest frame of every predictor
+    that has one (at most `max_batch`) and runs them through the model as one batch. With more than
+    one predictor (micro-batching across cameras, `prediction.batch`), it waits up to `batch_wait` sec
+    for the other cameras' frames of the same trigger before running the batch.
+    """
+
+    def __init__(self, runner, logger, max_batch=4, batch_wait=0.002) -> None:
+        self.runner = runner
+        self.logger = logger
+        self.max_batch = max_batch
+        self.batch_wait = batch_wait
+        self.predictors = []
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.thread = None
+
+        # counters
+        self.n_batches = 0
+        self.n_inferred = 0
+
+    def add(self, predictor):
+        with self.condition:
+            self.predictors.append(predictor)
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='inference', daemon=True)
+            self.thread.start()
+
+    def remove(self, predictor):
+        with self.condition:
+            if predictor in self.predictors:
+                self.predictors.remove(predictor)
+
+    def notify(self):
+        with self.condition:
+            self.condition.notify()
+
+    def ready(self):
+        return [predictor for predictor in self.predictors if predictor.pending]
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.stopped or self.ready())
+                if self.stopped:
+                    break
+                if len(self.predictors) > 1 and self.batch_wait:
+                    self.condition.wait_for(lambda: self.stopped or len(self.ready()) == len(self.predictors),
+                                            timeout=self.batch_wait)
+                ready = self.ready()[:self.max_batch]
+            try:
+                self.infer(ready)
+            except Exception as e:
+                self.logger.info(f'Inference failed: {e}')
+                time.sleep(0.1)
+
+    def infer(self, predictors):
+        items = [item for item in (predictor.take() for predictor in predictors) if item is not None]
+        if not items:
+            return
+        inputs = np.stack([item[1] for item in items])
+        outputs = self.run_batch(inputs)
+        if outputs.ndim == 3:
+            outputs = outputs[:, None]  # single animal
+        for (predictor, _, scale, frame_id, n_frame, time_stamp, t_update), keypoints in zip(items, outputs):
+            keypoints = np.array(keypoints, dtype=np.float32)
+            keypoints[..., 0] *= scale[0]
+            keypoints[..., 1] *= scale[1]
+            predictor.set_result(Prediction(frame_id, n_frame, time_stamp, keypoints, time.perf_counter() - t_update))
+        self.n_batches += 1
+        self.n_inferred += len(items)
+
+    def run_batch(self, inputs):
+        """ Runs the model, in chunks zero-padded to its batch size if the model has a fixed one. """
+        batch_size = self.runner.batch_size
+        if batch_size is None or batch_size == len(inputs):
+            return self.runner.run(inputs)
+        outputs = []
+        for start in range(0, len(inputs), batch_size):
+            chunk = inputs[start:start + batch_size]
+            n = len(chunk)
+            if n < batch_size:
+                chunk = np.concatenate([chunk, np.zeros((batch_size - n, *chunk.shape[1:]), dtype=chunk.dtype)])
+            outputs.append(self.runner.run(chunk)[:n])
+        return np.concatenate(outputs)
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+        self.logger.info(f'Inference engine | batches: {self.n_batches}, frames: {self.n_inferred}')
+
+
+def make_engine(logger, model_path='', options=None):
+    """ Creates an InferenceEngine and its model runner from prediction_options(). """
+    options = dict(options or {})
+    max_batch, batch_wait = options.pop('max_batch'), options.pop('batch_wait')
+    options.pop('batch')
+    runner = make_runner(model_path, **options)
+    logger.info(f'Prediction runner: {type(runner).__name__}' + (f' ({model_path})' if model_path else ''))
+    return InferenceEngine(runner, logger, max_batch=max_batch, batch_wait=batch_wait)
 
-def threaded(fn):
-    def wrapper(*args, **kwargs):
-        return tp.submit(fn, *args, **kwargs)  # returns Future object
-    return wrapper
 
 class Predictor():
-    def __init__(self, logger, model_path='', save_dir=None):
+    """ Hands the latest frame of a camera to an InferenceEngine and keeps the latest Prediction.
+
+    The grab loop calls update() with a frame pool slot; the slot is held until the engine takes it,
+    and replaced (released without inference) if a newer frame arrives first, so inference never works
+    on stale frames. `engine` is a shared engine (micro-batching across cameras); without it, the
+    predictor runs its own engine. Callbacks in `on_prediction` are called with every Prediction; with
+    `save_dir`, predictions are saved to `<save_dir>/predictions_<name>` (see PredictionWriter).
+    """
+
+    def __init__(self, logger, model_path='', save_dir=None, frame_pool=None, name='', options=None, engine=None):
+        self.name = name
         self.n_frame = 0
-        self.prev_n_frame = 0
-        self.frame = None
-        self.pred_result = None
+        self.frame_id = None
+        self.time_stamp = np.nan
+        self.frame_pool = frame_pool
+        self.slot = None  # frame pool slot (or frame without a pool) waiting for inference
+        self.slot_lock = threading.Lock()
+        self.t_update = None
+        self.prediction = None
+        self.on_prediction = []
         self.save_dir = save_dir
         self.model_path = model_path
         self.stopped = False
         self.logger = logger
-        self.get_random_prediction()
+        self.latency = LatencyHistogram()
+        self.writer = None
+        if self.save_dir is not None:
+            self.writer = PredictionWriter(name, os.path.join(save_dir, f'predictions_{name}'), logger)
+            self.on_prediction.append(self.writer.put)
+
+        # counters
+        self.n_updates = 0
+        self.n_stale = 0
 
         if self.model_path == '':
-            self.logger.info('model_path is not provided, making random predictions')
-            # print('model_path is not provided, drawing making predictions')
-        else:
-            self.load_model()
-
-    def start(self):        
-        # Thread(target=self.predict, args=()).start()
-        self.predict()
-        return self
-    
-    @threaded
-    def get_random_prediction(self):
-        # self.pred_result = np.random.randint(100, 500, size=(3, 5, 2))
-        centers = np.random.randint(100, 1000, size=(4, 2))
-        pos = [[[center[0] - 40, center[1]], # head
-                [center[0], center[1] + 20], # lwing
-                [center[0], center[1] - 20], # rwing
-                [center[0] + 40, center[1] + 15], # lleg
-                [center[0] + 40, center[1] - 15]] # rleg
-                for center in centers]
-        self.pred_result = pos
-        time.sleep(0.01)
-        # self.pred_result = np.array([[[10, 20], [30, 40], [50, 60], [70, 80], [90, 100]],
-        #                              [[200, 220], [210, 230], [240, 250], [250, 240], [270, 270]]])
-    
-    @threaded
-    def predict(self):
-        # os.sched_setaffinity(0, [5, 6, 7, 8])
-        while not self.stopped:
-            # make prediction for only new frames
-            if self.n_frame != self.prev_n_frame:
-                if self.model_path == '':
-                    self.get_random_prediction()
-                else:
-                    raise NotImplementedError
-                
-                self.prev_n_frame = self.n_frame
-        
-    def load_model(self):
-        # load model
-        pass
+            self.logger.info(f'{self.name}: model_path is not provided, making random predictions')
+        self.own_engine = engine is None
+        self.engine = make_engine(logger, model_path, options or prediction_options({})) if engine is None else engine
+        self.engine.add(self)
+
+    @property
+    def pred_result(self):
+        """ Keypoints of the latest prediction, None before the first one. """
+        return None if self.prediction is None else self.prediction.keypoints
+
+    @property
+    def pending(self):
+        return self.slot is not None
+
+    def update(self, slot, n_frame, frame_id=None, time_stamp=np.nan):
+        """ Takes a reference to the latest frame pool slot, releasing the previous one if it was not inferred yet.
+        frame_id and time_stamp (host time) of the frame are passed on to its Prediction.
+        """
+        with self.slot_lock:
+            if self.slot is not None:
+                self.n_stale += 1
+                if self.frame_pool is not None:
+                    self.frame_pool.release(self.slot)
+            self.slot = slot
+            self.n_frame = n_frame
+            self.frame_id = frame_id
+            self.time_stamp = time_stamp
+            self.t_update = time.perf_counter()
+            self.n_updates += 1
+        self.engine.notify()
+
+    def take(self):
+        """ Prepares the pending frame for the model and releases its slot.
+        Returns (predictor, model input, scale, frame_id, n_frame, time_stamp, t_update), or None.
+        """
+        with self.slot_lock:
+            if self.slot is None:
+                return None
+            slot, frame_id, n_frame, time_stamp, t_update = self.slot, self.frame_id, self.n_frame, self.time_stamp, self.t_update
+            self.slot = None
+        try:
+            frame = self.frame_pool[slot] if self.frame_pool is not None else slot
+            inputs, scale = self.engine.runner.prepare(frame)
+        finally:
+            if self.frame_pool is not None:
+                self.frame_pool.release(slot)
+        return self, inputs, scale, frame_id, n_frame, time_stamp, t_update
+
+    def set_result(self, prediction):
+        self.prediction = prediction
+        self.latency.record(prediction.latency * 1e9)
+        for callback in self.on_prediction:
+            callback(prediction)
+
+    def report(self):
+        summary = self.latency.summary()
+        return (f"predictions: {summary['count']} of {self.n_updates} frames (stale: {self.n_stale}), "
+                f"latency (ms) p50 {summary['p50']:.2f} / p99 {summary['p99']:.2f} / max {summary['max']:.2f}")
 
-    def save_predictions(self):
-        pass
-    
     def stop(self):
+        if self.stopped:
+            return
         self.stopped = True
+        self.engine.remove(self)
+        if self.own_engine:
+            self.engine.stop()
+        with self.slot_lock:
+            if self.slot is not None:
+                if self.frame_pool is not None:
+                    self.frame_pool.release(self.slot)
+                self.slot = None
+        self.logger.info(f'{self.name}: {self.report()}')
+        self.save_predictions()
 
-
+    def save_predictions(self):
+        """ Writes the remaining predictions and closes the predictions file. """
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
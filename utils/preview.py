@@ -1,12 +1,18 @@
 import os
+import math
 import time
 import cv2
-from pynput import keyboard
+import numpy as np
 from threading import Thread
 from queue import LifoQueue, Queue
 import threading
 from concurrent.futures import ThreadPoolExecutor
 
+try:
+    from pynput import keyboard
+except ImportError:
+    keyboard = None  # no X display (e.g., headless benchmarks with simulated cameras), previews without key toggles
+
 tp = ThreadPoolExecutor(50)  # max 10 threads
 
 def threaded(fn):
@@ -18,13 +24,33 @@ def non_blocking_wait(delay=1):
     time.sleep(delay / 1000.0)
     return -1  # Simulate "no key pressed"
 
+DEFAULT_PREVIEW_FPS = 30
+
+
+def preview_options(config):
+    """ Returns preview options from the `preview` section of the config. """
+    options = {'fps': DEFAULT_PREVIEW_FPS, 'mosaic': False, 'tile_width': 480, 'tile_height': 360, 'columns': 0}
+    options.update(config.get('preview') or {})
+    return options
+
+
 class DisplayManager:
-    """Centralized display manager for multiple camera streams"""
-    def __init__(self):
+    """Centralized display manager for multiple camera streams.
+
+    Each camera hands over frames through a single 'latest' slot: update_frame() replaces (and releases)
+    a frame that was not displayed yet, so the grab loop never waits for the display. The display thread
+    shows the latest frame of every camera at most `fps` times per second, downscaled to the window size
+    before the predictions are drawn.
+    With `mosaic`, all cameras are tiled into one pre-allocated canvas (tile_width x tile_height per camera,
+    `columns` tiles per row, 0: square-ish grid) shown in a single window.
+    """
+    def __init__(self, **options):
         self.displays = {}
         self.stopped = False
         self.display_thread = None
         self.display_lock = threading.Lock()
+        self.canvas = None
+        self.configure(**options)
         # cv2.setNumThreads(1)
 
         # prediction preview params
@@ -37,45 +63,65 @@ class DisplayManager:
         # self.fontcolor = (255, 255, 255) # white
         self.fontcolor = (255, 0, 0) # blue
         self.fontthickness = 2
+
+    def configure(self, fps=DEFAULT_PREVIEW_FPS, mosaic=False, tile_width=480, tile_height=360, columns=0):
+        """Sets the preview options, see preview_options()"""
+        self.fps = fps
+        self.mosaic = mosaic
+        self.tile_size = (tile_width, tile_height)
+        self.columns = columns
         
-    def add_display(self, name, width=500, height=500, pred_preview_button=None):
-        """Add a new display for a camera stream"""
+    def add_display(self, name, width=500, height=500, pred_preview_button=None, frame_pool=None):
+        """Add a new display for a camera stream. With a frame_pool, frames are passed as slot indices."""
         if name not in self.displays:
             self.displays[name] = {
-                'queue': LifoQueue(maxsize=5),
+                'latest': None,  # (frame or slot, pred_result) not displayed yet
+                'lock': threading.Lock(),
                 'window_size': (width, height),
                 'frame_count': 0,
+                'n_received': 0,
+                'n_dropped': 0,
+                'display_fps': 0.0,
+                'hidden': False,
                 'last_time': time.perf_counter(),
-                'pred_preview_button': pred_preview_button
+                'pred_preview_button': pred_preview_button,
+                'frame_pool': frame_pool
             }
-            # cv2.startWindowThread()
-            # cv2.namedWindow(name, cv2.WINDOW_NORMAL | cv2.WINDOW_KEEPRATIO)
-            # cv2.namedWindow(name, cv2.WINDOW_NORMAL)
-            # cv2.resizeWindow(name, width, height)
     
-    def update_frame(self, name, frame):
-        """Update frame for a specific display"""
+    def update_frame(self, name, frame, pred_result=None):
+        """Update frame (or frame pool slot) for a specific display, with optional predictions to overlay"""
         if name not in self.displays.keys() or frame is None:
             print(f'Display Err: {name} not in displays OR frame is None.')
             return
-            
-        try:
-            self.displays[name]['queue'].put_nowait(frame)
-            # print(f'{name}: put new frame')
-        except Exception as e:
-            # If queue is full, drop the oldest frame
-            try:
-                self.displays[name]['queue'].get_nowait()
-                self.displays[name]['queue'].put_nowait(frame)
-                # print(f'{name}: put new frame2')
-            except Exception as nested_e:
-                print(f'Display Err2: {str(nested_e)}')
+
+        display = self.displays[name]
+        with display['lock']:
+            dropped = display['latest']
+            display['latest'] = (frame, pred_result)
+            display['n_received'] += 1
+        if dropped is not None:
+            display['n_dropped'] += 1
+            self.release(name, dropped[0])
+
+    def take_frame(self, name):
+        """Returns the latest (frame, pred_result) of a display, or None if there is no new frame"""
+        display = self.displays[name]
+        with display['lock']:
+            latest = display['latest']
+            display['latest'] = None
+        return latest
+
+    def release(self, name, frame):
+        """Give a frame pool slot back once the display is done with it"""
+        frame_pool = self.displays[name]['frame_pool']
+        if frame_pool is not None:
+            frame_pool.release(frame)
             
     def start(self):
         """Start the display thread"""
         # self.display_loop()
         if self.display_thread is None:
-            self.display_thread = threading.Thread(target=self.display_loop, daemon=True)
+            self.display_thread = threading.Thread(target=self.display_loop, name='display', daemon=True)
             self.display_thread.start()
             print('Display thread started.')
         else:
@@ -85,75 +131,150 @@ class DisplayManager:
         """Stop all displays"""
         if window_name is None:
             self.stopped = True
-            cv2.destroyAllWindows()
-            if self.display_thread is not None:
+            if self.display_thread is not None and self.display_thread is not threading.current_thread():
                 self.display_thread.join(timeout=1.0)
                 self.display_thread = None
+            for name in self.displays:
+                latest = self.take_frame(name)
+                if latest is not None:
+                    self.release(name, latest[0])
+            cv2.destroyAllWindows()
+        elif self.mosaic:
+            self.displays[window_name]['hidden'] = True
         else:
             cv2.destroyWindow(window_name)
+
+    def preview_frame(self, name, frame, size=None):
+        """Downscales a frame (or frame pool slot) to `size` (default: the display's window size), as a new BGR image"""
+        display = self.displays[name]
+        size = size or display['window_size']
+        frame_pool = display['frame_pool']
+        slot = None
+        if frame_pool is not None:
+            slot = frame
+            # mono frames are downscaled before the color conversion, Bayer frames need to be demosaiced first
+            frame = frame_pool[slot] if frame_pool.pixel_format.startswith('Mono') else frame_pool.bgr(slot)
+
+        height, width = frame.shape[:2]
+        scale = min(size[0] / width, size[1] / height, 1)
+        # resize() copies the frame, so drawing never touches the recorded frame
+        preview = cv2.resize(frame, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+        if slot is not None:
+            frame_pool.release(slot)
+        if preview.ndim == 2:
+            preview = cv2.cvtColor(preview, cv2.COLOR_GRAY2BGR)
+        return preview, scale
+
+    def draw_predictions(self, frame, pred_result, scale):
+        """ Draws keypoints given as (animals x keypoints x (x, y[, confidence])), skipping undetected (nan) ones. """
+        for target_number, target in enumerate(pred_result):
+            for key_point in target:
+                if not np.isfinite(key_point[0]) or not np.isfinite(key_point[1]):
+                    continue
+                frame = cv2.circle(frame, (round(key_point[0] * scale), round(key_point[1] * scale)), self.circle_radius,
+                                   self.colors[target_number % len(self.colors)], self.thickness)
+        return frame
     
+    def count_frame(self, display):
+        now = time.perf_counter()
+        if display['frame_count'] > 0:
+            # exponential moving average of the displayed frame rate
+            display['display_fps'] = 0.9 * display['display_fps'] + 0.1 / max(now - display['last_time'], 1e-6)
+        display['frame_count'] += 1
+        display['last_time'] = now
+
+    def mosaic_layout(self):
+        """Allocates the canvas and returns {name: (x, y)} tile origins"""
+        n_tiles = len(self.displays)
+        columns = self.columns or math.ceil(math.sqrt(n_tiles))
+        rows = math.ceil(n_tiles / columns)
+        tile_width, tile_height = self.tile_size
+        if self.canvas is None or self.canvas.shape[:2] != (rows * tile_height, columns * tile_width):
+            self.canvas = np.zeros((rows * tile_height, columns * tile_width, 3), dtype=np.uint8)
+            cv2.namedWindow('Preview', cv2.WINDOW_NORMAL)
+            cv2.resizeWindow('Preview', self.canvas.shape[1], self.canvas.shape[0])
+        return {name: ((i % columns) * tile_width, (i // columns) * tile_height) for i, name in enumerate(self.displays)}
+
+    def show_mosaic(self):
+        """Draws the new frames into their tiles of the canvas and shows it once"""
+        tile_width, tile_height = self.tile_size
+        for name, (x, y) in self.mosaic_layout().items():
+            display = self.displays[name]
+            latest = self.take_frame(name)
+            if display['hidden']:
+                if latest is not None:
+                    self.release(name, latest[0])
+                self.canvas[y:y + tile_height, x:x + tile_width] = 0
+                continue
+            if latest is None:
+                continue  # the tile keeps the last frame
+            frame, pred_result = latest
+            try:
+                tile, scale = self.preview_frame(name, frame, size=self.tile_size)
+                if pred_result is not None:
+                    tile = self.draw_predictions(tile, pred_result, scale)
+                self.canvas[y:y + tile_height, x:x + tile_width] = 0
+                self.canvas[y:y + tile.shape[0], x:x + tile.shape[1]] = tile
+                self.count_frame(display)
+            except Exception as e:
+                print(f"Display error in {name}: {str(e)}")
+                continue
+            cv2.putText(self.canvas, f'{name} | {display["display_fps"]:.1f} FPS | skipped: {display["n_dropped"]}',
+                        (x + 10, y + 25), self.font, 0.6, self.fontcolor, 1, cv2.LINE_AA)
+        with self.display_lock:
+            cv2.imshow('Preview', self.canvas)
+
     # @threaded
     def display_loop(self):
-        """Main display loop"""
-        cnt = 0
+        """Main display loop, paced at self.fps"""
+        next_time = time.perf_counter()
 
         while not self.stopped:
-            # print(f'cnt: {cnt}')
-            cnt += 1
-            # for name, display in self.displays.items():
-            for name, display in self.displays.items():
+            if self.mosaic:
+                self.show_mosaic()
+            for name, display in ([] if self.mosaic else self.displays.items()):
+                latest = self.take_frame(name)
+                if latest is None:
+                    continue
+                frame, pred_result = latest
                 try:
-                    # print(f'name: {name}, display: {display}')
-
-                    if display['queue'].empty():
-                        # print(f'{name}: empty q')
-                        continue
-
-                    # Try to get a frame with a short timeout
-                    frame = display['queue'].get()
-                    
-                    if frame is None:
-                        # print(f'{name}: None frame')
-                        continue
+                    frame, scale = self.preview_frame(name, frame)
 
                     if display['frame_count'] == 0:
                         print(f'Creating display window for: {name}')
-                        # cv2.startWindowThread()
                         cv2.namedWindow(name, cv2.WINDOW_NORMAL)
-                        cv2.resizeWindow(name, 500, 500)
-
-                    # print(f'frame: {frame.shape}')
-                    if len(frame.shape) == 2:
-                        frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
-                    
-                    # Calculate and display FPS
-                    current_time = time.perf_counter()
-                    # fps = 1.0 / (current_time - self.displays[name]['last_time'])
-                    self.displays[name]['last_time'] = current_time                    
-                    frame = cv2.putText(frame, f'Frame: {display["frame_count"]}', self.pos, self.font, # , FPS: {fps:.1f}
+                        cv2.resizeWindow(name, frame.shape[1], frame.shape[0])
+
+                    if pred_result is not None:
+                        frame = self.draw_predictions(frame, pred_result, scale)
+                    frame = cv2.putText(frame, f'Frame: {display["frame_count"]}', self.pos, self.font,
                                         self.fontScale, self.fontcolor, self.fontthickness, cv2.LINE_AA)
                     # Short lock only for imshow
                     with self.display_lock:
-                        try:
-                            cv2.imshow(name, frame)
-                            if cv2.waitKey(1) == ord("q"):
-                                self.stopped = True
-                                break
-                        except Exception as e:
-                            print(f"Error displaying frame for {name}: {e}")
-                            continue
-
-                    self.displays[name]['frame_count'] += 1
-                    
+                        cv2.imshow(name, frame)
+                    self.count_frame(display)
                 except Exception as e:
                     print(f"Display error in {name}: {str(e)}")
                     continue
-                    
+
+            # one event loop iteration for all windows
+            with self.display_lock:
+                if cv2.waitKey(1) == ord("q"):
+                    self.stopped = True
+                    break
+
+            next_time += 1 / self.fps
+            delay = next_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_time = time.perf_counter()  # fell behind, don't try to catch up
+
 
 class VideoShow2:
     def __init__(self, name, show_pred=False, frame=None, preview_button='q', 
                  pred_preview_button='p', prev_width=500, prev_height=500, 
-                 display_manager=None):
+                 display_manager=None, frame_pool=None):
         self.name = name
         self.show_pred = show_pred
         self.stopped = False
@@ -162,30 +283,32 @@ class VideoShow2:
         self.pred_preview_button = pred_preview_button
         self.preview_button = preview_button
 
-        self.listener = keyboard.Listener(on_press=self.on_key_event)
-        self.listener.start()
+        self.listener = None
+        if keyboard is not None:
+            self.listener = keyboard.Listener(on_press=self.on_key_event)
+            self.listener.start()
         
         # Use provided display manager or create new one
         self.display_manager = display_manager
         if self.display_manager is None:
             self.display_manager = DisplayManager()
             
-        self.display_manager.add_display(name, prev_width, prev_height, pred_preview_button)
+        self.frame_pool = frame_pool
+        self.display_manager.add_display(name, prev_width, prev_height, pred_preview_button, frame_pool=frame_pool)
         
     def start(self):
         if self.display_manager.display_thread is None:
             self.display_manager.start()
         
     def update(self, frame):
+        """frame is a slot index if a frame_pool is used"""
         if not self.stopped:
-            if self.pred_result is not None and self.show_pred:
-                for target_number, target in enumerate(self.pred_result):
-                    for key_point in target:
-                        frame = cv2.circle(frame, (key_point[1], key_point[0]), self.display_manager.circle_radius,
-                                            self.display_manager.colors[target_number], self.display_manager.thickness)
-
-            self.display_manager.update_frame(self.name, frame)
+            # predictions are drawn in the display thread
+            pred_result = self.pred_result if self.show_pred else None
+            self.display_manager.update_frame(self.name, frame, pred_result)
             self.n_frame += 1
+        elif self.frame_pool is not None:
+            self.frame_pool.release(frame)
     
     @threaded
     def on_key_event(self, event):
@@ -236,8 +359,10 @@ class VideoShow:
         self.queue = Queue(maxsize=2)
         self.queue.put(frame)
         self.lock = threading.Lock()
-        self.listener = keyboard.Listener(on_press=self.on_key_event)
-        self.listener.start()
+        self.listener = None
+        if keyboard is not None:
+            self.listener = keyboard.Listener(on_press=self.on_key_event)
+            self.listener.start()
         # cv2.setNumThreads(1)
         self.preview_thread = Thread(target=self.preview_worker, daemon=True)
 
@@ -0,0 +1,149 @@
+import time
+import numpy as np
+from utils.metadata import ColumnarWriter
+from utils.recorders import SegmentedRecorder
+
+# one row per camera outage, written to outages_<camname>
+OUTAGE_DTYPE = np.dtype([('start_time', np.float64),   # host wall-clock time (time.time()) of the last frame before the outage
+                         ('end_time', np.float64),     # ... and of the reopening of the camera
+                         ('grab_index', np.int64),     # number of frames grabbed before the outage
+                         ('last_frame_id', np.int64),  # frame ID of the last frame before the outage
+                         ('n_missing', np.int64),      # estimated number of frames missed during the outage
+                         ('n_attempts', np.int64),     # attempts to reopen the camera
+                         ('segment', np.int64)])       # video segment the recording resumed in, -1 if not segmented
+
+
+def reconnect_options(config, cam):
+    """ Returns reconnect options from the top-level `reconnect` section of the config,
+    overridden by the camera's own `reconnect` section if present.
+    """
+    options = {'enabled': False, 'grab_timeout': 5.0, 'retry_period': 1.0, 'max_attempts': 0}
+    options.update(config.get('reconnect') or {})
+    options.update(cam.get('reconnect') or {})
+    return options
+
+
+def split_recording(frame_writer, recorder):
+    """ Starts a new video segment after the frames that were queued before. Returns the new segment number,
+    -1 if the recording is not segmented (it continues in the same file) or is written by another process.
+    """
+    if recorder is None:
+        # writer process: the split is queued after the frames, see writer_process()
+        if hasattr(frame_writer, 'split'):
+            frame_writer.split()
+        return -1
+    if not isinstance(recorder, SegmentedRecorder):
+        return -1
+    frame_writer.drain()
+    recorder.split()
+    return recorder.current['number']
+
+
+class ReconnectSupervisor():
+    """ Decides when a camera is lost and reopens it.
+
+    A camera is lost if it was removed, or if no frame arrived for `grab_timeout` sec and either it
+    free-runs or it does not answer `probe` (a triggered camera that answers is only waiting for triggers).
+    recover() calls `reopen` every `retry_period` sec until it succeeds, the acquisition is stopped or
+    `max_attempts` (0: no limit) failed. The frames missed in the outage are estimated from the host time of
+    the first frame after it, see resume(). Each outage is appended to a table at `path` if given.
+    """
+
+    def __init__(self, name, fps, logger, path=None, triggered=False, stop_event=None,
+                 grab_timeout=5.0, retry_period=1.0, max_attempts=0) -> None:
+        self.name = name
+        self.period = 1 / fps
+        self.logger = logger
+        self.triggered = triggered
+        self.stop_event = stop_event
+        self.grab_timeout = grab_timeout
+        self.retry_period = retry_period
+        self.max_attempts = max_attempts
+        self.table = ColumnarWriter(path, OUTAGE_DTYPE, chunk_size=1) if path is not None else None
+        self.last_frame_t = time.perf_counter()
+        self.last_host_time = None
+        self.last_frame_id = -1
+        # outage waiting for the first frame after it, with the video segment the recording resumes in
+        self.outage = None
+
+        # counters
+        self.n_outages = 0
+        self.n_missing = 0
+        self.downtime = 0.0
+
+    def frame(self, frame_id, host_time):
+        """ Called for every frame, with its host time (sec since start_t, FrameInfo.time_stamp_w_offset). """
+        self.last_frame_t = time.perf_counter()
+        self.last_frame_id = frame_id
+        self.last_host_time = host_time
+
+    def lost(self, is_removed, probe):
+        """ Called when a grab timed out or failed: True if the camera has to be reopened. """
+        if is_removed():
+            return True
+        if time.perf_counter() - self.last_frame_t < self.grab_timeout:
+            return False
+        if not self.triggered:
+            return True
+        try:
+            probe()
+            return False
+        except Exception:
+            return True
+
+    def stop_requested(self):
+        return self.stop_event is not None and self.stop_event.is_set()
+
+    def recover(self, reopen, grab_index):
+        """ Reopens the camera, returns False if it could not be reopened before the acquisition was stopped. """
+        start_time = time.time() - (time.perf_counter() - self.last_frame_t)
+        self.logger.info(f'{self.name}: camera lost after {grab_index} frames (last frame ID {self.last_frame_id}), reconnecting...')
+        n_attempts = 0
+        while not self.stop_requested():
+            n_attempts += 1
+            try:
+                reopen()
+            except Exception as e:
+                self.logger.info(f'{self.name}: could not reopen the camera ({e}), attempt {n_attempts}'
+                                 f'{"/" + str(self.max_attempts) if self.max_attempts else ""}')
+                if n_attempts == self.max_attempts:
+                    self.logger.info(f'{self.name}: giving up reconnecting')
+                    return False
+                if self.stop_event is not None:
+                    self.stop_event.wait(self.retry_period)
+                else:
+                    time.sleep(self.retry_period)
+                continue
+            self.outage = {'start_time': start_time, 'end_time': time.time(), 'grab_index': grab_index,
+                           'last_frame_id': self.last_frame_id, 'n_missing': -1, 'n_attempts': n_attempts, 'segment': -1}
+            self.n_outages += 1
+            self.logger.info(f'{self.name}: reconnected after {self.outage["end_time"] - start_time:.2f} sec and {n_attempts} attempt(s)')
+            return True
+        return False
+
+    def resume(self, host_time):
+        """ Called for the first frame after an outage: records the outage and returns the estimated number of frames missed. """
+        n_missing = 0
+        if self.last_host_time is not None:
+            n_missing = max(0, int(round((host_time - self.last_host_time) / self.period)) - 1)
+            self.downtime += host_time - self.last_host_time
+        self.n_missing += n_missing
+        self.outage['n_missing'] = n_missing
+        self.logger.info(f'{self.name}: resumed, ~{n_missing} frame(s) missed | {self.report()}')
+        self.record()
+        return n_missing
+
+    def record(self):
+        if self.table is not None:
+            self.table.append(tuple(self.outage[name] for name in OUTAGE_DTYPE.names))
+        self.outage = None
+
+    def report(self):
+        return f'outages: {self.n_outages}, downtime: {self.downtime:.2f} sec, missed frames: ~{self.n_missing}'
+
+    def close(self):
+        if self.outage is not None:
+            # reconnected, but no frame came before the end (n_missing stays -1)
+            self.record()
+        if self.table is not None:
+            self.table.close()
@@ -0,0 +1,372 @@
+import os
+import cv2
+import glob
+import json
+import shutil
+import subprocess
+import numpy as np
+from utils.writer import FRAME_INFO_DTYPE
+from utils.frame_pool import frame_shape
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+MOVIE_FORMATS = ['opencv', 'ffmpeg', 'hdf5', 'raw']
+# formats that store the frame pool's native (Mono8/Bayer) frames bit-exact, with per-frame metadata
+LOSSLESS_FORMATS = ['hdf5', 'raw']
+HDF5_COMPRESSIONS = [None, 'gzip', 'lzf', 'lz4', 'blosc']
+
+# ffmpeg output options per codec. Only software encoders are used so that the same config
+# works on every acquisition PC; `threads: 0` lets the encoder pick one thread per core.
+CODEC_PRESETS = {
+    'libx264': {'ext': '.mp4', 'crf': 18, 'preset': 'veryfast', 'pix_fmt': 'yuv420p', 'threads': 0},
+    'libx265': {'ext': '.mp4', 'crf': 20, 'preset': 'fast', 'pix_fmt': 'yuv420p', 'threads': 0},
+    'ffv1': {'ext': '.mkv', 'crf': None, 'preset': None, 'pix_fmt': None, 'threads': 0},  # lossless
+}
+
+
+def ffmpeg_options(config, cam):
+    """ Returns ffmpeg options: the codec from the top-level `codec` key, then the codec's preset,
+    overridden by the top-level and the camera's own `ffmpeg` sections.
+    """
+    codec = (cam.get('ffmpeg') or {}).get('codec', config.get('codec', 'libx264'))
+    if codec not in CODEC_PRESETS:
+        raise ValueError(f'Unsupported codec: {codec}, choose one of {list(CODEC_PRESETS.keys())}')
+    options = dict(CODEC_PRESETS[codec])
+    options.update(config.get('ffmpeg') or {})
+    options.update(cam.get('ffmpeg') or {})
+    options['codec'] = codec
+    return options
+
+
+def hdf5_options(config, cam):
+    """ Returns HDF5 recorder options from the top-level `hdf5` section of the config,
+    overridden by the camera's own `hdf5` section if present.
+    """
+    options = {'compression': None, 'chunk_frames': 1}
+    options.update(config.get('hdf5') or {})
+    options.update(cam.get('hdf5') or {})
+    return options
+
+
+class OpenCVRecorder():
+    """ cv2.VideoWriter, single-threaded mp4v encoding. """
+    native = False
+
+    def __init__(self, path, fps, width, height, color=False, fourcc='mp4v') -> None:
+        self.path = path + '.mp4'
+        self.writer = cv2.VideoWriter(self.path, cv2.VideoWriter_fourcc(*fourcc), fps, (width, height), isColor=color)
+
+    def write(self, frame, info=None):
+        self.writer.write(frame)
+
+    def release(self):
+        self.writer.release()
+
+
+class FFmpegRecorder():
+    """ Pipes raw frames to an ffmpeg subprocess, which encodes them with a multi-threaded encoder. """
+    native = False
+
+    def __init__(self, path, fps, width, height, color=False, codec='libx264', crf=18, preset='veryfast',
+                 pix_fmt=None, threads=0, ext='.mp4', ffmpeg_path='ffmpeg', extra_args=None, log_path=None) -> None:
+        if shutil.which(ffmpeg_path) is None:
+            raise FileNotFoundError(f'ffmpeg executable not found: {ffmpeg_path}')
+
+        self.path = path + ext
+        in_pix_fmt = 'bgr24' if color else 'gray'
+        cmd = [ffmpeg_path, '-y', '-loglevel', 'error',
+               '-f', 'rawvideo', '-pix_fmt', in_pix_fmt, '-s', f'{width}x{height}', '-r', str(fps), '-i', '-',
+               '-c:v', codec, '-threads', str(threads)]
+        if codec == 'ffv1':
+            # version 3 with slices is encoded in parallel, slice CRCs make the files self-checking
+            cmd += ['-level', '3', '-slices', '16', '-slicecrc', '1', '-g', '1']
+        if crf is not None:
+            cmd += ['-crf', str(crf)]
+        if preset is not None:
+            cmd += ['-preset', str(preset)]
+        if pix_fmt is not None:
+            cmd += ['-pix_fmt', pix_fmt]
+        cmd += list(extra_args or []) + [self.path]
+
+        self.log_file = open(log_path, 'w') if log_path is not None else subprocess.DEVNULL
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=self.log_file)
+
+    def write(self, frame, info=None):
+        self.proc.stdin.write(np.ascontiguousarray(frame).data)
+
+    def release(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+        if self.log_file is not subprocess.DEVNULL:
+            self.log_file.close()
+        if self.proc.returncode != 0:
+            raise RuntimeError(f'ffmpeg exited with code {self.proc.returncode} while writing {self.path}')
+
+
+class HDF5Recorder():
+    """ Writes frames to a chunked, optionally compressed `frames` dataset of an HDF5 file, and their
+    FrameInfo fields to parallel 1D datasets of the same name.
+
+    Datasets are grown `chunk_frames` (at least 64) frames at a time and trimmed on release.
+    `lz4` and `blosc` compression need the hdf5plugin package.
+    """
+    native = True
+
+    def __init__(self, path, fps, shape, dtype, pixel_format, compression=None, chunk_frames=1) -> None:
+        if h5py is None:
+            raise ImportError('h5py is required for the hdf5 movie format: pip install h5py')
+        if compression not in HDF5_COMPRESSIONS:
+            raise ValueError(f'Invalid HDF5 compression: {compression}, choose one of {HDF5_COMPRESSIONS}')
+
+        self.path = path + '.h5'
+        self.file = h5py.File(self.path, 'w')
+        chunk_frames = int(chunk_frames)
+        self.grow_frames = max(chunk_frames, 64)
+        self.n_frames = 0
+        self.capacity = self.grow_frames
+
+        self.frames = self.file.create_dataset('frames', shape=(self.capacity, *shape), maxshape=(None, *shape), dtype=dtype,
+                                               chunks=(chunk_frames, *shape), **self.compression_kwargs(compression))
+        self.frames.attrs['fps'] = fps
+        self.frames.attrs['pixel_format'] = pixel_format
+        self.columns = {name: self.file.create_dataset(name, shape=(self.capacity,), maxshape=(None,), dtype=FRAME_INFO_DTYPE[name],
+                                                       chunks=(1024,))
+                        for name in FRAME_INFO_DTYPE.names}
+        # metadata is buffered and written one block at a time
+        self.info_buffer = np.zeros(self.grow_frames, dtype=FRAME_INFO_DTYPE)
+        self.n_buffered = 0
+
+    @staticmethod
+    def compression_kwargs(compression):
+        if compression in ['lz4', 'blosc']:
+            import hdf5plugin
+            if compression == 'lz4':
+                return dict(hdf5plugin.LZ4())
+            return dict(hdf5plugin.Blosc(cname='lz4', clevel=5, shuffle=hdf5plugin.Blosc.BITSHUFFLE))
+        return {'compression': compression}
+
+    def write(self, frame, info=None):
+        if self.n_frames == self.capacity:
+            self.flush_info()
+            self.capacity += self.grow_frames
+            self.frames.resize(self.capacity, axis=0)
+            for column in self.columns.values():
+                column.resize(self.capacity, axis=0)
+        self.frames[self.n_frames] = frame
+        if info is not None:
+            self.info_buffer[self.n_buffered] = tuple(info)
+        else:
+            self.info_buffer[self.n_buffered] = (-1, -1, -1, np.nan)
+        self.n_buffered += 1
+        self.n_frames += 1
+
+    def flush_info(self):
+        start = self.n_frames - self.n_buffered
+        for name, column in self.columns.items():
+            column[start:self.n_frames] = self.info_buffer[name][:self.n_buffered]
+        self.n_buffered = 0
+
+    def release(self):
+        self.flush_info()
+        self.frames.resize(self.n_frames, axis=0)
+        for column in self.columns.values():
+            column.resize(self.n_frames, axis=0)
+        self.file.close()
+
+
+class RawRecorder():
+    """ Appends frames as flat bytes to a `.raw` file and their FrameInfo records to a `.frames` file.
+    Frame shape, dtype, pixel format and frame count are kept in a `.json` header next to them.
+    Load the recording with load_raw(), which memory-maps the frames.
+    """
+    native = True
+
+    def __init__(self, path, fps, shape, dtype, pixel_format) -> None:
+        self.path = path + '.raw'
+        self.header_path = path + '.json'
+        self.info_path = path + '.frames'
+        self.header = {'fps': fps, 'shape': list(shape), 'dtype': np.dtype(dtype).str, 'pixel_format': pixel_format,
+                       'info_dtype': FRAME_INFO_DTYPE.descr, 'n_frames': 0}
+        self.write_header()
+        self.file = open(self.path, 'wb')
+        self.info_file = open(self.info_path, 'wb')
+        self.record = np.zeros(1, dtype=FRAME_INFO_DTYPE)
+        self.n_frames = 0
+
+    def write_header(self):
+        with open(self.header_path, 'w') as file:
+            json.dump(self.header, file)
+
+    def write(self, frame, info=None):
+        self.file.write(np.ascontiguousarray(frame).data)
+        self.record[0] = tuple(info) if info is not None else (-1, -1, -1, np.nan)
+        self.info_file.write(self.record.data)
+        self.n_frames += 1
+
+    def release(self):
+        self.file.close()
+        self.info_file.close()
+        self.header['n_frames'] = self.n_frames
+        self.write_header()
+
+
+def load_raw(path):
+    """ Returns (frames, frame_info, header) of a RawRecorder recording. `path` is the file path without extension.
+    frames is a read-only memory map of shape (n_frames, *shape), frame_info a FRAME_INFO_DTYPE record array.
+    """
+    with open(path + '.json') as file:
+        header = json.load(file)
+    frame_info = np.fromfile(path + '.frames', dtype=FRAME_INFO_DTYPE)
+    # the frame count is only updated on release, use the metadata if the recording was interrupted
+    n_frames = header['n_frames'] or len(frame_info)
+    frames = np.memmap(path + '.raw', dtype=np.dtype(header['dtype']), mode='r', shape=(n_frames, *header['shape']))
+    return frames, frame_info[:n_frames], header
+
+
+def segment_frames(args, cam):
+    """ Number of frames per video segment from --nframes_per_file, or --segment_duration (min) at the
+    camera's acquisition frame rate. 0 means a single file for the whole recording.
+    """
+    if args.nframes_per_file:
+        return int(args.nframes_per_file)
+    if args.segment_duration:
+        return int(round(args.segment_duration * 60 * cam['options']['AcquisitionFrameRate']))
+    return 0
+
+
+class SegmentedRecorder():
+    """ Splits a recording into `<path>_0000`, `<path>_0001`, ... segments of `nframes_per_file` frames.
+
+    The next segment is opened in a background thread while the current one is still being written,
+    and finished segments are closed (containers finalized) in the same thread, so writes never wait
+    at a segment boundary. `<path>_index.json` lists the segments with their first global frame number
+    and frame IDs; it is rewritten every time a segment is closed. See find_segment().
+    """
+
+    def __init__(self, open_segment, path, nframes_per_file, lookahead=None) -> None:
+        self.open_segment = open_segment  # callable, segment path without extension -> recorder
+        self.path = path
+        self.nframes_per_file = int(nframes_per_file)
+        # frames before the end of a segment at which the next one is opened
+        self.lookahead = lookahead if lookahead is not None else max(1, self.nframes_per_file // 10)
+        self.index_path = path + '_index.json'
+        self.segments = []
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='segment')
+        self.n_frames = 0
+        self.closing = []  # futures of close_segment(), checked for errors in split() and release()
+
+        self.current = self.new_segment(self.open_segment(self.segment_path(0)))
+        self.native = self.current['recorder'].native
+        self.next = None  # future of the next segment's recorder
+
+    def segment_path(self, number):
+        return f'{self.path}_{number:04d}'
+
+    def new_segment(self, recorder):
+        return {'recorder': recorder, 'number': len(self.segments), 'first_frame': self.n_frames,
+                'n_frames': 0, 'first_frame_id': None, 'last_frame_id': None}
+
+    def write(self, frame, info=None):
+        segment = self.current
+        if segment['n_frames'] == self.nframes_per_file - self.lookahead and self.next is None:
+            self.next = self.executor.submit(self.open_segment, self.segment_path(segment['number'] + 1))
+        elif segment['n_frames'] == self.nframes_per_file:
+            self.split()
+            segment = self.current
+
+        segment['recorder'].write(frame, info)
+        if info is not None:
+            if segment['first_frame_id'] is None:
+                segment['first_frame_id'] = int(info.frame_id)
+            segment['last_frame_id'] = int(info.frame_id)
+        segment['n_frames'] += 1
+        self.n_frames += 1
+
+    def split(self):
+        """ Closes the current segment, the next frame starts a new one. Called by write(), or between writes
+        to end a segment early (e.g. when the camera was reconnected, see utils/reconnect.py).
+        """
+        if self.current['n_frames'] == 0:
+            return
+        if self.next is None:
+            self.next = self.executor.submit(self.open_segment, self.segment_path(self.current['number'] + 1))
+        self.segments.append(self.current)
+        for future in [future for future in self.closing if future.done()]:
+            future.result()
+            self.closing.remove(future)
+        self.closing.append(self.executor.submit(self.close_segment, self.current))
+        self.current = self.new_segment(self.next.result())
+        self.next = None
+
+    def close_segment(self, segment):
+        recorder = segment.pop('recorder')  # keeps memory bounded in long (continuous) recordings
+        recorder.release()
+        segment['file'] = os.path.basename(recorder.path)
+        self.write_index()
+
+    def write_index(self):
+        segments = [{key: segment[key] for key in ['file', 'first_frame', 'n_frames', 'first_frame_id', 'last_frame_id']}
+                    for segment in self.segments if 'file' in segment]
+        with open(self.index_path, 'w') as file:
+            json.dump({'nframes_per_file': self.nframes_per_file, 'n_frames': sum(s['n_frames'] for s in segments),
+                       'segments': segments}, file, indent=1)
+
+    def release(self):
+        if self.next is not None:
+            # opened ahead of time but never written to
+            unused = self.segment_path(self.current['number'] + 1)
+            self.closing.append(self.executor.submit(self.discard_segment, self.next.result(), unused))
+        if self.current['n_frames'] == 0:
+            # e.g. split() right before the end of the recording, like split() it is left out of the index
+            empty = self.segment_path(self.current['number'])
+            self.closing.append(self.executor.submit(self.discard_segment, self.current.pop('recorder'), empty))
+            self.closing.append(self.executor.submit(self.write_index))
+        else:
+            self.segments.append(self.current)
+            self.closing.append(self.executor.submit(self.close_segment, self.current))
+        self.executor.shutdown(wait=True)
+        for future in self.closing:
+            future.result()  # raises the first error of closing a segment
+
+    @staticmethod
+    def discard_segment(recorder, path):
+        recorder.release()
+        for file in glob.glob(glob.escape(path) + '.*') + glob.glob(glob.escape(path) + '_*'):
+            os.remove(file)
+
+
+def find_segment(index_path, frame_number):
+    """ Returns (segment file, frame number in the segment) of a global frame number of a SegmentedRecorder recording. """
+    with open(index_path) as file:
+        index = json.load(file)
+    for segment in index['segments']:
+        if segment['first_frame'] <= frame_number < segment['first_frame'] + segment['n_frames']:
+            return segment['file'], frame_number - segment['first_frame']
+    raise IndexError(f'Frame {frame_number} is not in {index_path} ({index["n_frames"]} frames)')
+
+
+def make_recorder(movie_format, path, fps, width, height, color, config, cam, pixel_format='Mono8', nframes_per_file=0):
+    """ Creates the recorder for `movie_format`. `path` is the file path without extension.
+    Video formats get BGR frames if `color`, lossless formats always get `pixel_format` frames.
+    With `nframes_per_file`, the recording is split into segments by a SegmentedRecorder.
+    """
+    if nframes_per_file:
+        return SegmentedRecorder(lambda segment_path: make_recorder(movie_format, segment_path, fps, width, height, color,
+                                                                    config, cam, pixel_format=pixel_format),
+                                 path, nframes_per_file)
+    if movie_format == 'opencv':
+        return OpenCVRecorder(path, fps, width, height, color=color)
+    elif movie_format == 'ffmpeg':
+        return FFmpegRecorder(path, fps, width, height, color=color, log_path=path + '_ffmpeg.log',
+                              **ffmpeg_options(config, cam))
+    elif movie_format in LOSSLESS_FORMATS:
+        shape, dtype = frame_shape({'Width': width, 'Height': height}, pixel_format=pixel_format)
+        if movie_format == 'hdf5':
+            return HDF5Recorder(path, fps, shape, dtype, pixel_format, **hdf5_options(config, cam))
+        return RawRecorder(path, fps, shape, dtype, pixel_format)
+    else:
+        raise ValueError(f'Invalid movie format: {movie_format}, choose one of {MOVIE_FORMATS}')
@@ -0,0 +1,56 @@
+import time
+import shutil
+import threading
+
+ACQUISITION_MODES = ['frames', 'continuous']
+
+
+def acquisition_frames(args):
+    """ Number of frames each camera acquires, None in continuous mode (until stopped). """
+    if args.acquisition_mode not in ACQUISITION_MODES:
+        raise ValueError(f'Invalid acquisition mode: {args.acquisition_mode}, choose one of {ACQUISITION_MODES}')
+    return args.n_total_frames if args.acquisition_mode == 'frames' else None
+
+
+class StopMonitor():
+    """ Sets `stop_event` (threading or multiprocessing Event) once the experiment duration is over
+    or the free space on the disk of `path` falls below `min_free_gb`. The grab loops check the
+    event once per frame.
+    """
+
+    def __init__(self, stop_event, logger, duration=float('inf'), path='.', min_free_gb=0, period=1.0) -> None:
+        self.stop_event = stop_event
+        self.logger = logger
+        self.duration = duration  # sec
+        self.path = path
+        self.min_free_gb = min_free_gb
+        self.period = period
+        self.start_t = None
+        self.thread = None
+
+    def start(self):
+        self.start_t = time.perf_counter()
+        self.thread = threading.Thread(target=self.run, name='stop_monitor', daemon=True)
+        self.thread.start()
+
+    def check(self):
+        """ Returns the reason to stop, or None. """
+        elapsed = time.perf_counter() - self.start_t
+        if elapsed >= self.duration:
+            return f'experiment duration reached ({elapsed / 60:.1f} min)'
+        if self.min_free_gb:
+            free_gb = shutil.disk_usage(self.path).free / 1e9
+            if free_gb < self.min_free_gb:
+                return f'free disk space {free_gb:.1f} GB is below {self.min_free_gb} GB'
+        return None
+
+    def run(self):
+        while not self.stop_event.wait(self.period):
+            reason = self.check()
+            if reason is not None:
+                self.stop(reason)
+
+    def stop(self, reason):
+        if not self.stop_event.is_set():
+            self.logger.info(f'Stopping acquisition: {reason}')
+            self.stop_event.set()
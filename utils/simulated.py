@@ -0,0 +1,273 @@
+import os
+import cv2
+import time
+import queue
+import threading
+import numpy as np
+from collections import namedtuple
+from utils.helpers import str_to_bool
+from utils.latency import LatencyMonitor
+from utils.grab_loop import GrabLoop, GrabbedFrame
+from utils.frame_pool import frame_shape, pool_pixel_format
+
+SIMULATION_SOURCES = ['synthetic', 'video']
+
+# a frame in the simulated camera's buffer: block_id is the camera frame counter (gaps for lost frames),
+# image_number counts the delivered frames, time_stamp is the simulated camera clock (ns),
+# n_skipped the frames lost to full buffers since the previous delivered frame
+SimulatedFrame = namedtuple('SimulatedFrame', ['block_id', 'image_number', 'time_stamp', 'n_skipped', 'image'])
+
+
+def simulation_options(config, cam):
+    """ Returns simulated camera options from the top-level `simulation` section of the config,
+    overridden by the camera's own `simulation` section if present.
+    """
+    options = {'source': 'synthetic', 'video': '', 'max_video_frames': 256, 'jitter_ms': 0.2, 'drop_rate': 0.0,
+               'drift_ppm': 0.0, 'n_buffers': 10, 'n_blobs': 4, 'noise': 8, 'seed': None,
+               'disconnects': [], 'disconnect_duration': 2.0}
+    options.update(config.get('simulation') or {})
+    options.update(cam.get('simulation') or {})
+    return options
+
+
+class SyntheticFrames():
+    """ Noisy background with bright blobs moving on circles. A few backgrounds are rendered at start,
+    so that a frame costs a copy and the blobs rather than a full frame of random numbers.
+    """
+
+    def __init__(self, shape, dtype, n_blobs=4, noise=8, seed=None, n_backgrounds=8) -> None:
+        rng = np.random.default_rng(seed)
+        self.shape = shape
+        level = 64 if dtype == np.uint8 else 64 << 8
+        self.backgrounds = [np.clip(rng.normal(level, noise * level / 64, shape), 0, np.iinfo(dtype).max).astype(dtype)
+                            for _ in range(n_backgrounds)]
+        self.blobs = rng.uniform(0, 1, (n_blobs, 3))  # radius and phase of the orbit, angular speed
+        self.value = int(np.iinfo(dtype).max * 0.9)
+
+    def read(self, n):
+        frame = self.backgrounds[n % len(self.backgrounds)].copy()
+        height, width = self.shape[:2]
+        for orbit, phase, speed in self.blobs:
+            angle = 2 * np.pi * (phase + n * (0.002 + 0.01 * speed))
+            x = int(width / 2 + orbit * width / 3 * np.cos(angle))
+            y = int(height / 2 + orbit * height / 3 * np.sin(angle))
+            cv2.circle(frame, (x, y), max(2, min(width, height) // 40), self.value, -1)
+        return frame
+
+
+class VideoFrames():
+    """ Frames of a recorded video, resized to the camera's Width/Height and pixel format and looped.
+    Up to `max_frames` frames are decoded at start, so that decoding does not slow down the camera.
+    """
+
+    def __init__(self, path, shape, max_frames=256) -> None:
+        capture = cv2.VideoCapture(path)
+        self.frames = []
+        while len(self.frames) < max_frames:
+            ret, frame = capture.read()
+            if not ret:
+                break
+            frame = cv2.resize(frame, (shape[1], shape[0]))
+            if len(shape) == 2:
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            self.frames.append(frame)
+        capture.release()
+        if not self.frames:
+            raise ValueError(f'Could not read frames from the simulation video: {path}')
+
+    def read(self, n):
+        return self.frames[n % len(self.frames)]
+
+
+class SimulatedCamera():
+    """ Free-running camera emulation: a thread exposes a frame every 1/fps sec (plus gaussian jitter)
+    into a buffer of `n_buffers` frames, like a camera filling the driver's buffers. Frames are lost when
+    the buffer is full or with probability `drop_rate` (transport errors), which shows up as a gap in
+    the frame counter. The camera clock counts ns and runs `drift_ppm` faster than the host clock.
+    Exposures are on a grid of 1/fps periods from host time `t0`, so cameras with the same `t0` expose
+    together, like cameras sharing a hardware trigger.
+    At the host times in `disconnects`, the camera falls off the bus for `disconnect_duration` sec: it stops
+    exposing and is removed until reopened (a new SimulatedCamera, with its clock and counters reset).
+    """
+
+    def __init__(self, name, source, fps, jitter_ms=0.2, drop_rate=0.0, drift_ppm=0.0, n_buffers=10, seed=None, t0=None,
+                 disconnects=(), disconnect_duration=2.0) -> None:
+        self.name = name
+        self.source = source
+        self.period = 1 / fps
+        self.t0 = t0
+        self.jitter = jitter_ms / 1000
+        self.drop_rate = drop_rate
+        self.clock_rate = 1 + drift_ppm * 1e-6
+        self.rng = np.random.default_rng(seed)
+        self.buffers = queue.Queue(maxsize=n_buffers)
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.clock0 = time.perf_counter()
+        self.disconnects = sorted(t for t in disconnects if t > self.clock0)
+        self.disconnect_duration = disconnect_duration
+        self.removed_until = None  # host time from which the camera can be reopened after a disconnect
+
+        # counters
+        self.n_exposed = 0
+        self.n_dropped = 0
+        self.n_overruns = 0
+
+    def clock(self, host_time=None):
+        host_time = time.perf_counter() if host_time is None else host_time
+        return int((host_time - self.clock0) * self.clock_rate * 1e9)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name=f'{self.name}_camera', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        next_t = time.perf_counter()
+        if self.t0 is not None:
+            next_t = self.t0 + np.ceil((next_t - self.t0) / self.period) * self.period
+        n_delivered, n_skipped = 0, 0
+        while not self.stop_event.is_set():
+            next_t += self.period
+            exposure_t = next_t + self.rng.normal(0, self.jitter) if self.jitter else next_t
+            delay = exposure_t - time.perf_counter()
+            if delay > 0 and self.stop_event.wait(delay):
+                break
+            if self.disconnects and exposure_t >= self.disconnects[0]:
+                self.removed_until = self.disconnects.pop(0) + self.disconnect_duration
+                break
+            # timestamped at the scheduled exposure: a late thread delays the delivery, not the exposure
+            time_stamp = self.clock(exposure_t)
+            self.n_exposed += 1
+            if self.drop_rate and self.rng.random() < self.drop_rate:
+                self.n_dropped += 1
+                continue
+            if self.buffers.full():
+                self.n_overruns += 1
+                n_skipped += 1
+                continue
+            n_delivered += 1
+            self.buffers.put(SimulatedFrame(self.n_exposed, n_delivered, time_stamp, n_skipped, self.source.read(self.n_exposed)))
+            n_skipped = 0
+
+    def retrieve(self, timeout):
+        try:
+            return self.buffers.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def is_removed(self):
+        return self.removed_until is not None
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def report(self):
+        return f'exposed: {self.n_exposed}, lost in transport: {self.n_dropped}, buffer overruns: {self.n_overruns}'
+
+
+class Simulated(GrabLoop):
+    """ Camera with the interface of Basler/FLIR that needs no hardware, for testing and benchmarking the
+    acquisition on any machine. Frames come from a SimulatedCamera, synthetic or from a recorded video
+    (see the `simulation` section of the config), through the same grab loop as Basler and FLIR (see utils/grab_loop.py).
+    """
+
+    def __init__(self, args, cam, camname, experiment, config, start_t, logger, cam_id=0,
+                 display_lock=None, display_manager=None, frame_pool=None, frame_writer=None, stop_event=None,
+                 synchronizer=None, inference_engine=None, closed_loop=None) -> None:
+
+        self.start_t = start_t
+        self.args = args
+        self.cam = cam
+        self.camname = camname
+        self.experiment = experiment
+        self.config = config
+        self.cam_id = cam_id
+        self.frame_timer = None
+        self.display_lock = display_lock
+        self.display_manager = display_manager
+        self.frame_pool = frame_pool
+        self.frame_writer = frame_writer
+        self.stop_event = stop_event
+        self.synchronizer = synchronizer
+        self.inference_engine = inference_engine
+        self.closed_loop = closed_loop
+        self.latency = LatencyMonitor(camname, enabled=str_to_bool(args.latency_stats))
+        self.writer_obj = None
+        self.preview = cam['preview']
+        self.save = str_to_bool(self.args.save)
+        self.predict = cam['predict']
+        self.preview_predict = cam['preview_predict']
+        self.logger = logger
+        self.nframes = 0
+        self.logger.info(f'{self.camname}: Creating the simulated camera...')
+        self.init_camera()
+
+    def init_camera(self):
+        self.pool_pixel_format = pool_pixel_format(self.cam)
+        self.record_color = not self.pool_pixel_format.startswith('Mono')
+        shape, dtype = frame_shape(self.cam['options'], pixel_format=self.pool_pixel_format)
+        options = simulation_options(self.config, self.cam)
+        if options['source'] == 'video':
+            source = VideoFrames(options['video'], shape, max_frames=options['max_video_frames'])
+        elif options['source'] == 'synthetic':
+            source = SyntheticFrames(shape, dtype, n_blobs=options['n_blobs'], noise=options['noise'], seed=options['seed'])
+        else:
+            raise ValueError(f"Invalid simulation source: {options['source']}, choose one of {SIMULATION_SOURCES}")
+        # disconnects are given in sec since the start of the session
+        disconnects = [self.start_t + t for t in options['disconnects']]
+        self.make_camera = lambda: SimulatedCamera(self.camname, source, self.cam['options']['AcquisitionFrameRate'],
+                                                   jitter_ms=options['jitter_ms'], drop_rate=options['drop_rate'],
+                                                   drift_ppm=options['drift_ppm'], n_buffers=options['n_buffers'],
+                                                   seed=options['seed'], t0=self.start_t, disconnects=disconnects,
+                                                   disconnect_duration=options['disconnect_duration'])
+        self.camera = self.make_camera()
+        self.name = 'Simulated'
+        if str_to_bool(self.args.trigger_with_arduino):
+            self.logger.info(f'{self.camname}: simulated cameras free-run, the Arduino trigger is ignored')
+        self.start_clock_sync()
+        self.logger.info(f"{self.camname}, name: {self.name}, source: {options['source']}, serial: {self.cam.get('serial')}")
+
+        self.init_consumers()
+
+    def close(self):
+        self.camera.stop()
+        self.clock.close()
+
+    def latch_timestamp(self):
+        if self.camera.is_removed():
+            raise RuntimeError('camera removed')
+        return self.camera.clock()
+
+    def start_acquisition(self, n_frames=None):
+        self.camera.start()
+
+    def end_acquisition(self):
+        self.camera.stop()
+        self.logger.info(f'{self.camname}: simulated camera | {self.camera.report()}')
+
+    def is_removed(self):
+        return self.camera.is_removed()
+
+    def triggered(self):
+        # simulated cameras free-run
+        return False
+
+    def retrieve(self, timeout_time):
+        return self.camera.retrieve(timeout_time / 1000)
+
+    def read_frame(self, image_result):
+        return GrabbedFrame(image_result.image_number, image_result.image_number, image_result.time_stamp,
+                            image_result.block_id, image_result.n_skipped)
+
+    def put_frame(self, image_result):
+        return self.frame_pool.put(image_result.image, self.n_consumers, timeout=self.pool_timeout)
+
+    def reopen(self):
+        """ Replaces the camera once it is back on the bus, with its clock and counters reset like after a power cycle. """
+        if self.camera.is_removed() and time.perf_counter() < self.camera.removed_until:
+            raise RuntimeError(f"simulated camera {self.cam.get('serial')} not found")
+        self.camera.stop()
+        self.camera = self.make_camera()
+        self.clock.reset()
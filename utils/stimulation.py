@@ -1,5 +1,7 @@
 import json
 import time
+import struct
+import binascii
 from utils.helpers import str_to_bool
 from concurrent.futures import ThreadPoolExecutor
 
@@ -11,6 +13,48 @@ def threaded(fn):
         return tp.submit(fn, *args, **kwargs)  # returns Future object
     return wrapper
 
+# a run of `count` stimulation epochs every `period` ms from `onset` ms after the trigger, each `duration` ms long
+# with pulses of `interval` ms and `duty` percent, as uploaded to the sketch (utils/arduino_pwm_led)
+SCHEDULE_RUN = struct.Struct('<IIHHHB')
+MAX_SCHEDULE_RUNS = 40  # runs the sketch can store
+CHUNK_RUNS = 3  # runs per upload chunk, a chunk has to fit in the Arduino's 64 byte serial buffer
+UPLOAD_RETRIES = 3
+
+
+def compile_schedule(epochs):
+    """ Compiles stimulation epochs (onset ms, duration ms, pulse interval ms, duty cycle %) into runs of
+    equally spaced identical epochs (onset, period, count, duration, interval, duty), see SCHEDULE_RUN.
+    Identical epochs given twice are kept once; overlapping epochs and values the sketch can't store
+    raise a ValueError. Returns the runs and the number of removed duplicates.
+    """
+    for onset, duration, interval, duty in epochs:
+        if not 0 <= onset < 2 ** 32:
+            raise ValueError(f'Invalid stimulation onset: {onset} ms')
+        if not 0 < duration < 2 ** 16 or not 0 < interval < 2 ** 16:
+            raise ValueError(f'Stimulation duration ({duration} ms) and pulse interval ({interval} ms) must be in 1-65535 ms')
+        if not 0 <= duty <= 100:
+            raise ValueError(f'Invalid duty cycle: {duty}%')
+    unique = sorted(set(epochs))
+    for previous, epoch in zip(unique, unique[1:]):
+        if epoch[0] < previous[0] + previous[1]:
+            raise ValueError(f'Overlapping stimulations at {previous[0]} and {epoch[0]} ms.')
+
+    runs = []
+    for onset, duration, interval, duty in unique:
+        if runs:
+            run_onset, period, count, *params = runs[-1]
+            if params == [duration, interval, duty] and count < 2 ** 16 - 1:
+                if count == 1 and onset - run_onset < 2 ** 32:
+                    runs[-1][1:3] = [onset - run_onset, 2]
+                    continue
+                if onset == run_onset + count * period:
+                    runs[-1][2] += 1
+                    continue
+        runs.append([onset, 0, 1, duration, interval, duty])
+    if len(runs) > MAX_SCHEDULE_RUNS:
+        raise ValueError(f'The stimulation schedule compiles to {len(runs)} runs, the Arduino stores at most {MAX_SCHEDULE_RUNS}.')
+    return [tuple(run) for run in runs], len(epochs) - len(unique)
+
 
 class Stimulator():
 
@@ -44,7 +88,6 @@ class Stimulator():
         self.pulse_dutyCycles = []  # percent
         
         global_offset = 0  # sec
-        stimulation_end_time = None
 
         for block_number in stimulation_cfg.keys():
             cur_block = stimulation_cfg[block_number]
@@ -60,25 +103,29 @@ class Stimulator():
             assert len(cur_block["stimulation_turnOn_times_sec"]) == len(cur_block["pulse_offtime_ms"])
 
             for i, local_on_time in enumerate(cur_block["stimulation_turnOn_times_sec"]):
-                self.stimulation_turnOn_times_global.append(int(local_on_time) + global_offset)
-                if stimulation_end_time is not None:
-                    if self.stimulation_turnOn_times_global[-1] < stimulation_end_time:
-                        raise ValueError("Conflicting stimulation start/end times.")
-                    
+                self.stimulation_turnOn_times_global.append(float(local_on_time) + global_offset)
                 self.stimulation_durations.append(int(cur_block["stimulation_durations_ms"][i]))
-                stimulation_end_time = self.stimulation_turnOn_times_global[-1] + (self.stimulation_durations[-1] / 1000)
                 self.pulse_intervals.append((int(cur_block["pulse_ontime_ms"][i]) + int(cur_block["pulse_offtime_ms"][i])))
                 self.pulse_dutyCycles.append(round(int(cur_block["pulse_ontime_ms"][i]) /
                                         (int(cur_block["pulse_ontime_ms"][i]) + int(cur_block["pulse_offtime_ms"][i])) * 100))
             
             global_offset += int(cur_block["duration_sec"])
+
+        # validated, deduplicated and compacted for the upload
+        epochs = [(round(on_time * 1000), duration, interval, duty) for on_time, duration, interval, duty in
+                  zip(self.stimulation_turnOn_times_global, self.stimulation_durations, self.pulse_intervals, self.pulse_dutyCycles)]
+        self.schedule, n_duplicates = compile_schedule(epochs)
+        if n_duplicates:
+            self.logger.info(f'Removed {n_duplicates} duplicate stimulation(s) from {self.args.stimulation_path}')
     
     def print_params(self):
         self.logger.info(f'block_durations: {self.block_durations}')
         self.logger.info(f'stimulation_turnOn_times_global: {self.stimulation_turnOn_times_global}')
         self.logger.info(f'stimulation_durations: {self.stimulation_durations}')
         self.logger.info(f'pulse_intervals: {self.pulse_intervals}')
-        self.logger.info(f'pulse_dutyCycles: {self.pulse_dutyCycles}\n')
+        self.logger.info(f'pulse_dutyCycles: {self.pulse_dutyCycles}')
+        self.logger.info(f'schedule: {len(self.stimulation_durations)} stimulations in {len(self.schedule)} runs '
+                         f'[onset (ms), period (ms), count, duration (ms), pulse interval (ms), duty cycle (%)]: {self.schedule}\n')
         # print(f'block_durations: {self.block_durations}')
         # print(f'stimulation_turnOn_times_global: {self.stimulation_turnOn_times_global}')
         # print(f'stimulation_durations: {self.stimulation_durations}')
@@ -89,19 +136,33 @@ class Stimulator():
         if self.arduino is None:
             raise ValueError('Arduino is not set as the trigger source.')
         
-        stim_profiles = [f'{self.stimulation_turnOn_times_global[i]}-{self.stimulation_durations[i]}-' + 
-                         f'{self.pulse_intervals[i]}-{self.pulse_dutyCycles[i]}' for i in range(len(self.stimulation_turnOn_times_global))]
-        cmd = 'D,' + ','.join(stim_profiles) + '\n'
-        self.arduino.arduino.write(cmd.encode())
-        self.logger.info("***Sent stimulation config cmd to Arduino: {} ***".format(cmd))
-        # print("***Sent stimulation config cmd to Arduino: {} ***".format(cmd))
+        # U announces the runs and the CRC of the whole schedule, C sends them in CRC-checked chunks
+        # (retried if rejected or not acknowledged), F checks that the sketch got all of them
+        data = b''.join(SCHEDULE_RUN.pack(*run) for run in self.schedule)
+        self.arduino.request(f'U,{len(self.schedule)},{binascii.crc_hqx(data, 0)}')
+        chunk_size = CHUNK_RUNS * SCHEDULE_RUN.size
+        for seq, start in enumerate(range(0, len(data), chunk_size)):
+            chunk = data[start:start + chunk_size]
+            self.send_chunk(seq, chunk)
+        self.arduino.request('F')
+        self.logger.info(f"***Sent stimulation schedule to Arduino: {len(self.schedule)} runs, {len(data)} bytes ***")
+
+    def send_chunk(self, seq, chunk):
+        payload = chunk + struct.pack('<H', binascii.crc_hqx(chunk, 0))
+        for attempt in range(1, UPLOAD_RETRIES + 1):
+            try:
+                return self.arduino.request(f'C,{seq},{len(chunk)}', payload=payload)
+            except (TimeoutError, RuntimeError) as e:
+                if attempt == UPLOAD_RETRIES:
+                    raise
+                self.logger.info(f'Stimulation schedule chunk {seq}: {e}, retrying')
     
     def send_stim_trigger(self):
         if self.arduino is None:
             raise ValueError('Arduino is not set as the trigger source.')
         
         cmd = 'T\n'
-        self.arduino.arduino.write(cmd.encode())
+        self.arduino.request(cmd)
         self.logger.info("***Sent stimulation trigger cmd to Arduino: {} ***".format(cmd))
         # print("***Sent stimulation trigger cmd to Arduino: {} ***".format(cmd))
 
@@ -0,0 +1,222 @@
+import time
+import threading
+import numpy as np
+from collections import deque
+from utils.helpers import str_to_bool
+from utils.metadata import ColumnarWriter
+
+SYNC_MODES = ['trigger', 'timestamp']
+
+# latched (camera clock, host clock) pairs, written to clock_<camname>
+CLOCK_DTYPE = np.dtype([('cam_clock_time_stamp', np.int64), ('host_time', np.float64), ('latch_duration', np.float64)])
+
+
+def sync_options(config, args):
+    """ Returns synchronizer options from the `sync` section of the config. Frames are matched by
+    trigger index with the Arduino trigger, by drift-corrected timestamps otherwise.
+    """
+    options = {'mode': 'trigger' if str_to_bool(args.trigger_with_arduino) else 'timestamp', 'relatch_period': 10.0,
+               'tolerance': 0.5, 'max_pending': 256}
+    options.update(config.get('sync') or {})
+    return options
+
+
+class ClockSync():
+    """ Maps a camera clock (ns ticks) to host time (sec since start_t, time.perf_counter()).
+
+    `latch` is a callable that latches and returns the camera clock. It is sampled at start and then
+    every `period` sec in a background thread; host = intercept + slope * (ticks - ticks0) is a least
+    squares fit of the last `n_samples` samples, which corrects the drift between the two clocks.
+    """
+
+    def __init__(self, name, latch, start_t, logger, period=10.0, n_samples=360, path=None) -> None:
+        self.name = name
+        self.latch = latch
+        self.start_t = start_t
+        self.logger = logger
+        self.period = period
+        self.samples = deque(maxlen=n_samples)
+        self.fit = None  # (ticks0, slope, intercept), replaced as a whole so that readers need no lock
+        self.table = ColumnarWriter(path, CLOCK_DTYPE, chunk_size=16) if path is not None else None
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.lock = threading.Lock()  # between the background samples, reset() and the to_host() fallback
+
+    def sample(self):
+        try:
+            before = time.perf_counter()
+            ticks = int(self.latch())
+            after = time.perf_counter()
+        except Exception as e:
+            self.logger.info(f'{self.name}: Could not latch the camera clock: {e}')
+            return
+        # the latch happened somewhere between the two host readings
+        host_time = (before + after) / 2 - self.start_t
+        with self.lock:
+            self.samples.append((ticks, host_time))
+            if self.table is not None:
+                self.table.append((ticks, host_time, after - before))
+            self.refit()
+
+    def reset(self):
+        """ Starts a new fit after the camera clock was reset, e.g. when the camera was reconnected. """
+        with self.lock:
+            self.samples.clear()
+            self.fit = None
+        self.sample()
+
+    def refit(self):
+        ticks, host_time = np.array(self.samples, dtype=np.float64).T
+        ticks0 = int(self.samples[0][0])
+        if len(self.samples) < 2 or ticks[-1] == ticks[0]:
+            self.fit = (ticks0, 1e-9, host_time[0])
+            return
+        slope, intercept = np.polyfit(ticks - ticks0, host_time, 1)
+        self.fit = (ticks0, slope, intercept)
+
+    def to_host(self, ticks):
+        """ Host time (sec since start_t) of a camera timestamp. """
+        if self.fit is None:
+            # the clock could not be latched, assume the frame was timestamped when it arrived
+            with self.lock:
+                self.samples.append((int(ticks), time.perf_counter() - self.start_t))
+                self.refit()
+        ticks0, slope, intercept = self.fit
+        return intercept + slope * (int(ticks) - ticks0)
+
+    def drift_ppm(self):
+        """ Camera clock drift relative to the host clock in parts per million, positive if the camera clock runs faster. """
+        return 0.0 if self.fit is None else (1 / (self.fit[1] * 1e9) - 1) * 1e6
+
+    def start(self):
+        self.sample()
+        if self.period:
+            self.thread = threading.Thread(target=self.run, name=f'{self.name}_clock', daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while not self.stop_event.wait(self.period):
+            self.sample()
+
+    def close(self):
+        if self.stop_event.is_set():
+            return
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.table is not None:
+            self.table.close()
+
+
+class FrameSynchronizer():
+    """ Matches the frames of all cameras into a joint frame table, one row per trigger and a
+    `<camname>_frame_id` and `<camname>_time` column per camera (-1 / nan for missing frames).
+
+    In `trigger` mode a frame's row is its trigger index (grabbed frames plus dropped frames before it,
+    see GapDetector); in `timestamp` mode it is the number of frame periods between its drift-corrected
+    host time and the first frame of any camera. A row is complete once every camera has delivered a
+    later frame, or once more than `max_pending` rows are open. Complete rows are written to `path` and
+    passed to the `on_row` callbacks; `latest_row` is the last complete row.
+    """
+
+    def __init__(self, camnames, fps, logger, mode='trigger', path=None, tolerance=0.5, max_pending=256) -> None:
+        if mode not in SYNC_MODES:
+            raise ValueError(f'Invalid sync mode: {mode}, choose one of {SYNC_MODES}')
+        self.camnames = list(camnames)
+        self.period = 1 / fps
+        self.logger = logger
+        self.mode = mode
+        self.tolerance = tolerance
+        self.max_pending = max_pending
+        fields = [('trigger', np.int64)]
+        for camname in self.camnames:
+            fields += [(f'{camname}_frame_id', np.int64), (f'{camname}_time', np.float64)]
+        self.dtype = np.dtype(fields)
+        self.table = ColumnarWriter(path, self.dtype) if path is not None else None
+        self.lock = threading.Lock()
+        self.pending = {}  # trigger -> row
+        self.last_trigger = {camname: -1 for camname in self.camnames}
+        self.next_trigger = 0  # first row that is not complete yet
+        self.t0 = None
+        self.latest_row = None
+        self.on_row = []
+
+        # counters
+        self.n_rows = 0
+        self.n_complete = 0
+        self.n_late = 0
+        self.n_off_grid = 0
+
+    def trigger_index(self, info, trigger_index):
+        if self.mode == 'trigger':
+            return trigger_index
+        if self.t0 is None:
+            self.t0 = info.time_stamp_w_offset
+        periods = (info.time_stamp_w_offset - self.t0) / self.period
+        index = int(round(periods))
+        if abs(periods - index) > self.tolerance / 2:
+            self.n_off_grid += 1
+        return index
+
+    def update(self, camname, info, trigger_index=None):
+        """ Adds a camera's frame (FrameInfo); `trigger_index` is required in trigger mode. """
+        with self.lock:
+            index = self.trigger_index(info, trigger_index)
+            if index < self.next_trigger:
+                self.n_late += 1  # its row was already written
+                return
+            row = self.pending.get(index)
+            if row is None:
+                row = self.pending[index] = self.empty_row(index)
+            row[f'{camname}_frame_id'] = info.frame_id
+            row[f'{camname}_time'] = info.time_stamp_w_offset
+            self.last_trigger[camname] = max(self.last_trigger[camname], index)
+            self.flush(min(self.last_trigger.values()))
+
+    def empty_row(self, index):
+        row = np.zeros((), dtype=self.dtype)
+        row['trigger'] = index
+        for camname in self.camnames:
+            row[f'{camname}_frame_id'] = -1
+            row[f'{camname}_time'] = np.nan
+        return row
+
+    def flush(self, complete_until):
+        """ Emits rows up to `complete_until` (exclusive), and the oldest rows beyond max_pending. """
+        while self.pending and (self.next_trigger < complete_until or len(self.pending) > self.max_pending):
+            row = self.pending.pop(self.next_trigger, None)
+            if row is None:
+                row = self.empty_row(self.next_trigger)  # no camera got this trigger
+            self.emit(row)
+            self.next_trigger += 1
+
+    def emit(self, row):
+        complete = all(row[f'{camname}_frame_id'] != -1 for camname in self.camnames)
+        self.n_rows += 1
+        self.n_complete += complete
+        self.latest_row = row
+        if self.table is not None:
+            self.table.append(row.item())
+        for callback in self.on_row:
+            callback(row)
+
+    def report(self):
+        return (f'rows: {self.n_rows}, complete: {self.n_complete}, pending: {len(self.pending)}, '
+                f'late: {self.n_late}, off grid: {self.n_off_grid}')
+
+    def close(self):
+        with self.lock:
+            self.flush(max(self.pending.keys(), default=-1) + 1)
+        if self.table is not None:
+            self.table.close()
+        self.logger.info(f'Frame synchronizer | {self.report()}')
+
+
+class SyncQueue():
+    """ Stand-in for FrameSynchronizer in a camera process: sends (camname, info, trigger_index) to the main process. """
+
+    def __init__(self, queue) -> None:
+        self.queue = queue
+
+    def update(self, camname, info, trigger_index=None):
+        self.queue.put((camname, tuple(info), trigger_index))
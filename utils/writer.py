@@ -0,0 +1,214 @@
+import os
+import threading
+import numpy as np
+from queue import Queue, Full, Empty
+from collections import namedtuple
+from utils.frame_pool import frame_pool_options, max_queue_size
+
+# block: the grab loop waits for room in the queue (no frame is lost, but acquisition can stall)
+# drop: the newest frame is discarded when the queue is full
+# spill: overflowing frames are appended to a file on disk and written once the queue drains
+OVERFLOW_POLICIES = ['block', 'drop', 'spill']
+DEFAULT_QUEUE_SIZE = 240  # 2 sec at 120 FPS
+
+# per-frame descriptor that travels with a frame (or frame pool slot) to the writer
+FrameInfo = namedtuple('FrameInfo', ['frame_id', 'image_number', 'cam_clock_time_stamp', 'time_stamp_w_offset'])
+# FrameInfo as a numpy record, for columnar storage
+FRAME_INFO_DTYPE = np.dtype([('frame_id', np.int64), ('image_number', np.int64),
+                             ('cam_clock_time_stamp', np.int64), ('time_stamp_w_offset', np.float64)])
+
+
+def writer_options(config, cam):
+    """ Returns writer options from the top-level `writer` section of the config,
+    overridden by the camera's own `writer` section if present.
+    The queue is capped to fit in the camera's frame pool, see max_queue_size().
+    """
+    options = {'queue_size': DEFAULT_QUEUE_SIZE, 'overflow_policy': 'block'}
+    options.update(config.get('writer') or {})
+    options.update(cam.get('writer') or {})
+    options['queue_size'] = min(options['queue_size'], max_queue_size(frame_pool_options(config, cam)['n_slots']))
+    return options
+
+
+class FrameWriter():
+    """ Writer stage between a grab loop and a video sink.
+
+    The grab loop calls put() and a dedicated thread blocks on the bounded queue, passing
+    frames and their FrameInfo to `sink(frame, info)` in order. close() enqueues a sentinel and waits for the queue to drain.
+    If `frame_pool` is given, put() takes slot indices of the pool instead of frames, and each
+    slot is released once it is written, dropped or spilled. With `color`, the sink gets the
+    pool's (cached) BGR conversion of the slot instead of the native frame.
+    """
+
+    def __init__(self, name, sink, logger, queue_size=DEFAULT_QUEUE_SIZE, overflow_policy='block',
+                 spill_path=None, frame_pool=None, color=False) -> None:
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f'Invalid overflow policy: {overflow_policy}, choose one of {OVERFLOW_POLICIES}')
+        if overflow_policy == 'spill' and spill_path is None:
+            raise ValueError('spill_path is required for the spill overflow policy.')
+
+        self.name = name
+        self.sink = sink
+        self.logger = logger
+        self.queue_size = int(queue_size)
+        self.overflow_policy = overflow_policy
+        self.frame_pool = frame_pool
+        self.color = color
+        self.queue = Queue(maxsize=self.queue_size)
+
+        # counters
+        self.n_put = 0
+        self.n_written = 0
+        self.n_dropped = 0
+        self.n_blocked = 0
+        self.n_spilled = 0
+        self.n_errors = 0
+        self.max_depth = 0
+
+        # spill state, guarded by spill_lock
+        self.spill_path = spill_path
+        self.spill_lock = threading.Lock()
+        self.spilling = False
+        self.n_spill_written = 0
+        self.n_spill_read = 0
+        self.spill_out = None
+        self.spill_in = None
+
+        self.thread = threading.Thread(target=self.run, name=f'{name}_writer', daemon=True)
+        self.thread.start()
+
+    def put(self, frame, info=None):
+        """ Hands a frame (or a frame pool slot) and its FrameInfo to the writer thread. Returns False if it was dropped. """
+        self.n_put += 1
+        item = (frame, info)
+
+        if self.overflow_policy == 'spill':
+            with self.spill_lock:
+                if not self.spilling:
+                    try:
+                        self.queue.put_nowait(item)
+                        self.update_depth()
+                        return True
+                    except Full:
+                        self.spilling = True
+                # once spilling, every frame goes to disk until the writer catches up, to keep the order
+                self.spill(frame, info)
+            return True
+
+        try:
+            self.queue.put_nowait(item)
+        except Full:
+            if self.overflow_policy == 'drop':
+                self.n_dropped += 1
+                if self.frame_pool is not None:
+                    self.frame_pool.release(frame)
+                return False
+            self.n_blocked += 1
+            self.queue.put(item)
+        self.update_depth()
+        return True
+
+    def update_depth(self):
+        depth = self.queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def depth(self):
+        return self.queue.qsize() + (self.n_spill_written - self.n_spill_read)
+
+    def spill(self, frame, info=None):
+        if self.spill_out is None:
+            self.spill_out = open(self.spill_path, 'w+b')
+            self.spill_in = open(self.spill_path, 'rb')
+        if self.frame_pool is not None:
+            np.save(self.spill_out, self.resolve(frame), allow_pickle=False)
+            self.frame_pool.release(frame)
+        else:
+            np.save(self.spill_out, np.asarray(frame), allow_pickle=False)
+        # FrameInfo is stored as a record after the frame, an empty array stands for None
+        record = np.array([info] if info is not None else [], dtype=FRAME_INFO_DTYPE)
+        np.save(self.spill_out, record, allow_pickle=False)
+        self.spill_out.flush()
+        self.n_spill_written += 1
+        self.n_spilled += 1
+
+    def unspill(self):
+        # reading happens outside the lock; only frames that were already flushed are read
+        frame = np.load(self.spill_in, allow_pickle=False)
+        record = np.load(self.spill_in, allow_pickle=False)
+        info = FrameInfo(*record[0].tolist()) if len(record) else None
+        with self.spill_lock:
+            self.n_spill_read += 1
+            if self.n_spill_read == self.n_spill_written:
+                # caught up: rewind the spill file and go back to the in-memory queue
+                self.spill_out.seek(0)
+                self.spill_out.truncate()
+                self.spill_in.seek(0)
+                self.n_spill_written = 0
+                self.n_spill_read = 0
+                self.spilling = False
+        return frame, info
+
+    def resolve(self, slot):
+        return self.frame_pool.bgr(slot) if self.color else self.frame_pool[slot]
+
+    def spill_pending(self):
+        return self.n_spill_read < self.n_spill_written
+
+    def write(self, frame, info=None):
+        try:
+            self.sink(frame, info)
+            self.n_written += 1
+        except Exception as e:
+            self.n_errors += 1
+            self.logger.info(f'{self.name}: Error writing frame: {e}')
+
+    def run(self):
+        while True:
+            if self.spill_pending():
+                # frames in the queue are older than the spilled ones
+                try:
+                    item = self.queue.get_nowait()
+                except Empty:
+                    self.write(*self.unspill())
+                    continue
+            else:
+                item = self.queue.get()
+
+            if item is None:  # sentinel
+                break
+            frame, info = item
+            if self.frame_pool is not None:
+                self.write(self.resolve(frame), info)
+                self.frame_pool.release(frame)
+            else:
+                self.write(frame, info)
+
+        # frames spilled before the sentinel was queued
+        while self.spill_pending():
+            self.write(*self.unspill())
+
+    def drain(self):
+        """ Waits until all queued (and spilled) frames are written, the writer keeps running. Not to be called during put(). """
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = threading.Thread(target=self.run, name=f'{self.name}_writer', daemon=True)
+        self.thread.start()
+
+    def close(self):
+        """ Stops the writer after all queued (and spilled) frames are written. """
+        self.queue.put(None)
+        self.thread.join()
+        if self.spill_out is not None:
+            self.spill_out.close()
+            self.spill_in.close()
+            os.remove(self.spill_path)
+
+    def stats(self):
+        return {'put': self.n_put, 'written': self.n_written, 'depth': self.depth(),
+                'max_depth': self.max_depth, 'dropped': self.n_dropped, 'blocked': self.n_blocked,
+                'spilled': self.n_spilled, 'errors': self.n_errors}
+
+    def report(self):
+        stats = self.stats()
+        return ', '.join(f'{key}: {value}' for key, value in stats.items())